@@ -0,0 +1,667 @@
+"""Benchmarks for the lww_set implementations
+
+Usage:
+    python lww_benchmark.py [benchmark ...] [--size N] [--redis HOST:PORT]
+
+Without --redis only the lww_python engines are measured. With --redis,
+the lww_add_set/lww_remove_set keys of the given redis server are
+overwritten. Benchmarks in PYTHON_ONLY run on lww_python alone.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import pickle
+import random
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import deque
+from lww_interface import LWW_set
+from lww_python import LWW_python
+from lww_python_compact import LWW_python_compact
+from lww_python_sharded import LWW_python_sharded
+from lww_snapshot import LWW_snapshot
+
+
+def timed(func, *args):
+    """Returns the wall clock seconds spent in func(*args)"""
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def traced_peak(func, *args):
+    """Returns the peak bytes allocated by Python during func(*args)"""
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def consume(iterable):
+    deque(iterable, maxlen=0)
+
+
+def traced_current(func, *args):
+    """Returns the bytes still allocated by Python after func(*args),
+    keeping its result alive while measuring"""
+    tracemalloc.start()
+    try:
+        result = func(*args)
+        return tracemalloc.get_traced_memory()[0]
+    finally:
+        del result
+        tracemalloc.stop()
+
+
+def percentile(sorted_values, p):
+    """Returns the p-th percentile (0-100) of a sorted list"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.0))]
+
+
+def report(name, n, seconds, unit="ops"):
+    print("%-40s %10d %-8s %10.3f s %12.0f %s/s" % (name, n, unit, seconds, n / seconds, unit))
+
+
+def make_ops(n, n_elements=None, seed=0):
+    """Returns n random (op, element, timestamp) tuples"""
+    rand = random.Random(seed)
+    n_elements = n_elements or n
+    ops = []
+    for timestamp in range(n):
+        op = LWW_set.ADD if rand.random() < 0.7 else LWW_set.REMOVE
+        ops.append((op, str(rand.randrange(n_elements)), timestamp))
+    return ops
+
+
+def make_zipf_ops(n, n_elements, s=1.1, seed=0):
+    """Returns n (op, element, timestamp) tuples whose elements follow a
+    Zipf distribution with exponent s, i.e., element k is chosen with a
+    probability proportional to 1 / k ** s"""
+    rand = random.Random(seed)
+    cum_weights = []
+    total = 0.0
+    for k in range(1, n_elements + 1):
+        total += 1.0 / k ** s
+        cum_weights.append(total)
+    elements = rand.choices(range(n_elements), cum_weights=cum_weights, k=n)
+    return [(LWW_set.ADD if rand.random() < 0.7 else LWW_set.REMOVE, str(element), timestamp)
+            for timestamp, element in enumerate(elements)]
+
+
+def python_factory():
+    return LWW_python()
+
+
+def python_compact_factory():
+    return LWW_python_compact()
+
+
+def python_sharded_factory():
+    return LWW_python_sharded()
+
+
+def redis_factory(address):
+    """Returns a factory of empty LWW_redis sets on the given host:port"""
+    import redis
+    from lww_redis import LWW_redis
+
+    host, _, port = address.partition(":")
+    r = redis.StrictRedis(host=host, port=int(port or 6379), db=0)
+
+    def factory(**kwargs):
+        r.delete("lww_add_set", "lww_remove_set", "lww_count", "lww_feed")
+        return LWW_redis(r, **kwargs)
+    factory.host = host
+    factory.port = int(port or 6379)
+    return factory
+
+
+def apply_one_by_one(lww, ops):
+    for op, element, timestamp in ops:
+        if op == LWW_set.ADD:
+            lww.add(element, timestamp)
+        else:
+            lww.remove(element, timestamp)
+
+
+def bench_batch(name, factory, n):
+    """apply_ops() against a per-element add()/remove() loop"""
+    ops = make_ops(n)
+    report("%s loop" % name, n, timed(apply_one_by_one, factory(), ops))
+    report("%s apply_ops" % name, n, timed(factory().apply_ops, ops))
+
+
+def bench_get(name, factory, n):
+    """get() on sets of n/100, n/10 and n elements, a third of them removed"""
+    for size in (n // 100, n // 10, n):
+        lww = factory()
+        lww.add_many((i, 2) for i in range(size))
+        lww.remove_many((i, 3) for i in range(0, size, 3))
+        report("%s get" % name, size, timed(lww.get), "elements")
+        report("%s iter_elements" % name, size,
+               timed(lambda: consume(lww.iter_elements())), "elements")
+
+
+def bench_iter_memory(name, factory, n):
+    """Peak memory of get() against iter_elements() on n/100, n/10 and n
+    elements, with the bytes per element"""
+    for size in (n // 100, n // 10, n):
+        lww = factory()
+        lww.add_many((i, 1) for i in range(size))
+        for label, func in (("get", lww.get),
+                            ("iter_elements", lambda: consume(lww.iter_elements()))):
+            peak = traced_peak(func)
+            print("%-40s %10d elements %12d bytes peak %8.1f bytes/element"
+                  % ("%s %s" % (name, label), size, peak, peak / max(size, 1)))
+
+
+def bench_memory(name, factory, n):
+    """Bytes per element of n added elements, then with all of them removed"""
+    elements = [str(i) for i in range(n)]  # allocated before tracing
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        lww = factory()
+        lww.add_many((element, 1) for element in elements)
+        added = tracemalloc.get_traced_memory()[0]
+        lww.remove_many((element, 2) for element in elements)
+        removed = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    print("%-40s %10d elements %8.1f bytes/element" % ("%s added" % name, n, (added - before) / float(n)))
+    print("%-40s %10d elements %8.1f bytes/element" % ("%s added+removed" % name, n, (removed - before) / float(n)))
+
+
+def run_threads(n_threads, target, *args):
+    """Runs target(i, *args) in n_threads threads and waits for them"""
+    threads = [threading.Thread(target=target, args=(i,) + args) for i in range(n_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def private_dirty():
+    """Returns the private dirty bytes of this process, i.e., the memory
+    it no longer shares with its parent after a fork (Linux only)"""
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Private_Dirty:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return 0
+
+
+def run_processes(n_processes, target, *args):
+    """Runs target(i, *args) in n_processes forked processes, waits for
+    them and returns the private dirty bytes of each one at its end"""
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+
+    def run(i):
+        target(i, *args)
+        results.put(private_dirty())
+
+    processes = [context.Process(target=run, args=(i,)) for i in range(n_processes)]
+    for p in processes:
+        p.start()
+    dirty = [results.get() for _ in processes]
+    for p in processes:
+        p.join()
+    return dirty
+
+
+def bench_threads(name, factory, n):
+    """n add()/remove() calls on distinct elements split over 1-64 threads"""
+    def write(i, lww, n_threads):
+        for element in range(i, n, n_threads):
+            lww.add(element, 1)
+            lww.remove(element, 2)
+
+    for n_threads in (1, 4, 16, 64):
+        report("%s %d threads" % (name, n_threads), 2 * n,
+               timed(run_threads, n_threads, write, factory(), n_threads))
+
+
+def bench_sync(name, factory, n):
+    """Anti-entropy after 1% new writes: delta_since() against full state"""
+    source = factory()
+    source.add_many((i, i) for i in range(n))
+    watermark = source.watermark()
+    source.apply_ops((op, element, n + timestamp + 1)
+                     for op, element, timestamp in make_ops(n // 100, n, seed=1))
+
+    for label, since in (("full", None), ("delta", watermark)):
+        replica = LWW_python()
+        replica.add_many((i, i) for i in range(n))
+        shipped = len(list(source.delta_since(since)))
+        report("%s %s sync" % (name, label), shipped, timed(replica.merge, source, since), "entries")
+
+
+def bench_snapshot(name, factory, n):
+    """Warm start from a binary snapshot against pickle and JSON files"""
+    lww = factory()
+    lww.add_many((i, i) for i in range(n))
+    lww.remove_many((i, i + 1) for i in range(0, n, 2))
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "lww")
+
+        def pickle_dump():
+            with open(path + ".pickle", "wb") as f:
+                pickle.dump((lww.add_set, lww.remove_set), f, pickle.HIGHEST_PROTOCOL)
+
+        def pickle_load():
+            with open(path + ".pickle", "rb") as f:
+                return pickle.load(f)
+
+        def json_dump():
+            with open(path + ".json", "w") as f:
+                json.dump([lww.add_set, lww.remove_set], f)
+
+        def json_load():
+            with open(path + ".json") as f:
+                return json.load(f)
+
+        def snapshot_open():
+            snapshot = LWW_snapshot(path + ".snapshot")
+            for i in range(0, n, max(1, n // 1000)):
+                snapshot.exist(i)
+            return snapshot
+
+        formats = [("snapshot", lambda: lww.dump(path + ".snapshot"),
+                    lambda: LWW_python.load(path + ".snapshot")),
+                   ("pickle", pickle_dump, pickle_load),
+                   ("json", json_dump, json_load)]
+        for label, dump, load in formats:
+            dump_seconds = timed(dump)
+            size = os.path.getsize("%s.%s" % (path, label))
+            load_seconds = timed(load)
+            heap = traced_current(load)
+            print("%-40s %10d elements dump %7.3f s load %7.3f s %12d bytes file %12d bytes heap"
+                  % ("%s %s" % (name, label), n, dump_seconds, load_seconds, size, heap))
+        # opening is lazy: time mapping the file and 1000 cold exist() calls
+        print("%-40s %10d elements open+1000 exist %7.3f s %12d bytes heap"
+              % ("%s mmap snapshot" % name, n, timed(snapshot_open), traced_current(snapshot_open)))
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_async(name, factory, n):
+    """n exist() calls from waves of 1000 concurrent coroutines on
+    AsyncLWW_redis, with and without coalescing"""
+    import redis.asyncio
+    from lww_redis_async import AsyncLWW_redis
+
+    factory().add_many((i, 1) for i in range(n))
+
+    async def wave(lww, elements, latencies):
+        async def one(element):
+            start = time.perf_counter()
+            await lww.exist(element)
+            latencies.append(time.perf_counter() - start)
+        await asyncio.gather(*[one(element) for element in elements])
+
+    async def run(batch_size):
+        pool = redis.asyncio.BlockingConnectionPool(host=factory.host, port=factory.port, max_connections=64)
+        client = redis.asyncio.StrictRedis(connection_pool=pool)
+        lww = AsyncLWW_redis(client)
+        lww.BATCH_SIZE = batch_size
+        latencies = []
+        start = time.perf_counter()
+        for offset in range(0, n, 1000):
+            await wave(lww, range(offset, min(n, offset + 1000)), latencies)
+        seconds = time.perf_counter() - start
+        await client.aclose()
+        return seconds, sorted(latencies)
+
+    for label, batch_size in (("coalesced", AsyncLWW_redis.BATCH_SIZE), ("one by one", 1)):
+        seconds, latencies = asyncio.run(run(batch_size))
+        report("%s async exist %s" % (name, label), n, seconds)
+        print("%-40s p50 %8.3f ms p99 %8.3f ms" % ("", percentile(latencies, 50) * 1000,
+                                                   percentile(latencies, 99) * 1000))
+
+
+def bench_coalesce(name, factory, n):
+    """add()/remove() calls of a Zipf workload, directly and through an
+    LWW_coalescer with several flush policies, counting the entries
+    written to the backend"""
+    from lww_coalescer import LWW_coalescer
+
+    # 10k elements with a few hot ones
+    ops = make_zipf_ops(n, 10000, s=1.2)
+    seconds = timed(apply_one_by_one, factory(), ops)
+    print("%-40s %10d ops %10.3f s %10d backend writes"
+          % ("%s direct" % name, n, seconds, n))
+    for max_entries, max_delay in ((1000, None), (10000, None), (1000, 0.01)):
+        coalescer = LWW_coalescer(factory(), max_entries=max_entries, max_delay=max_delay)
+        seconds = timed(apply_one_by_one, coalescer, ops)
+        seconds += timed(coalescer.close)
+        writes = coalescer.stats["writes"]
+        print("%-40s %10d ops %10.3f s %10d backend writes %6.1fx fewer (%d flushes)"
+              % ("%s coalesced %d/%s" % (name, max_entries, max_delay), n, seconds,
+                 writes, float(n) / writes, coalescer.stats["flushes"]))
+
+
+def bench_cache(name, factory, n):
+    """n exist() calls on Zipf distributed elements, with and without
+    the exist() cache of LWW_redis"""
+    from lww_redis import LWW_redis
+
+    lww = factory()
+    lww.add_many((i, 1) for i in range(10000))
+    elements = [element for _, element, _ in make_zipf_ops(n, 10000, s=1.2)]
+    report("%s exist" % name, n, timed(consume, map(lww.exist, elements)))
+    for cache_size in (100, 1000, 10000):
+        cached = LWW_redis(lww.redis, cache_size=cache_size)
+        cached.cache_ready.wait(5)
+        seconds = timed(consume, map(cached.exist, elements))
+        stats = cached.cache_stats
+        report("%s exist cache %d" % (name, cache_size), n, seconds)
+        print("%-40s hits %d misses %d evictions %d (%.1f%% hits)"
+              % ("", stats["hits"], stats["misses"], stats["evictions"],
+                 100.0 * stats["hits"] / n))
+        cached.close()
+
+
+def bench_query(name, factory, n):
+    """get_range(), latest() and select() on a set of n elements, and
+    the cost of the add timestamp index of lww_python on writes"""
+    variants = [(name, factory)]
+    if factory is python_factory:
+        variants.append(("%s ordered" % name, lambda: LWW_python(ordered=True)))
+    ops = make_ops(n)
+    for label, variant_factory in variants:
+        lww = variant_factory()
+        report("%s apply_ops" % label, n, timed(lww.apply_ops, ops))
+        report("%s add one by one" % label, 10000,
+               timed(apply_one_by_one, lww, [(LWW_set.ADD, i, n + i) for i in range(10000)]))
+        rand = random.Random(0)
+        starts = [rand.randrange(n) for _ in range(10)]
+        report("%s get_range(t, t+100)" % label, len(starts),
+               timed(consume, (lww.get_range(start, start + 100) for start in starts)), "queries")
+        report("%s latest(10)" % label, len(starts),
+               timed(consume, (lww.latest(10) for _ in starts)), "queries")
+        report("%s select(n/4, 10)" % label, len(starts),
+               timed(consume, (lww.select(n // 4, 10) for _ in starts)), "queries")
+
+
+def bench_exist_many(name, factory, n):
+    """n membership checks of which half exist, by an exist() loop and
+    by one exist_many() call"""
+    lww = factory()
+    lww.add_many((i, 1) for i in range(0, n, 2))
+    elements = list(range(n))
+    report("%s exist loop" % name, n, timed(consume, map(lww.exist, elements)))
+    report("%s exist_many" % name, n, timed(lww.exist_many, elements))
+
+
+def bench_calls(name, factory, n):
+    """Per-call overhead of add(), remove() and exist() on lww_python,
+    with str/float arguments (the validation fast path), int arguments
+    (converted), and with trusted=True (no validation)"""
+    str_elements = [str(i) for i in range(n)]
+    float_timestamps = [float(i) for i in range(n)]
+    variants = [("str/float", LWW_python, str_elements, float_timestamps),
+                ("int/int", LWW_python, list(range(n)), list(range(n))),
+                ("trusted", lambda: LWW_python(trusted=True), str_elements, float_timestamps)]
+    for label, variant_factory, elements, timestamps in variants:
+        lww = variant_factory()
+        for method in (lww.add, lww.remove):
+            seconds = timed(consume, map(method, elements, timestamps))
+            print("%-40s %10d calls %10.0f ns/call"
+                  % ("%s %s %s" % (name, method.__name__, label), n, seconds * 1e9 / n))
+        seconds = timed(consume, map(lww.exist, elements))
+        print("%-40s %10d calls %10.0f ns/call" % ("%s exist %s" % (name, label), n, seconds * 1e9 / n))
+
+
+def bench_int_timestamps(name, factory, n):
+    """Bytes per element and write/read time of n elements with
+    nanosecond timestamps, stored as floats and as ints. Every third
+    element is removed 1 ns after its add, which floats cannot tell
+    apart, so they get these elements wrong."""
+    elements = [str(i) for i in range(n)]
+    base = 1700000000000000000
+    ops = [(LWW_set.ADD, elements[i], base + i) for i in range(n)]
+    ops.extend((LWW_set.REMOVE, elements[i], base + i + 1) for i in range(0, n, 3))
+    variants = [("float", LWW_python), ("int", lambda: LWW_python(int_timestamps=True)),
+                ("compact float", LWW_python_compact),
+                ("compact int", lambda: LWW_python_compact(int_timestamps=True))]
+    for label, variant_factory in variants:
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            lww = variant_factory()
+            lww.apply_ops(ops)
+            used = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+        lww = variant_factory()
+        report("%s %s apply_ops" % (name, label), len(ops), timed(lww.apply_ops, ops))
+        report("%s %s exist" % (name, label), n, timed(consume, map(lww.exist, elements)))
+        print("%-40s %10d elements %8.1f bytes/element %d wrong"
+              % ("%s %s" % (name, label), n, used / float(n),
+                 sum(1 for i, flag in zip(range(n), lww.exist_many(elements))
+                     if flag != (i % 3 != 0))))
+
+
+def bench_clock(name, factory, n):
+    """Stamps per second of lww_clock in 1 and 4 threads and by
+    reserve(), and add() stamped by the clock against time.time()"""
+    from lww_clock import LWW_clock
+
+    clock = LWW_clock()
+    now = clock.now
+    report("lww_clock now", n, timed(lambda: consume(now() for _ in range(n))), "stamps")
+    report("lww_clock reserve(1000)", n,
+           timed(lambda: consume(clock.reserve(1000) for _ in range(n // 1000))), "stamps")
+
+    def stamp(i, count):
+        for _ in range(count):
+            now()
+    report("lww_clock now 4 threads", n, timed(run_threads, 4, stamp, n // 4), "stamps")
+
+    elements = [str(i) for i in range(n)]
+    lww = factory()
+    report("%s add time.time()" % name, n,
+           timed(lambda: consume(lww.add(element, time.time()) for element in elements)))
+    lww = factory()
+    lww.clock = clock
+    report("%s add clock" % name, n, timed(lambda: consume(lww.add(element) for element in elements)))
+
+
+def bench_shared(name, factory, n):
+    """n exist() calls split over 1, 4 and 16 forked processes, on the
+    inherited copy of lww_python in every process against one
+    LWW_shared, with the memory each process stops sharing; then n
+    add() calls on LWW_shared. Times include forking."""
+    import gc
+    from lww_shared import LWW_shared
+
+    copy = factory()
+    copy.add_many((i, 1) for i in range(n))
+    shared = LWW_shared(capacity=2 * n)
+    shared.add_many((i, 1) for i in range(n))
+
+    def read(i, lww, n_processes):
+        exist = lww.exist
+        for element in range(i, n, n_processes):
+            exist(element)
+
+    def write(i, lww, n_processes):
+        add = lww.add
+        for element in range(i, n, n_processes):
+            add(element, 2)
+
+    # as a pre-fork server would, so that the garbage collector of a
+    # worker does not write to every inherited object
+    gc.freeze()
+    try:
+        for n_processes in (1, 4, 16):
+            for label, lww in (("%s copy" % name, copy), ("lww_shared", shared)):
+                dirty = []
+                seconds = timed(lambda: dirty.extend(run_processes(n_processes, read, lww, n_processes)))
+                print("%-40s %10d ops      %10.3f s %12.0f ops/s %8.1f MB/process"
+                      % ("%s exist %d processes" % (label, n_processes), n, seconds,
+                         n / seconds, max(dirty) / 1e6))
+        for n_processes in (1, 4, 16):
+            with LWW_shared(capacity=2 * n) as lww:
+                report("lww_shared add %d processes" % n_processes, n,
+                       timed(run_processes, n_processes, write, lww, n_processes))
+    finally:
+        gc.unfreeze()
+        shared.close()
+
+
+def bench_metrics(name, factory, n):
+    """add() and exist() calls on a set that was never instrumented,
+    one instrumented and then uninstrumented, which must be as fast,
+    and an instrumented one"""
+    from lww_metrics import LWW_metrics, instrument, uninstrument
+
+    elements = [str(i) for i in range(n)]
+    metrics = LWW_metrics()
+    variants = (("plain", factory),
+                ("uninstrumented", lambda: uninstrument(instrument(factory(), metrics))),
+                ("instrumented", lambda: instrument(factory(), metrics)))
+    for label, make in variants:
+        lww = make()  # one set at a time, so the heap is the same for all
+        add = lww.add
+        exist = lww.exist
+        report("%s %s add" % (name, label), n,
+               timed(lambda: consume(add(element, 1) for element in elements)))
+        report("%s %s exist" % (name, label), n,
+               timed(lambda: consume(exist(element) for element in elements)))
+    summary = metrics.latency["exist"].summary()
+    print("%-40s p50 %8.1f us p99 %8.1f us p999 %8.1f us"
+          % ("%s exist latency" % name, summary["p50"] * 1e6, summary["p99"] * 1e6,
+             summary["p999"] * 1e6))
+
+
+def bench_count(name, factory, n):
+    """count() against len(get()) on a set of n elements, and the cost
+    of keeping the counter on writes"""
+    lww = factory()
+    ops = make_ops(n)
+    report("%s apply_ops" % name, n, timed(lww.apply_ops, ops))
+    report("%s count()" % name, 100, timed(consume, (lww.count() for _ in range(100))), "calls")
+    report("%s len(get())" % name, 10, timed(consume, (len(lww.get()) for _ in range(10))), "calls")
+
+
+def bench_buckets(name, factory, n):
+    """apply_ops() and get() of n elements split into 1, 4 and 16
+    buckets. On a single server, this is the overhead of bucketing;
+    on a cluster, the buckets are spread over the nodes."""
+    from lww_redis import LWW_redis
+
+    ops = make_ops(n, n // 2)
+    redis_client = factory().redis
+    for n_buckets in (1, 4, 16):
+        lww = LWW_redis(redis_client, namespace="lww_benchmark", n_buckets=n_buckets)
+        keys = [key for pair in lww.buckets for key in pair]
+        redis_client.delete(*keys)
+        report("%s %d buckets apply_ops" % (name, n_buckets), n, timed(lww.apply_ops, ops))
+        seconds = timed(lww.get)
+        report("%s %d buckets get" % (name, n_buckets), len(lww.get()), seconds, "elements")
+        redis_client.delete(*keys)
+        lww.close()
+
+
+def bench_feed(name, factory, n):
+    """add()/remove() calls without and with a change feed subscriber,
+    and the seconds until the subscriber received every flip"""
+    make = factory
+    if hasattr(factory, "host"):
+        make = lambda: factory(feed_length=n)
+    ops = make_ops(n, n // 4)
+    reference = LWW_python()
+    queue = reference.changes()
+    queue.max_events = n
+    apply_one_by_one(reference, ops)
+    flips = len(queue.events)
+
+    report("%s loop" % name, n, timed(apply_one_by_one, make(), ops))
+    lww = make()
+    received = [0]
+
+    def callback(batch):
+        received[0] += len(batch)
+    try:
+        subscription = lww.subscribe(callback)
+    except NotImplementedError:
+        return
+    start = time.perf_counter()
+    apply_one_by_one(lww, ops)
+    report("%s loop subscribed" % name, n, time.perf_counter() - start)
+    while received[0] < flips:
+        time.sleep(0.001)
+    report("%s subscriber caught up" % name, flips, time.perf_counter() - start, "events")
+    subscription.close()
+
+
+PYTHON_ONLY = set(["calls", "clock", "int_timestamps", "shared", "snapshot"])
+REDIS_ONLY = set(["async", "buckets", "cache"])
+
+BENCHMARKS = {
+    "async": bench_async,
+    "batch": bench_batch,
+    "buckets": bench_buckets,
+    "cache": bench_cache,
+    "calls": bench_calls,
+    "coalesce": bench_coalesce,
+    "clock": bench_clock,
+    "count": bench_count,
+    "exist_many": bench_exist_many,
+    "feed": bench_feed,
+    "get": bench_get,
+    "int_timestamps": bench_int_timestamps,
+    "iter_memory": bench_iter_memory,
+    "memory": bench_memory,
+    "metrics": bench_metrics,
+    "query": bench_query,
+    "shared": bench_shared,
+    "snapshot": bench_snapshot,
+    "sync": bench_sync,
+    "threads": bench_threads,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for lww_set")
+    parser.add_argument("benchmarks", nargs="*", default=sorted(BENCHMARKS),
+                        help="benchmarks to run (default: all)")
+    parser.add_argument("--size", type=int, default=100000,
+                        help="number of operations or elements")
+    parser.add_argument("--redis", metavar="HOST:PORT",
+                        help="also benchmark lww_redis on this server")
+    args = parser.parse_args()
+
+    backends = [("lww_python", python_factory),
+                ("lww_python_compact", python_compact_factory),
+                ("lww_python_sharded", python_sharded_factory)]
+    if args.redis:
+        backends.append(("lww_redis", redis_factory(args.redis)))
+
+    for benchmark in args.benchmarks:
+        for name, factory in backends:
+            if benchmark in PYTHON_ONLY and factory is not python_factory:
+                continue
+            if benchmark in REDIS_ONLY and not hasattr(factory, "host"):
+                continue
+            BENCHMARKS[benchmark](name, factory, args.size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Hybrid logical clock (HLC) timestamps for lww-sets
+
+A stamp is one int: the wall clock in milliseconds since the epoch,
+shifted left by LOGICAL_BITS, plus a logical counter in the low bits.
+Every stamp of a clock is larger than the previous one and than every
+stamp the clock has seen, so a write stamped after a merge always wins
+over the merged writes, even if the wall clock of this host is behind.
+When the wall clock moves on, stamps follow it again. More than
+2 ** LOGICAL_BITS stamps per millisecond carry into the millisecond
+part, i.e., the clock runs slightly ahead until the wall clock catches
+up.
+
+With LOGICAL_BITS = 10, stamps stay below 2 ** 53 until the year 2248,
+so they are exact as floats and as Redis ZSET scores.
+"""
+
+import time
+from threading import *
+
+LOGICAL_BITS = 10
+
+
+class LWW_clock(object):
+    """A hybrid logical clock that stamps lww-set writes.
+
+    now() returns the next stamp. update() moves the clock past a stamp
+    received from another replica; lww-sets with a clock call it for
+    every timestamp passed to add(), remove() and apply_ops(), and so
+    for merge(). The state is one int behind a lock that is held for a
+    comparison and an assignment, so threads hardly contend on it.
+    reserve() hands out a block of stamps for one lock acquisition.
+
+    Keyword attributes:
+    wall_clock -- a function returning the wall clock in nanoseconds
+    since the epoch, e.g., time.time_ns
+    last -- the largest stamp issued or seen
+    """
+    def __init__(self, wall_clock=time.time_ns):
+        self.wall_clock = wall_clock
+        self.last = 0
+        self.lock = Lock()
+
+    def now(self):
+        """Returns a new stamp, larger than any stamp issued or seen"""
+        wall = self.wall_clock() // 1000000 << LOGICAL_BITS
+        # acquire() and release() are cheaper than a with statement,
+        # which matters at millions of stamps per second
+        self.lock.acquire()
+        try:
+            stamp = self.last + 1
+            if stamp < wall:
+                stamp = wall
+            self.last = stamp
+        finally:
+            self.lock.release()
+        return stamp
+
+    def reserve(self, n):
+        """Returns the first of n new consecutive stamps"""
+        wall = self.wall_clock() // 1000000 << LOGICAL_BITS
+        self.lock.acquire()
+        try:
+            stamp = self.last + 1
+            if stamp < wall:
+                stamp = wall
+            self.last = stamp + n - 1
+        finally:
+            self.lock.release()
+        return stamp
+
+    def update(self, stamp):
+        """Moves the clock past a stamp received from another replica"""
+        if stamp > self.last:  # most stamps seen are older, no lock needed
+            self.lock.acquire()
+            try:
+                if stamp > self.last:
+                    self.last = int(stamp)
+            finally:
+                self.lock.release()
+
+    @staticmethod
+    def stamp_at(seconds):
+        """Returns the first stamp of a wall clock time in seconds since
+        the epoch, e.g., the horizon of compact()"""
+        return int(seconds * 1000) << LOGICAL_BITS
+
+    @staticmethod
+    def seconds(stamp):
+        """Returns the wall clock time of a stamp in seconds since the epoch"""
+        return (int(stamp) >> LOGICAL_BITS) / 1000.0
@@ -0,0 +1,87 @@
+"""unit tests for the lww_clock"""
+
+import threading
+import unittest
+from lww_clock import LWW_clock, LOGICAL_BITS
+from lww_python import LWW_python
+from lww_python_compact import LWW_python_compact
+
+class Fake_wall_clock(object):
+    """A wall clock in nanoseconds that only moves when told to, in
+    milliseconds"""
+    def __init__(self, ms):
+        self.ms = ms
+
+    def __call__(self):
+        return self.ms * 1000000
+
+
+class Test_LWW_Clock(unittest.TestCase):
+    def test_now(self):
+        wall = Fake_wall_clock(1000)
+        clock = LWW_clock(wall)
+        first = clock.now()
+        self.assertEqual(first, 1000 << LOGICAL_BITS)
+        self.assertEqual(clock.now(), first + 1)  # same millisecond
+        wall.ms = 1001
+        self.assertEqual(clock.now(), 1001 << LOGICAL_BITS)
+        wall.ms = 900  # the wall clock goes back, stamps do not
+        self.assertEqual(clock.now(), (1001 << LOGICAL_BITS) + 1)
+        self.assertEqual(LWW_clock.seconds(first), 1.0)
+        self.assertEqual(LWW_clock.stamp_at(1.0), first)
+
+    def test_update(self):
+        wall = Fake_wall_clock(1000)
+        clock = LWW_clock(wall)
+        remote = 5000 << LOGICAL_BITS  # a replica with a clock ahead
+        clock.update(remote)
+        self.assertEqual(clock.now(), remote + 1)
+        clock.update(remote - 10)  # older stamps do not move it back
+        self.assertEqual(clock.now(), remote + 2)
+
+    def test_reserve(self):
+        clock = LWW_clock(Fake_wall_clock(1000))
+        first = clock.reserve(100)
+        self.assertEqual(clock.now(), first + 100)
+
+    def test_threads(self):
+        clock = LWW_clock()
+        stamps = [[] for _ in range(4)]
+
+        def stamp(i):
+            for _ in range(5000):
+                stamps[i].append(clock.now())
+
+        threads = [threading.Thread(target=stamp, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for thread_stamps in stamps:
+            self.assertEqual(thread_stamps, sorted(thread_stamps))
+        self.assertEqual(len(set(s for thread_stamps in stamps for s in thread_stamps)), 20000)
+
+    def test_lww_set(self):
+        wall = Fake_wall_clock(1000)
+        for lww_type in (LWW_python, LWW_python_compact):
+            lww = lww_type(int_timestamps=True, clock=LWW_clock(wall))
+            lww.add("a")
+            lww.remove("a")  # the same millisecond, still later
+            self.assertFalse(lww.exist("a"))
+            self.assertRaises(ValueError, LWW_python().add, "a")  # no clock
+
+            # a write of a replica with a clock ahead is merged, and the
+            # next local write wins over it
+            other = LWW_python(int_timestamps=True, clock=LWW_clock(Fake_wall_clock(2000)))
+            other.add("a")
+            lww.merge(other)
+            self.assertTrue(lww.exist("a"))
+            lww.remove("a")
+            self.assertFalse(lww.exist("a"))
+            lww.add("b", 3000 << LOGICAL_BITS)
+            lww.remove("b")
+            self.assertFalse(lww.exist("b"))
+
+
+if __name__ == '__main__':
+    unittest.main()
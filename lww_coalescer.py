@@ -0,0 +1,296 @@
+"""Write coalescing front-end for lww-sets
+
+Only the largest add and remove timestamp of an element matter, so a
+burst of operations on a hot element can be collapsed to at most two
+entries before it reaches the backend. LWW_coalescer buffers operations
+in two dicts of element to largest timestamp and writes them to the
+backend with one apply_ops() call per flush.
+"""
+
+from threading import *
+from lww_interface import LWW_set
+
+
+class LWW_coalescer(LWW_set):
+    """An lww-set that coalesces writes in front of another lww-set.
+
+    add(), remove() and apply_ops() only update the buffer and return
+    True. The buffer is flushed to the backend by the writer that makes
+    it reach max_entries distinct entries, and by a background thread
+    every max_delay seconds (never, if max_delay is None). flush()
+    forces a flush and close() flushes and stops the thread.
+
+    exist() reads your writes: the buffered timestamps of the element
+    are combined with the ones of the backend, see timestamps(). get(),
+    iter_elements(), count(), the ordered queries, delta_since() and
+    compact() flush first and then read the backend.
+
+    Keyword attributes:
+    backend -- the lww-set written to, of any implementation
+    max_entries -- the number of buffered entries that triggers a flush
+    max_delay -- the maximum seconds an operation stays buffered
+    """
+    def __init__(self, backend, max_entries=1000, max_delay=0.01):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.max_delay = max_delay
+        self.add_buffer = {}
+        self.remove_buffer = {}
+        self.flushing = ({}, {})  # the buffers being written to the backend
+        self.lock = Lock()        # protects the buffers and stats
+        self.flush_lock = Lock()  # serializes flushes
+        self.stats = {"ops": 0, "writes": 0, "flushes": 0, "errors": 0}
+        self.closed = False
+        self.wake = Event()
+        self.flusher = None
+        if max_delay is not None:
+            self.flusher = Thread(target=self.__run_flusher)
+            self.flusher.daemon = True
+            self.flusher.start()
+
+    def use_int_timestamps(self):
+        """Switches the coalescer and its backend to int timestamps
+
+        See base class LWW_set docstring for detals.
+        """
+        self.backend.use_int_timestamps()
+        LWW_set.use_int_timestamps(self)
+
+    def add(self, element, timestamp=None):
+        """Add an element to the buffer
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+        timestamp = self.write_timestamp(timestamp)
+        return self.__buffer([(self.ADD, element, timestamp)])
+
+    def remove(self, element, timestamp=None):
+        """Remove an element through the buffer
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+        timestamp = self.write_timestamp(timestamp)
+        return self.__buffer([(self.REMOVE, element, timestamp)])
+
+    def apply_ops(self, ops):
+        """Apply a batch of add and remove operations to the buffer
+
+        See base class LWW_set docstring for detals.
+        """
+        ops = [self.validate_op(op, element, timestamp)
+               for op, element, timestamp in ops]
+        return self.__buffer(ops)
+
+    def __buffer(self, ops):
+        """Folds validated operations into the buffer
+
+        Keyword returns:
+        True -- the operations are buffered
+        False -- the coalescer is closed, or the flush triggered by
+        these operations failed
+        """
+        with self.lock:
+            if self.closed:
+                return False
+            add_buffer = self.add_buffer
+            remove_buffer = self.remove_buffer
+            for op, element, timestamp in ops:
+                target_buffer = add_buffer if op == self.ADD else remove_buffer
+                current_timestamp = target_buffer.get(element)
+                if current_timestamp is None or current_timestamp < timestamp:
+                    target_buffer[element] = timestamp
+            self.stats["ops"] += len(ops)
+            full = len(add_buffer) + len(remove_buffer) >= self.max_entries
+        if full:
+            return self.flush()
+        return True
+
+    def flush(self):
+        """Writes the buffered entries to the backend in one apply_ops()
+
+        If the backend fails, the entries are put back into the buffer
+        and retried by the next flush.
+
+        Keyword returns:
+        True -- the buffer was written, or was empty
+        False -- the backend failed
+        """
+        with self.flush_lock:
+            with self.lock:
+                add_buffer, remove_buffer = self.add_buffer, self.remove_buffer
+                if not add_buffer and not remove_buffer:
+                    return True
+                self.add_buffer, self.remove_buffer = {}, {}
+                self.flushing = (add_buffer, remove_buffer)
+
+            ops = [(self.ADD, element, timestamp) for element, timestamp in add_buffer.items()]
+            ops.extend((self.REMOVE, element, timestamp) for element, timestamp in remove_buffer.items())
+            try:
+                return_flag = self.backend.apply_ops(ops)
+            except RuntimeError:
+                return_flag = False
+
+            with self.lock:
+                self.flushing = ({}, {})
+                self.stats["flushes"] += 1
+                if return_flag:
+                    self.stats["writes"] += len(ops)
+                else:
+                    self.stats["errors"] += 1
+                    for target_buffer, failed in ((self.add_buffer, add_buffer),
+                                                  (self.remove_buffer, remove_buffer)):
+                        for element, timestamp in failed.items():
+                            current_timestamp = target_buffer.get(element)
+                            if current_timestamp is None or current_timestamp < timestamp:
+                                target_buffer[element] = timestamp
+            return return_flag
+
+    def __run_flusher(self):
+        while not self.closed:
+            self.wake.wait(self.max_delay)
+            self.flush()
+
+    def close(self):
+        """Stops the flush thread and flushes the buffer
+
+        Keyword returns:
+        the result of the last flush()
+        """
+        with self.lock:
+            self.closed = True
+        self.wake.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        return self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def timestamps(self, element):
+        """Returns the add and remove timestamps of an element, including
+        buffered operations
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+        with self.lock:
+            buffered = [target_buffer.get(element) for target_buffer in
+                        (self.add_buffer, self.remove_buffer) + self.flushing]
+        # read the backend after the buffers: an entry that left
+        # flushing in between has been written to the backend
+        add_timestamp, remove_timestamp = self.backend.timestamps(element)
+        for timestamp in buffered[0::2]:
+            if timestamp is not None and (add_timestamp is None or add_timestamp < timestamp):
+                add_timestamp = timestamp
+        for timestamp in buffered[1::2]:
+            if timestamp is not None and (remove_timestamp is None or remove_timestamp < timestamp):
+                remove_timestamp = timestamp
+        return add_timestamp, remove_timestamp
+
+    def exist(self, element):
+        """Check if the element exists in lww-set, including buffered
+        operations
+
+        See base class LWW_set docstring for detals.
+        """
+        add_timestamp, remove_timestamp = self.timestamps(element)
+        if add_timestamp is None:
+            return False
+        return remove_timestamp is None or add_timestamp >= remove_timestamp
+
+    def exist_many(self, elements):
+        """Check which of many elements exist in lww-set, including
+        buffered operations
+
+        Elements without buffered operations are checked by one
+        exist_many() call on the backend, the others by exist().
+
+        See base class LWW_set docstring for detals.
+        """
+        validate_element = self.validate_element
+        elements = [validate_element(element) for element in elements]
+        with self.lock:
+            buffers = (self.add_buffer, self.remove_buffer) + self.flushing
+            buffered = set(element for element in elements
+                           if any(element in target_buffer for target_buffer in buffers))
+        unbuffered = [element for element in elements if element not in buffered]
+        flags = iter(self.backend.exist_many(unbuffered))
+        return [self.exist(element) if element in buffered else next(flags)
+                for element in elements]
+
+    def get(self):
+        """Returns an array of all existing elements in lww-set
+
+        See base class LWW_set docstring for detals.
+        """
+        self.flush()
+        return self.backend.get()
+
+    def iter_elements(self, batch_size=1000):
+        """Iterates over all existing elements in lww-set
+
+        See base class LWW_set docstring for detals.
+        """
+        self.flush()
+        return self.backend.iter_elements(batch_size)
+
+    def count(self):
+        """Returns the number of existing elements in lww-set
+
+        See base class LWW_set docstring for detals.
+        """
+        self.flush()
+        return self.backend.count()
+
+    def get_range(self, start_timestamp, end_timestamp):
+        """Returns the existing elements added between two timestamps
+
+        See base class LWW_set docstring for detals.
+        """
+        self.flush()
+        return self.backend.get_range(start_timestamp, end_timestamp)
+
+    def latest(self, n):
+        """Returns the n most recently added existing elements
+
+        See base class LWW_set docstring for detals.
+        """
+        self.flush()
+        return self.backend.latest(n)
+
+    def select(self, offset, limit):
+        """Returns one page of the existing elements
+
+        See base class LWW_set docstring for detals.
+        """
+        self.flush()
+        return self.backend.select(offset, limit)
+
+    def watermark(self):
+        """Returns the watermark of the backend, after a flush
+
+        See base class LWW_set docstring for detals.
+        """
+        self.flush()
+        return self.backend.watermark()
+
+    def delta_since(self, watermark=None):
+        """Iterates over the entries changed after a watermark
+
+        See base class LWW_set docstring for detals.
+        """
+        self.flush()
+        return self.backend.delta_since(watermark)
+
+    def compact(self, horizon_timestamp, slice_size=1000):
+        """Garbage collect redundant entries of the backend
+
+        See base class LWW_set docstring for detals.
+        """
+        self.flush()
+        return self.backend.compact(horizon_timestamp, slice_size)
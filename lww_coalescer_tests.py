@@ -0,0 +1,125 @@
+"""unit tests for the lww_coalescer"""
+
+import unittest
+import time
+import lww_python_tests
+from lww_coalescer import LWW_coalescer
+from lww_compactor import LWW_compactor
+from lww_python import LWW_python
+
+
+def coalesced_python():
+    """A coalescer that flushes every 4 entries, without a flush thread"""
+    return LWW_coalescer(LWW_python(), max_entries=4, max_delay=None)
+
+
+class Failing_LWW_python(LWW_python):
+    """An LWW_python whose apply_ops() fails while failing is True"""
+    failing = False
+
+    def apply_ops(self, ops):
+        if self.failing:
+            return False
+        return LWW_python.apply_ops(self, ops)
+
+
+class Test_LWW_Coalescer(lww_python_tests.Test_LWW_Set):
+    """Runs all lww_python tests through a coalescer"""
+    lww_type = staticmethod(coalesced_python)
+
+    def test_compact(self):
+        lww = self.lww_type()
+        lww.add("live", 2)
+        lww.remove("live", 1)
+        lww.add("dead", 1)
+        lww.remove("dead", 2)
+        lww.remove("recent", 10)
+        stats = lww.compact(5)
+        self.assertEqual(stats["add_entries"], 1)
+        self.assertEqual(stats["remove_entries"], 2)
+        self.assertEqual(lww.backend.add_set, {"live": 2})
+        self.assertEqual(lww.backend.remove_set, {"recent": 10})
+        self.assertEqual(lww.get(), ["live"])
+
+    def test_compactor(self):
+        lww = self.lww_type()
+        lww.add_many((i, 1) for i in range(100))
+        lww.remove_many((i, 2) for i in range(100))
+        compactor = LWW_compactor(lww, lambda: 3, interval=0.01, slice_size=10)
+        compactor.start()
+        while compactor.stats["runs"] == 0:
+            time.sleep(0.01)
+        compactor.stop()
+        self.assertEqual(compactor.stats["add_entries"], 100)
+        self.assertEqual(compactor.stats["remove_entries"], 100)
+        self.assertEqual(lww.backend.add_set, {})
+        self.assertEqual(lww.backend.remove_set, {})
+
+    def test_coalescing(self):
+        backend = LWW_python()
+        lww = LWW_coalescer(backend, max_entries=4, max_delay=None)
+        for timestamp in range(100):
+            lww.add("hot", timestamp)
+            lww.remove("hot", timestamp - 1)
+        lww.add("cold", 1)
+        # nothing was written yet, but exist() reads the buffer
+        self.assertEqual(backend.add_set, {})
+        self.assertTrue(lww.exist("hot"))
+        self.assertEqual(lww.timestamps("hot"), (99, 98))
+        # the fourth distinct entry triggers the flush
+        lww.remove("cold", 2)
+        self.assertEqual(backend.add_set, {"hot": 99, "cold": 1})
+        self.assertEqual(backend.remove_set, {"hot": 98, "cold": 2})
+        self.assertEqual(lww.stats["ops"], 202)
+        self.assertEqual(lww.stats["writes"], 4)
+        self.assertEqual(lww.stats["flushes"], 1)
+
+    def test_read_your_writes(self):
+        backend = LWW_python()
+        backend.add("a", 5)
+        backend.remove("b", 5)
+        lww = LWW_coalescer(backend, max_delay=None)
+        lww.remove("a", 4)
+        self.assertTrue(lww.exist("a"))
+        lww.remove("a", 6)
+        self.assertFalse(lww.exist("a"))
+        lww.add("b", 5)
+        self.assertTrue(lww.exist("b"))
+        self.assertTrue(backend.exist("a"))
+        self.assertEqual(sorted(lww.get()), ["b"])
+        self.assertFalse(backend.exist("a"))
+
+    def test_flush_delay(self):
+        backend = LWW_python()
+        lww = LWW_coalescer(backend, max_delay=0.01)
+        lww.add("a", 1)
+        deadline = time.time() + 5
+        while not backend.exist("a") and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(backend.exist("a"))
+        lww.close()
+        self.assertFalse(lww.add("b", 1))
+
+    def test_close(self):
+        backend = LWW_python()
+        with LWW_coalescer(backend, max_delay=60) as lww:
+            lww.add_many((i, 1) for i in range(10))
+        self.assertEqual(len(backend.get()), 10)
+
+    def test_failed_flush(self):
+        backend = Failing_LWW_python()
+        lww = LWW_coalescer(backend, max_delay=None)
+        lww.add("a", 1)
+        backend.failing = True
+        self.assertFalse(lww.flush())
+        self.assertEqual(lww.stats["errors"], 1)
+        # the entries stay buffered and visible
+        lww.add("a", 0)
+        self.assertTrue(lww.exist("a"))
+        backend.failing = False
+        self.assertTrue(lww.flush())
+        self.assertEqual(backend.add_set, {"a": 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
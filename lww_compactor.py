@@ -0,0 +1,59 @@
+from threading import *
+
+class LWW_compactor(Thread):
+    """A background thread that periodically compacts an lww-set.
+
+    Every interval seconds, the thread calls lww_set.compact() with the
+    current stability horizon. Since compact() works in slices of
+    slice_size elements, writers are never stalled for a whole pass.
+
+    Keyword attributes:
+    lww_set -- the lww-set to compact, e.g., LWW_python or LWW_redis
+    horizon -- a function that returns the current causally stable
+    horizon timestamp. See LWW_set.compact().
+    interval -- seconds to wait between two compactions
+    slice_size -- the number of elements checked per slice
+    stats -- the total number of "runs", "errors", dropped
+    "add_entries" and "remove_entries", and reclaimed "bytes"
+    """
+    def __init__(self, lww_set, horizon, interval=60.0, slice_size=1000):
+        Thread.__init__(self)
+        self.daemon = True
+        self.lww_set = lww_set
+        self.horizon = horizon
+        self.interval = interval
+        self.slice_size = slice_size
+        self.stats = {"runs": 0, "errors": 0, "add_entries": 0,
+                      "remove_entries": 0, "bytes": 0}
+        self.stats_lock = Lock()
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.compact_once()
+
+    def compact_once(self):
+        """Compacts the lww-set once with the current horizon
+
+        Keyword returns:
+        the stats of this compaction, or None if it failed
+        """
+        try:
+            stats = self.lww_set.compact(self.horizon(), self.slice_size)
+        except (RuntimeError, ValueError):
+            # keep the thread alive, the next run may succeed
+            with self.stats_lock:
+                self.stats["errors"] += 1
+            return None
+
+        with self.stats_lock:
+            self.stats["runs"] += 1
+            for key in stats:
+                self.stats[key] += stats[key]
+        return stats
+
+    def stop(self):
+        """Stops the thread and waits for the current compaction to finish"""
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
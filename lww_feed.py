@@ -0,0 +1,194 @@
+"""Change feeds of lww-sets
+
+A change event is an (op, element, timestamp) tuple, emitted when an
+element flips between existing and not existing: op is LWW_set.ADD when
+the element starts to exist and LWW_set.REMOVE when it stops, and
+timestamp is the one of the write that flipped it. Writes that only
+move a timestamp without flipping the element emit nothing.
+
+Writers never wait for subscribers. Every subscriber has a bounded
+queue, and the events that do not fit are dropped and counted, so a
+subscriber that falls behind learns it has to resync, e.g., from get()
+or delta_since(), instead of slowing down the writes.
+"""
+
+import time
+from collections import deque
+from threading import *
+
+
+class Change_source(object):
+    """The consumer side of a change feed.
+
+    get_batch() returns the next list of events, and iterating yields
+    the events one by one until close().
+    """
+    def get_batch(self, timeout=None):
+        """Returns the next batch of change events
+
+        Keyword arguments:
+        timeout -- the maximum seconds to wait, or None to wait until
+        an event arrives or the source is closed
+
+        Keyword returns:
+        a non-empty list of (op, element, timestamp) events, an empty
+        list on timeout, or None when the source is closed
+        """
+        raise NotImplementedError("Subclasses should implement this!")
+
+    def close(self):
+        raise NotImplementedError("Subclasses should implement this!")
+
+    def __iter__(self):
+        while True:
+            batch = self.get_batch()
+            if batch is None:
+                return
+            for event in batch:
+                yield event
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Change_queue(Change_source):
+    """The bounded queue of one subscriber of an LWW_feed.
+
+    Keyword attributes:
+    max_events -- the number of queued events; put() drops newer events
+    beyond it
+    batch_size -- the maximum number of events of a get_batch() batch
+    dropped -- the number of events dropped since the queue was created
+    """
+    def __init__(self, feed, max_events, batch_size):
+        self.feed = feed
+        self.max_events = max_events
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.events = deque()
+        self.closed = False
+        self.ready = Condition(Lock())
+
+    def put(self, events):
+        """Queues events without blocking, see the module docstring"""
+        with self.ready:
+            room = self.max_events - len(self.events)
+            if room < len(events):
+                self.dropped += len(events) - max(room, 0)
+                events = events[:max(room, 0)]
+            if events:
+                self.events.extend(events)
+                self.ready.notify()
+
+    def get_batch(self, timeout=None):
+        """Returns the next batch of change events
+
+        See base class Change_source docstring for detals.
+        """
+        with self.ready:
+            if not self.events and not self.closed:
+                self.ready.wait(timeout)
+            if not self.events:
+                return None if self.closed else []
+            count = min(self.batch_size, len(self.events))
+            return [self.events.popleft() for _ in range(count)]
+
+    def close(self):
+        """Unsubscribes the queue; get_batch() returns None once the
+        queued events are consumed"""
+        self.feed.unsubscribe(self)
+        with self.ready:
+            self.closed = True
+            self.ready.notify_all()
+
+
+class Subscription(Thread):
+    """A thread that calls a callback with every batch of a change source.
+
+    An exception of the callback is counted and the thread goes on with
+    the next batch. So is a RuntimeError of the source, e.g., a lost
+    connection, after which the read is retried.
+
+    Keyword attributes:
+    source -- the Change_source read, closed by close()
+    callback -- a function called with each list of events
+    errors -- the number of failed callbacks and reads
+    """
+    def __init__(self, source, callback):
+        Thread.__init__(self)
+        self.daemon = True
+        self.source = source
+        self.callback = callback
+        self.errors = 0
+
+    def run(self):
+        while True:
+            try:
+                batch = self.source.get_batch()
+            except RuntimeError:
+                self.errors += 1
+                time.sleep(0.1)
+                continue
+            if batch is None:
+                return
+            try:
+                self.callback(batch)
+            except Exception:
+                self.errors += 1
+
+    def close(self):
+        """Stops the thread after the current batch"""
+        self.source.close()
+        if self.is_alive() and current_thread() is not self:
+            self.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class LWW_feed(object):
+    """Fans the change events of an lww-set out to its subscribers.
+
+    publish() is called by the writers of the set, in the order their
+    writes took effect, and hands the events to every Change_queue
+    without blocking.
+
+    Keyword attributes:
+    max_events -- the queue length of each subscriber
+    batch_size -- the maximum number of events passed per callback
+    """
+    def __init__(self, max_events=65536, batch_size=1000):
+        self.max_events = max_events
+        self.batch_size = batch_size
+        self.queues = ()  # replaced, never mutated, so publish() needs no lock
+        self.lock = Lock()
+
+    def publish(self, events):
+        """Hands a list of change events to every subscriber"""
+        for queue in self.queues:
+            queue.put(events)
+
+    def changes(self):
+        """Returns a new Change_queue that receives the events published
+        from now on"""
+        queue = Change_queue(self, self.max_events, self.batch_size)
+        with self.lock:
+            self.queues = self.queues + (queue,)
+        return queue
+
+    def subscribe(self, callback):
+        """Starts a Subscription that calls callback with batches of
+        the events published from now on"""
+        subscription = Subscription(self.changes(), callback)
+        subscription.start()
+        return subscription
+
+    def unsubscribe(self, queue):
+        with self.lock:
+            self.queues = tuple(q for q in self.queues if q is not queue)
@@ -0,0 +1,101 @@
+"""unit tests for the lww_feed"""
+
+import threading
+import unittest
+from lww_feed import LWW_feed
+from lww_python import LWW_python
+
+
+class Test_LWW_Feed(unittest.TestCase):
+    def test_queue(self):
+        feed = LWW_feed(max_events=5, batch_size=2)
+        queue = feed.changes()
+        feed.publish([("add", "a", 1), ("add", "b", 1), ("remove", "a", 2)])
+        self.assertEqual(queue.get_batch(), [("add", "a", 1), ("add", "b", 1)])
+        self.assertEqual(queue.get_batch(), [("remove", "a", 2)])
+        self.assertEqual(queue.get_batch(0.01), [])
+        # a full queue drops the newest events instead of blocking
+        feed.publish([("add", str(i), 3) for i in range(7)])
+        self.assertEqual(queue.dropped, 2)
+        self.assertEqual(len(queue.events), 5)
+        queue.close()
+        self.assertEqual(feed.queues, ())
+        self.assertEqual(len(list(queue)), 5)
+        self.assertEqual(queue.get_batch(), None)
+
+    def test_subscribe(self):
+        feed = LWW_feed(batch_size=10)
+        batches = []
+        done = threading.Event()
+
+        def callback(batch):
+            batches.append(batch)
+            if batch[-1][1] == "last":
+                done.set()
+            raise ValueError("counted, not fatal")
+
+        subscription = feed.subscribe(callback)
+        feed.publish([("add", str(i), 1) for i in range(25)])
+        feed.publish([("add", "last", 1)])
+        self.assertTrue(done.wait(5))
+        subscription.close()
+        self.assertFalse(subscription.is_alive())
+        self.assertTrue(all(len(batch) <= 10 for batch in batches))
+        self.assertEqual(sum(len(batch) for batch in batches), 26)
+        self.assertEqual(subscription.errors, len(batches))
+
+
+class Test_LWW_Python_Changes(unittest.TestCase):
+    def test_flips(self):
+        lww = LWW_python()
+        lww.add("before", 1)  # not seen, written before changes()
+        changes = lww.changes()
+        lww.add("a", 1)
+        lww.add("a", 2)       # already exists
+        lww.remove("a", 1)    # older than the add
+        lww.remove("a", 2)    # the add wins the tie
+        lww.remove("a", 3)
+        lww.remove("b", 1)    # never existed
+        lww.apply_ops([(LWW_python.ADD, "b", 2), (LWW_python.ADD, "c", 1),
+                       (LWW_python.REMOVE, "c", 1), (LWW_python.ADD, "a", 3)])
+        lww.merge(LWW_python())
+        self.assertEqual(changes.get_batch(0), [("add", "a", 1), ("remove", "a", 3),
+                                                ("add", "b", 2), ("add", "c", 1), ("add", "a", 3)])
+        self.assertEqual(changes.get_batch(0), [])
+        changes.close()
+        lww.add("d", 1)
+        self.assertEqual(changes.get_batch(0), None)
+
+    def test_subscribe_concurrent(self):
+        """The flips of every element arrive in the order they took effect"""
+        lww = LWW_python()
+        events = []
+        subscription = lww.subscribe(events.extend)
+
+        def write(start):
+            for i in range(200):
+                lww.add(i % 20, start + i)
+                lww.remove(i % 20, start + i + 1)
+
+        writers = [threading.Thread(target=write, args=(start,)) for start in (0, 1000)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        lww.add("last", 1)
+        while not events or events[-1] != ("add", "last", 1):
+            threading.Event().wait(0.01)
+        subscription.close()
+        live = set()
+        for op, element, _ in events:
+            # adds and removes alternate per element
+            self.assertEqual(element in live, op == "remove")
+            if op == "add":
+                live.add(element)
+            else:
+                live.discard(element)
+        self.assertEqual(sorted(live), sorted(lww.get()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,44 @@
 import sys
+import uuid
+
+NODE_BITS = 16  # the default low bits of a tiebroken timestamp for the node id
+
+
+def pack_timestamp(timestamp, node_id, node_bits=NODE_BITS):
+    """Returns an int timestamp that orders by (timestamp, node_id)
+
+    Two replicas that write the same element at the same timestamp
+    would otherwise tie, and the add bias decides. Packing the id of
+    the writing node into the low node_bits bits resolves such writes
+    by node id, the same way on every replica. The packed value must
+    fit the timestamp range of the lww-set, see validate_int_timestamp().
+
+    Keyword arguments:
+    timestamp -- a non-negative int
+    node_id -- an int in [0, 2 ** node_bits)
+    node_bits -- the number of low bits reserved for node ids
+
+    Keyword raise:
+    ValueError -- bad timestamp or node id
+    """
+    if not 0 <= node_id < 1 << node_bits:
+        raise ValueError("node_id must be in [0, %d)!" % (1 << node_bits))
+    if timestamp < 0:
+        raise ValueError("timestamp must not be negative!")
+    return (int(timestamp) << node_bits) | int(node_id)
+
+
+def unpack_timestamp(packed, node_bits=NODE_BITS):
+    """Returns the (timestamp, node_id) of a pack_timestamp() value"""
+    packed = int(packed)
+    return packed >> node_bits, packed & ((1 << node_bits) - 1)
+
+
+def new_epoch():
+    """Returns a new random epoch for the watermarks of a replica, see
+    LWW_set.validate_watermark()"""
+    return uuid.uuid4().hex
+
 
 class LWW_set:
     """An interface fro Last-Writer-Win element set.  
@@ -8,11 +48,25 @@ class LWW_set:
     timestamp). 
     """
     MAX_STRING_IN_BYTES = 1 << 29  # 512 MB
+    # a str of at most this many characters is below MAX_STRING_IN_BYTES,
+    # at 4 bytes per character plus the object header
+    MAX_FAST_STRING_LENGTH = (MAX_STRING_IN_BYTES - 1024) // 4
+    # the range of int timestamps, see use_int_timestamps(); the smallest
+    # int64 is left out to mark a missing timestamp in array('q') storage
+    MIN_INT_TIMESTAMP = -(1 << 63) + 1
+    MAX_INT_TIMESTAMP = (1 << 63) - 1
+
+    # Operation names used by apply_ops()
+    ADD = "add"
+    REMOVE = "remove"
+
+    # an lww_clock.LWW_clock that stamps writes without a timestamp
+    clock = None
 
     def __init__(self):
         pass
 
-    def add(self, element, timestamp):
+    def add(self, element, timestamp=None):
         """Add an element to lww_set, or update the existing element timestamp
 
         If the operation has the most recent timestamp, the operation
@@ -26,7 +80,8 @@ class LWW_set:
 
         Keyword arguments: 
         element -- an object that has a unique identifier
-        timestamp -- a non-negaive number (int or long)
+        timestamp -- a non-negaive number (int or long), or None to
+        stamp the operation with the clock of the set
 
         Keyword returns: 
         True -- The operation is acknowledged and
@@ -40,7 +95,7 @@ class LWW_set:
         """
         raise NotImplementedError("Subclasses should implement this!")
 
-    def remove(self, element, timestamp):
+    def remove(self, element, timestamp=None):
         """Remove an element from lww_set 
 
         If the operation has the most recent timestamp, the operation
@@ -54,7 +109,8 @@ class LWW_set:
 
         Keyword arguments: 
         element -- an object that has a unique identifier
-        timestamp -- a non-negaive number (int or long)
+        timestamp -- a non-negaive number (int or long), or None to
+        stamp the operation with the clock of the set
 
         Keyword returns:
         True -- The operation is acknowledged and
@@ -97,6 +153,55 @@ class LWW_set:
         """
         raise NotImplementedError("Subclasses should implement this!")
     
+    def exist_many(self, elements):
+        """Check which of many elements exist in lww-set
+
+        This default calls exist() per element. Implementations check
+        the whole batch in one pass, or in a few round trips.
+
+        Keyword arguments:
+        elements -- an iterable of objects that have a unique identifier
+
+        Keyword returns:
+        a list of True or False, one per element, in the same order
+
+        Keyword raise:
+        RuntimeError -- An internal error occurs, e.g., disconnection
+        from network. A retry may solve the problem.
+        ValueError   -- bad element argument
+        """
+        return [self.exist(element) for element in elements]
+
+    def exist_mask(self, elements):
+        """Returns exist_many() as a NumPy boolean array
+
+        Requires numpy, which is imported on the first call, e.g., to
+        filter a numpy array of candidates with candidates[mask].
+        """
+        import numpy
+        return numpy.array(self.exist_many(elements), dtype=bool)
+
+    def timestamps(self, element):
+        """Returns the add and remove timestamps of an element
+
+        exist() is decided by these two timestamps. Wrappers that hold
+        operations not written to the lww-set yet, e.g., LWW_coalescer,
+        combine them with their own to answer exist().
+
+        Keyword arguments:
+        element -- an object that has a unique identifier
+
+        Keyword returns:
+        (add_timestamp, remove_timestamp) -- the largest timestamps of
+        the element, each None if there is no such entry
+
+        Keyword raise:
+        RuntimeError -- An internal error occurs, e.g., disconnection
+        from network. A retry may solve the problem.
+        ValueError   -- bad element argument
+        """
+        raise NotImplementedError("Subclasses should implement this!")
+
     def get(self):
         """Returns an array of all existing elements in lww-set 
 
@@ -115,6 +220,428 @@ class LWW_set:
         """
         raise NotImplementedError("Subclasses should implement this!")
 
+    def iter_elements(self, batch_size=1000):
+        """Iterates over all existing elements in lww-set
+
+        A generator counterpart of get(). Elements are produced as soon
+        as they are found, instead of building a list of all existing
+        elements first.
+
+        Keyword arguments:
+        batch_size -- a hint of how many elements are fetched at a time
+        from the underlying storage
+
+        Keyword raise:
+        RuntimeError -- An internal error occurs, e.g., disconnection
+        from network. A retry may solve the problem.
+        """
+        raise NotImplementedError("Subclasses should implement this!")
+
+    def add_many(self, pairs):
+        """Add many elements to lww_set in one batch
+
+        Equivalent to calling add() for each pair, but the whole batch
+        is validated and written with a single lock acquisition or a
+        few server round trips. See apply_ops().
+
+        Keyword arguments:
+        pairs -- an iterable of (element, timestamp) tuples
+
+        Keyword returns:
+        True -- The batch is acknowledged and processed.
+        False -- There was an internal error during the batch. Because
+        the operations are idempotent, a retry of the whole batch may
+        solve the problem.
+
+        Keyword raise:
+        ValueError -- bad element or timestamp argument
+        """
+        return self.apply_ops((self.ADD, element, timestamp)
+                              for element, timestamp in pairs)
+
+    def remove_many(self, pairs):
+        """Remove many elements from lww_set in one batch
+
+        See add_many() and apply_ops().
+
+        Keyword arguments:
+        pairs -- an iterable of (element, timestamp) tuples
+        """
+        return self.apply_ops((self.REMOVE, element, timestamp)
+                              for element, timestamp in pairs)
+
+    def apply_ops(self, ops):
+        """Apply a batch of add and remove operations
+
+        Because lww-set operations are commutative and idempotent, the
+        batch has the same effect as calling add() or remove() for every
+        operation, in any order.
+
+        Keyword arguments:
+        ops -- an iterable of (op, element, timestamp) tuples, where op
+        is LWW_set.ADD or LWW_set.REMOVE
+
+        Keyword returns:
+        True -- The batch is acknowledged and processed.
+        False -- There was an internal error during the batch. A retry
+        may solve the problem.
+
+        Keyword raise:
+        ValueError -- bad op, element or timestamp argument
+        """
+        raise NotImplementedError("Subclasses should implement this!")
+
+    def watermark(self):
+        """Returns the current watermark of this replica
+
+        Every write that changes an entry gives the element the next
+        number of a local change sequence. The watermark marks the
+        current position in that sequence, so that delta_since() can
+        return the entries changed after it. Timestamps cannot serve
+        as watermarks: a write may arrive late, or from a replica with
+        a clock behind, with a timestamp older than entries shipped
+        already.
+
+        A watermark is opaque and only meaningful to the replica that
+        returned it. A watermark of another replica, or of an earlier
+        run of an in-memory replica, gives all entries.
+
+        Keyword returns:
+        the watermark, to pass to delta_since() or merge() later
+
+        Keyword raise:
+        RuntimeError -- An internal error occurs, e.g., disconnection
+        from network. A retry may solve the problem.
+        """
+        raise NotImplementedError("Subclasses should implement this!")
+
+    def delta_since(self, watermark=None):
+        """Iterates over the entries changed after a watermark
+
+        An entry has changed after the watermark if a write changed it
+        after watermark() returned it, whatever the timestamp of that
+        write. The produced operations can be passed to apply_ops() of
+        another replica, which is how merge() ships state. Entries
+        changed while the delta is produced may be returned, and are
+        returned again by the next delta, which is harmless since
+        operations are idempotent.
+
+        Keyword arguments:
+        watermark -- a watermark() of this replica, e.g., taken before
+        the previous sync, or None for all entries
+
+        Keyword returns:
+        an iterable of (op, element, timestamp) tuples, for both
+        entries of every element changed after the watermark
+
+        Keyword raise:
+        RuntimeError -- An internal error occurs, e.g., disconnection
+        from network. A retry may solve the problem.
+        ValueError   -- bad watermark argument
+        """
+        raise NotImplementedError("Subclasses should implement this!")
+
+    def merge(self, other, watermark=None):
+        """Merge the state of another replica into this lww-set
+
+        The merge is the per-element join of both replicas, i.e., the
+        largest add and remove timestamp of every element wins. It is
+        commutative, associative and idempotent, so replicas that merge
+        each other converge. Only entries of other changed after
+        watermark are shipped, which is enough when every older entry
+        was merged before (anti-entropy by deltas instead of full
+        state). Take the watermark of other before the merge, and pass
+        it to the next one:
+
+            watermark = other.watermark()
+            lww.merge(other, previous_watermark)
+            previous_watermark = watermark
+
+        Keyword arguments:
+        other -- another lww-set of any implementation
+        watermark -- see delta_since()
+
+        Keyword returns:
+        True -- The merge is acknowledged and processed.
+        False -- There was an internal error during the merge. A retry
+        may solve the problem.
+        """
+        return self.apply_ops(other.delta_since(watermark))
+
+    def changes(self):
+        """Returns the change events of the writes from now on
+
+        An event is an (op, element, timestamp) tuple, emitted only when
+        a write flips an element: op is ADD when the element starts to
+        exist and REMOVE when it stops. Writes that do not flip an
+        element emit nothing. Writers never wait for a slow consumer,
+        the events it has no room for are dropped and counted, see
+        lww_feed.
+
+        Keyword returns:
+        an lww_feed.Change_source, iterated for the events one by one
+        or read in batches with get_batch(), and stopped with close()
+
+        Keyword raise:
+        RuntimeError -- An internal error occurs, e.g., disconnection
+        from network. A retry may solve the problem.
+        """
+        raise NotImplementedError("Subclasses should implement this!")
+
+    def subscribe(self, callback):
+        """Calls a function with the change events of the writes from now on
+
+        See changes() for the events.
+
+        Keyword arguments:
+        callback -- a function called from a background thread with a
+        list of events at a time
+
+        Keyword returns:
+        an lww_feed.Subscription, stopped with close()
+
+        Keyword raise:
+        RuntimeError -- An internal error occurs, e.g., disconnection
+        from network. A retry may solve the problem.
+        """
+        raise NotImplementedError("Subclasses should implement this!")
+
+    def compact(self, horizon_timestamp, slice_size=1000):
+        """Garbage collect redundant entries of add_set and remove_set
+
+        Two kinds of entries are dropped:
+
+        1) For an element with both an add and a remove entry, the
+        entry that lost, i.e., the remove entry of an existing element
+        or the add entry of a removed element. Dropping it never
+        changes the result of exist(), now or after any later add() or
+        remove(), so this is always safe.
+
+        2) The remaining remove entry of a removed element, if its
+        timestamp is older than horizon_timestamp. The caller must
+        make sure the horizon is causally stable, i.e., no replica will
+        ever issue or deliver another operation older than the horizon.
+        Otherwise a late add() older than the dropped remove() would
+        bring the element back. Operations newer than the horizon are
+        not affected, so commutativity still holds for them.
+
+        The work is done in slices of at most slice_size elements and
+        writers may run between two slices, so compaction does not
+        stall add() or remove() for long.
+
+        Keyword arguments:
+        horizon_timestamp -- remove entries older than this timestamp
+        may be dropped
+        slice_size -- the number of elements checked per slice
+
+        Keyword returns:
+        a dict with the number of dropped "add_entries" and
+        "remove_entries", and the approximate "bytes" they held
+
+        Keyword raise:
+        RuntimeError -- An internal error occurs, e.g., disconnection
+        from network. A retry may solve the problem.
+        ValueError   -- bad timestamp argument
+        """
+        raise NotImplementedError("Subclasses should implement this!")
+
+    def count(self):
+        """Returns the number of existing elements in lww-set
+
+        This default iterates over the set. Implementations that keep
+        a counter on the write path answer in O(1).
+
+        Keyword raise:
+        RuntimeError -- An internal error occurs, e.g., disconnection
+        from network. A retry may solve the problem.
+        """
+        return sum(1 for _ in self.iter_elements())
+
+    def __len__(self):
+        return self.count()
+
+    def __bool__(self):
+        # an lww-set object stays truthy when it is empty, as it was
+        # before __len__() was defined, so "if lww:" checks keep working
+        return True
+
+    __nonzero__ = __bool__
+
+    def get_range(self, start_timestamp, end_timestamp):
+        """Returns the existing elements added between two timestamps
+
+        Elements are ordered by their add timestamp, and elements with
+        the same add timestamp by their string. This default reads the
+        whole set through delta_since() and sorts it. Implementations
+        with an index on the add timestamp answer in O(log n + k).
+
+        Keyword arguments:
+        start_timestamp -- the smallest add timestamp, inclusive
+        end_timestamp -- the largest add timestamp, inclusive
+
+        Keyword returns:
+        an array of existing elements, oldest first
+
+        Keyword raise:
+        RuntimeError -- An internal error occurs, e.g., disconnection
+        from network. A retry may solve the problem.
+        ValueError   -- bad timestamp argument
+        """
+        start_timestamp = self.validate_timestamp(start_timestamp)
+        end_timestamp = self.validate_timestamp(end_timestamp)
+        return [element for timestamp, element in self.__ordered_elements()
+                if start_timestamp <= timestamp <= end_timestamp]
+
+    def latest(self, n):
+        """Returns the n most recently added existing elements
+
+        See get_range() for the order.
+
+        Keyword arguments:
+        n -- the maximum number of elements
+
+        Keyword returns:
+        an array of at most n existing elements, newest first
+        """
+        n = self.validate_count(n)
+        if n == 0:
+            return []
+        return [element for _, element in reversed(self.__ordered_elements()[-n:])]
+
+    def select(self, offset, limit):
+        """Returns one page of the existing elements
+
+        See get_range() for the order.
+
+        Keyword arguments:
+        offset -- the number of existing elements skipped
+        limit -- the maximum number of elements
+
+        Keyword returns:
+        an array of at most limit existing elements, oldest first
+        """
+        offset = self.validate_count(offset)
+        limit = self.validate_count(limit)
+        return [element for _, element in self.__ordered_elements()[offset:offset + limit]]
+
+    def __ordered_elements(self):
+        """Returns the sorted (add timestamp, element) of existing elements"""
+        add_set = {}
+        remove_set = {}
+        for op, element, timestamp in self.delta_since():
+            if op == self.ADD:
+                add_set[element] = timestamp
+            else:
+                remove_set[element] = timestamp
+        return sorted((timestamp, element) for element, timestamp in add_set.items()
+                      if element not in remove_set or timestamp >= remove_set[element])
+
+    def use_int_timestamps(self):
+        """Validates timestamps as ints from now on, see validate_int_timestamp()
+
+        A float has 53 bits of mantissa, so e.g. nanosecond epoch
+        timestamps differing in the last digits become equal floats.
+        Int timestamps compare exactly. Must be called before the first
+        write.
+        """
+        self.validate_timestamp = self.validate_int_timestamp
+
+    def validate_int_timestamp(self, timestamp):
+        """Validate the timestamp argument of a set with int timestamps
+
+        Keyword return
+        timestamp -- validated timestamp in int type
+
+        Keyword raises:
+        ValueError -- failed to convert the timestamp to an int, a float
+        with a fraction, or a timestamp out of [MIN_INT_TIMESTAMP,
+        MAX_INT_TIMESTAMP]
+        """
+        if type(timestamp) is not int:
+            try:
+                converted = int(timestamp)
+            except:
+                raise ValueError("timestamp must be able to be converted to int!")
+            if isinstance(timestamp, float) and converted != timestamp:
+                raise ValueError("timestamp must be a whole number!")
+            timestamp = converted
+        if not self.MIN_INT_TIMESTAMP <= timestamp <= self.MAX_INT_TIMESTAMP:
+            raise ValueError("timestamp must be in [%d, %d]!"
+                             % (self.MIN_INT_TIMESTAMP, self.MAX_INT_TIMESTAMP))
+        return timestamp
+
+    def trust_arguments(self):
+        """Skips the validation of elements and timestamps from now on
+
+        For internal callers that only pass validated arguments, i.e.,
+        element strings within MAX_STRING_IN_BYTES and float (or, with
+        use_int_timestamps(), int) timestamps,
+        such as a set fed by another lww-set. Any other argument is
+        stored as is and may break the set.
+        """
+        self.validate_element = self.trusted_argument
+        self.validate_timestamp = self.trusted_argument
+
+    @staticmethod
+    def trusted_argument(value):
+        """The validation used by trust_arguments(), returns value as is"""
+        return value
+
+    def validate_count(self, count):
+        """Validate a count argument, e.g., the limit of a query
+
+        Keyword return
+        count -- validated non-negative int
+
+        Keyword raises:
+        ValueError -- the count is not a non-negative integer
+        """
+        try:
+            count = int(count)
+        except:
+            raise ValueError("count must be able to be converted to int!")
+        if count < 0:
+            raise ValueError("count must not be negative!")
+        return count
+
+    def validate_op(self, op, element, timestamp):
+        """Validate one (op, element, timestamp) operation of a batch
+
+        Keyword return
+        (op, element, timestamp) -- validated operation tuple
+
+        Keyword raises:
+        ValueError -- unknown op, or bad element or timestamp argument
+        """
+        if op != self.ADD and op != self.REMOVE:
+            raise ValueError("op must be either %r or %r!" % (self.ADD, self.REMOVE))
+        timestamp = self.validate_timestamp(timestamp)
+        if self.clock is not None:
+            self.clock.update(timestamp)
+        return op, self.validate_element(element), timestamp
+
+    def write_timestamp(self, timestamp):
+        """Validate the timestamp argument of add() or remove()
+
+        Without a timestamp, the operation is stamped by the clock of
+        the set. A given timestamp moves the clock past it, see
+        lww_clock.LWW_clock.update().
+
+        Keyword return
+        timestamp -- validated timestamp
+
+        Keyword raises:
+        ValueError -- bad timestamp, or no timestamp and no clock
+        """
+        if timestamp is None:
+            if self.clock is None:
+                raise ValueError("timestamp is required without a clock!")
+            return self.validate_timestamp(self.clock.now())
+        timestamp = self.validate_timestamp(timestamp)
+        if self.clock is not None:
+            self.clock.update(timestamp)
+        return timestamp
+
     def validate_timestamp(self, timestamp):
         """Validate the timestamp argument
 
@@ -124,12 +651,36 @@ class LWW_set:
         Keyword raises:
         ValueError -- falied to convert the timestamp to a float
         """
+        if type(timestamp) is float:
+            return timestamp
         try:
             timestamp = float(timestamp)
         except:
             raise ValueError("timestamp must be able to be converted to float!")
         return timestamp
 
+    def validate_watermark(self, watermark):
+        """Validate an (epoch, sequence) watermark of this replica
+
+        For sets that number their changes in memory, with an epoch
+        that is new for every replica and run, see watermark().
+
+        Keyword return
+        sequence -- the change sequence number of the watermark, or 0
+        for None or a watermark of another epoch
+
+        Keyword raises:
+        ValueError -- the watermark is not an (epoch, sequence) pair
+        """
+        if watermark is None:
+            return 0
+        try:
+            epoch, sequence = watermark
+            sequence = int(sequence)
+        except:
+            raise ValueError("watermark must be an (epoch, sequence) pair from watermark()!")
+        return sequence if epoch == self.epoch else 0
+
     def validate_element(self, element):
         """Validate the timestamp argument
 
@@ -139,6 +690,9 @@ class LWW_set:
         Keyword raises:
         ValueError -- falied to convert the element to a string within the maximum limit
         """
+        # a short str needs neither conversion nor sys.getsizeof()
+        if type(element) is str and len(element) <= self.MAX_FAST_STRING_LENGTH:
+            return element
         try:
             element = str(element)
         except:
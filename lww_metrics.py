@@ -0,0 +1,442 @@
+"""Opt-in latency metrics for lww-sets
+
+instrument() wraps the operations of one lww-set object in timers. The
+wrappers are instance attributes, so the class and every other object
+run the original methods: an lww-set that is not instrumented pays
+nothing, and uninstrument() removes the wrappers again.
+
+Latencies are recorded in nanoseconds into log-linear histograms, in the
+spirit of HdrHistogram: every power of two is split into SUB_BUCKETS
+buckets, so a percentile is within 1 / SUB_BUCKETS of the true value,
+whatever the range, and recording a value is a shift and a list
+increment. Histograms, counters and gauges are reported by sinks: any
+callable taking the snapshot() dict, prometheus_text() for a Prometheus
+scrape endpoint, and Statsd_sink for statsd over UDP.
+"""
+
+import asyncio
+import socket
+import time
+
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+EXACT = 2 * SUB_BUCKETS  # values below are counted exactly
+QUANTILES = (("p50", 50.0), ("p99", 99.0), ("p999", 99.9))
+
+# instrumented methods; generators (iter_elements(), delta_since()) are
+# not, as calling them only creates the generator
+OPERATIONS = ("add", "remove", "apply_ops", "exist", "exist_many", "timestamps",
+              "get", "count", "compact")
+LOCKS = ("add_lock", "remove_lock", "index_lock", "lock", "cache_lock")
+SIZES = ("add_set", "remove_set", "index")
+REDIS_SCRIPTS = ("test_and_add_script", "apply_ops_script", "get_script", "scan_script",
+                 "compact_script", "query_script", "recount_script", "exist_many_script")
+
+
+class Histogram(object):
+    """A log-linear histogram of non-negative ints, e.g., nanoseconds
+
+    Values below 2 * SUB_BUCKETS have a bucket each. Above, the values
+    with the same bit length share SUB_BUCKETS buckets. record() only
+    updates a bucket and the sum; the total and the max are derived
+    from the buckets. It takes no lock: when threads record at the same
+    instant, a count may be lost, which does not matter for latency
+    percentiles.
+
+    Keyword attributes:
+    counts -- the number of values per bucket
+    sum -- the sum of recorded values
+    """
+    def __init__(self):
+        self.counts = [0] * (EXACT + SUB_BUCKETS * 64)
+        self.sum = 0
+
+    def record(self, value):
+        if value >= EXACT:
+            shift = value.bit_length() - SUB_BUCKET_BITS - 1
+            self.counts[(shift << SUB_BUCKET_BITS) + (value >> shift)] += 1
+        else:
+            self.counts[value] += 1
+        self.sum += value
+
+    def merge(self, other):
+        """Adds the values recorded by another histogram"""
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] += count
+        self.sum += other.sum
+
+    @property
+    def total(self):
+        """The number of recorded values"""
+        return sum(self.counts)
+
+    @property
+    def max(self):
+        """The highest value of the highest non-empty bucket"""
+        for index in range(len(self.counts) - 1, -1, -1):
+            if self.counts[index]:
+                return self.bucket_range(index)[1]
+        return 0
+
+    @staticmethod
+    def bucket_range(index):
+        """Returns the (lowest, highest) value of a bucket"""
+        if index < EXACT:
+            return index, index
+        shift = (index >> SUB_BUCKET_BITS) - 1
+        lowest = (index - (shift << SUB_BUCKET_BITS)) << shift
+        return lowest, lowest + (1 << shift) - 1
+
+    def percentile(self, p):
+        """Returns the highest value of the bucket holding the p-th
+        percentile (0-100), or 0 if the histogram is empty"""
+        total = self.total
+        if total == 0:
+            return 0
+        rank = max(1, int(total * p / 100.0 + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.bucket_range(index)[1]
+        return 0
+
+    def summary(self):
+        """Returns the count, and the sum, quantiles and max in seconds"""
+        result = {"count": self.total, "sum": self.sum / 1e9, "max": self.max / 1e9}
+        for name, p in QUANTILES:
+            result[name] = self.percentile(p) / 1e9
+        return result
+
+
+class LWW_metrics(object):
+    """The metrics of one or more instrumented lww-sets.
+
+    Keyword attributes:
+    latency -- operation name -> Histogram of its latency
+    phases -- phase name -> Histogram of the time spent in it: "validate"
+    for argument validation, "wait.<lock>" for waiting on a lock of
+    LOCKS, e.g., "wait.add_lock", and "backend" for calls to the redis
+    server (lww_redis only)
+    ops -- operation name -> the number of calls
+    errors -- operation name -> the number of calls that raised or
+    returned False
+    gauges -- gauge name -> a function returning its current value,
+    e.g., "add_set_size"
+    sinks -- functions called with snapshot() by report()
+    """
+    def __init__(self, sinks=()):
+        self.latency = {}
+        self.phases = {}
+        self.ops = {}
+        self.errors = {}
+        self.gauges = {}
+        self.sinks = list(sinks)
+
+    def histogram(self, histograms, name):
+        """Returns the histogram of a name, creating it if needed"""
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms.setdefault(name, Histogram())
+        return histogram
+
+    def snapshot(self):
+        """Returns all metrics as a dict of plain values
+
+        Keyword returns:
+        {"ops": {name: count}, "errors": {name: count},
+        "gauges": {name: value}, "latency": {name: summary},
+        "phases": {name: summary}}, see Histogram.summary()
+        """
+        return {"ops": dict(self.ops),
+                "errors": dict(self.errors),
+                "gauges": dict((name, gauge()) for name, gauge in self.gauges.items()),
+                "latency": dict((name, histogram.summary()) for name, histogram in self.latency.items()),
+                "phases": dict((name, histogram.summary()) for name, histogram in self.phases.items())}
+
+    def report(self):
+        """Passes one snapshot() to every sink"""
+        snapshot = self.snapshot()
+        for sink in self.sinks:
+            sink(snapshot)
+        return snapshot
+
+
+class Timed_lock(object):
+    """A lock that records how long acquire() waited"""
+    def __init__(self, lock, histogram):
+        self.lock = lock
+        self.histogram = histogram
+
+    def acquire(self, *args, **kwargs):
+        start = time.perf_counter_ns()
+        result = self.lock.acquire(*args, **kwargs)
+        self.histogram.record(time.perf_counter_ns() - start)
+        return result
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class Timed_client(object):
+    """A redis client whose commands and pipeline executions are timed
+
+    Other attributes are the ones of the client.
+    """
+    def __init__(self, client, histogram):
+        self.client = client
+        self.histogram = histogram
+
+    def __getattr__(self, name):
+        value = getattr(self.client, name)
+        if name == "pipeline":
+            def pipeline(*args, **kwargs):
+                # the pipeline itself stays a real redis pipeline, as
+                # scripts check its type; only execute() is timed
+                result = value(*args, **kwargs)
+                result.execute = timed(result.execute, self.histogram)
+                return result
+            return pipeline
+        if callable(value):
+            return timed(value, self.histogram)
+        return value
+
+
+def timed(func, histogram):
+    """Returns func, recording the time of every call in a histogram"""
+    def call(*args, **kwargs):
+        start = time.perf_counter_ns()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            histogram.record(time.perf_counter_ns() - start)
+    return call
+
+
+def timed_script(script, histogram):
+    """Returns a redis script, timing the calls that are not queued on a
+    pipeline"""
+    def call(*args, **kwargs):
+        if kwargs.get("client") is not None:
+            return script(*args, **kwargs)
+        start = time.perf_counter_ns()
+        try:
+            return script(*args, **kwargs)
+        finally:
+            histogram.record(time.perf_counter_ns() - start)
+    return call
+
+
+def timed_operation(name, method, metrics):
+    """Returns an lww-set method that counts and times its calls"""
+    histogram = metrics.histogram(metrics.latency, name)
+    ops = metrics.ops
+    errors = metrics.errors
+    ops.setdefault(name, 0)
+    errors.setdefault(name, 0)
+
+    if asyncio.iscoroutinefunction(method):
+        async def call(*args, **kwargs):
+            start = time.perf_counter_ns()
+            ops[name] += 1
+            try:
+                result = await method(*args, **kwargs)
+            except:
+                errors[name] += 1
+                raise
+            finally:
+                histogram.record(time.perf_counter_ns() - start)
+            if result is False:
+                errors[name] += 1
+            return result
+        return call
+
+    def call(*args, **kwargs):
+        start = time.perf_counter_ns()
+        ops[name] += 1
+        try:
+            result = method(*args, **kwargs)
+        except:
+            errors[name] += 1
+            raise
+        finally:
+            histogram.record(time.perf_counter_ns() - start)
+        if result is False:
+            errors[name] += 1
+        return result
+    return call
+
+
+def own_attribute(lww, name):
+    """Returns an attribute set on the lww-set object itself, or None if
+    it comes from the class
+
+    The instance __dict__ is not read: in CPython 3.11+, reading it
+    turns the inline attribute values of the object into a real dict,
+    which slows down every later attribute access of the object.
+    """
+    value = getattr(lww, name, None)
+    class_value = getattr(type(lww), name, None)
+    if value is class_value or (class_value is not None and
+                                getattr(value, "__func__", None) is class_value):
+        return None
+    return value
+
+
+def instrument(lww, metrics):
+    """Records the operations of an lww-set in metrics
+
+    Instruments the methods of OPERATIONS, argument validation, the
+    locks of LOCKS and, for lww_redis, the client and the scripts of
+    REDIS_SCRIPTS, and adds a "<name>_size" gauge for every dict of
+    SIZES. Instrument a set before other threads use it, since its
+    locks are replaced by timed wrappers of the same locks.
+
+    Keyword arguments:
+    lww -- any lww-set object
+    metrics -- an LWW_metrics, which may be shared by several sets
+
+    Keyword returns:
+    the lww-set
+
+    Keyword raise:
+    ValueError -- the lww-set is already instrumented
+    """
+    if hasattr(lww, "_instrumented"):
+        raise ValueError("The lww-set is already instrumented!")
+    saved = {}  # attribute -> its previous instance value, or None
+
+    def patch(name, value):
+        saved[name] = own_attribute(lww, name)
+        setattr(lww, name, value)
+
+    for name in OPERATIONS:
+        if hasattr(lww, name):
+            patch(name, timed_operation(name, getattr(lww, name), metrics))
+    validate = metrics.histogram(metrics.phases, "validate")
+    for name in ("validate_element", "validate_timestamp"):
+        patch(name, timed(getattr(lww, name), validate))
+    for name in LOCKS:
+        lock = own_attribute(lww, name)
+        if lock is not None:
+            patch(name, Timed_lock(lock, metrics.histogram(metrics.phases, "wait.%s" % name)))
+    # the commands of the asyncio client return awaitables, which are
+    # not timed
+    if hasattr(lww, REDIS_SCRIPTS[0]) and not asyncio.iscoroutinefunction(lww.add):
+        backend = metrics.histogram(metrics.phases, "backend")
+        patch("redis", Timed_client(lww.redis, backend))
+        for name in REDIS_SCRIPTS:
+            patch(name, timed_script(getattr(lww, name), backend))
+    for name in SIZES:
+        target = getattr(lww, name, None)
+        if isinstance(target, dict):
+            metrics.gauges["%s_size" % name] = target.__len__
+    lww._instrumented = saved
+    return lww
+
+
+def uninstrument(lww):
+    """Restores the methods, locks and client of an instrumented lww-set"""
+    saved = lww._instrumented
+    del lww._instrumented
+    for name, value in saved.items():
+        if value is None:
+            delattr(lww, name)
+        else:
+            setattr(lww, name, value)
+    return lww
+
+
+def prometheus_text(snapshot, prefix="lww"):
+    """Returns a snapshot() in the Prometheus text exposition format
+
+    Counters are lww_ops_total and lww_errors_total by op, latencies
+    are summaries lww_latency_seconds by op and lww_phase_seconds by
+    phase, and gauges are lww_<name>.
+    """
+    lines = []
+    for counter in ("ops", "errors"):
+        lines.append("# TYPE %s_%s_total counter" % (prefix, counter))
+        for op, value in sorted(snapshot[counter].items()):
+            lines.append('%s_%s_total{op="%s"} %d' % (prefix, counter, op, value))
+    for kind, label in (("latency", "op"), ("phases", "phase")):
+        metric = "%s_%s_seconds" % (prefix, "latency" if kind == "latency" else "phase")
+        lines.append("# TYPE %s summary" % metric)
+        for name, summary in sorted(snapshot[kind].items()):
+            for quantile, p in QUANTILES:
+                lines.append('%s{%s="%s",quantile="%s"} %.9f'
+                             % (metric, label, name, p / 100.0, summary[quantile]))
+            lines.append('%s_sum{%s="%s"} %.9f' % (metric, label, name, summary["sum"]))
+            lines.append('%s_count{%s="%s"} %d' % (metric, label, name, summary["count"]))
+    for name, value in sorted(snapshot["gauges"].items()):
+        lines.append("# TYPE %s_%s gauge" % (prefix, name))
+        lines.append("%s_%s %s" % (prefix, name, value))
+    return "\n".join(lines) + "\n"
+
+
+class Statsd_sink(object):
+    """A sink that sends snapshots to a statsd server over UDP
+
+    Counters are sent as the increments since the previous snapshot,
+    latency quantiles and gauges as gauges, e.g., "lww.ops.add:12|c"
+    and "lww.latency.add.p99:0.031|g" (milliseconds). Lines are packed
+    into datagrams of at most max_datagram bytes. Send errors are
+    ignored, as with any statsd client.
+
+    Keyword attributes:
+    address -- the (host, port) of the statsd server
+    prefix -- the prefix of all metric names
+    """
+    def __init__(self, host="127.0.0.1", port=8125, prefix="lww", max_datagram=1432):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.max_datagram = max_datagram
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.previous = {"ops": {}, "errors": {}}
+
+    def lines(self, snapshot):
+        """Returns the statsd lines of a snapshot"""
+        lines = []
+        for counter in ("ops", "errors"):
+            previous = self.previous[counter]
+            for op, value in sorted(snapshot[counter].items()):
+                if value != previous.get(op, 0):
+                    lines.append("%s.%s.%s:%d|c" % (self.prefix, counter, op, value - previous.get(op, 0)))
+            self.previous[counter] = dict(snapshot[counter])
+        for kind in ("latency", "phases"):
+            for name, summary in sorted(snapshot[kind].items()):
+                for quantile, _ in QUANTILES:
+                    lines.append("%s.%s.%s.%s:%.6f|g" % (self.prefix, kind, name, quantile,
+                                                         summary[quantile] * 1000))
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines.append("%s.%s:%s|g" % (self.prefix, name, value))
+        return lines
+
+    def __call__(self, snapshot):
+        datagram = b""
+        for line in self.lines(snapshot):
+            line = line.encode("utf-8")
+            if datagram and len(datagram) + 1 + len(line) > self.max_datagram:
+                self.__send(datagram)
+                datagram = b""
+            datagram = datagram + b"\n" + line if datagram else line
+        if datagram:
+            self.__send(datagram)
+
+    def __send(self, datagram):
+        try:
+            self.socket.sendto(datagram, self.address)
+        except socket.error:
+            pass
+
+    def close(self):
+        self.socket.close()
@@ -0,0 +1,125 @@
+"""unit tests for the lww_metrics"""
+
+import socket
+import threading
+import unittest
+from lww_metrics import (Histogram, LWW_metrics, Statsd_sink, instrument,
+                         uninstrument, prometheus_text)
+from lww_python import LWW_python
+from lww_python_compact import LWW_python_compact
+
+
+class Test_Histogram(unittest.TestCase):
+    def test_buckets(self):
+        # every value falls into the bucket whose range holds it
+        for value in list(range(100)) + [1000, 12345, 10 ** 9, (1 << 63) - 1]:
+            histogram = Histogram()
+            histogram.record(value)
+            index = histogram.counts.index(1)
+            lowest, highest = Histogram.bucket_range(index)
+            self.assertTrue(lowest <= value <= highest, (value, lowest, highest))
+            self.assertTrue(highest - lowest <= lowest // 16, value)
+
+    def test_percentile(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.percentile(50), 0)
+        for value in range(1, 10001):
+            histogram.record(value)
+        self.assertEqual(histogram.total, 10000)
+        self.assertTrue(10000 <= histogram.max <= 10000 * 1.07)
+        for p in (50, 99, 99.9):
+            expected = 10000 * p / 100.0
+            self.assertTrue(expected <= histogram.percentile(p) <= expected * 1.07)
+        self.assertEqual(histogram.percentile(100), histogram.max)
+        self.assertEqual(histogram.summary()["count"], 10000)
+        merged = Histogram()
+        merged.merge(histogram)
+        merged.merge(histogram)
+        self.assertEqual(merged.total, 20000)
+        self.assertEqual(merged.percentile(50), histogram.percentile(50))
+
+
+class Test_LWW_Metrics(unittest.TestCase):
+    def test_instrument(self):
+        metrics = LWW_metrics()
+        lww = instrument(LWW_python(), metrics)
+        lww.add("a", 1)
+        lww.add("b", 1)
+        lww.remove("a", 2)
+        self.assertFalse(lww.exist("a"))
+        lww.add_many([("c", 1), ("d", 1)])  # through apply_ops()
+        self.assertRaises(ValueError, lww.add, "e", "never")
+        self.assertEqual(metrics.ops["add"], 3)
+        self.assertEqual(metrics.errors["add"], 1)
+        self.assertEqual(metrics.ops["apply_ops"], 1)
+        self.assertEqual(metrics.latency["add"].total, 3)
+        self.assertEqual(metrics.phases["validate"].total, 13)
+        self.assertEqual(metrics.phases["wait.add_lock"].total, 4)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["gauges"], {"add_set_size": 4, "remove_set_size": 1})
+        self.assertTrue(snapshot["latency"]["add"]["p50"] > 0)
+        self.assertRaises(ValueError, instrument, lww, metrics)
+
+        # the class and other objects are untouched
+        self.assertEqual(sorted(LWW_python().__dict__), sorted(uninstrument(lww).__dict__))
+        lww.add("f", 1)
+        self.assertEqual(metrics.ops["add"], 3)
+        self.assertEqual(type(lww.add_lock), type(LWW_python().add_lock))
+
+    def test_trusted(self):
+        """The validators of a trusted set are restored"""
+        metrics = LWW_metrics()
+        lww = LWW_python_compact(trusted=True)
+        uninstrument(instrument(lww, metrics))
+        self.assertTrue(lww.validate_element is LWW_python_compact.trusted_argument)
+        self.assertEqual(metrics.gauges["index_size"](), 0)
+
+    def test_lock_wait(self):
+        metrics = LWW_metrics()
+        lww = instrument(LWW_python(), metrics)
+        lww.add_lock.acquire()
+        writer = threading.Thread(target=lww.add, args=("a", 1))
+        writer.start()
+        writer.join(0.05)
+        lww.add_lock.release()
+        writer.join()
+        self.assertTrue(metrics.phases["wait.add_lock"].max >= 0.04 * 1e9)
+
+    def test_prometheus_text(self):
+        metrics = LWW_metrics()
+        lww = instrument(LWW_python(), metrics)
+        lww.add("a", 1)
+        lww.remove("b", 1)
+        text = prometheus_text(metrics.snapshot())
+        self.assertIn('lww_ops_total{op="add"} 1\n', text)
+        self.assertIn('lww_errors_total{op="add"} 0\n', text)
+        self.assertIn('lww_latency_seconds_count{op="remove"} 1\n', text)
+        self.assertIn('lww_phase_seconds{phase="validate",quantile="0.99"} ', text)
+        self.assertIn("lww_add_set_size 1\n", text)
+
+    def test_statsd_sink(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(5)
+        sink = Statsd_sink(port=server.getsockname()[1], max_datagram=200)
+        metrics = LWW_metrics(sinks=[sink])
+        lww = instrument(LWW_python(), metrics)
+        lww.add("a", 1)
+        lww.add("b", 1)
+        metrics.report()
+        lines = []
+        while "lww.remove_set_size:0|g" not in lines:  # the last line
+            datagram = server.recv(65536)
+            self.assertTrue(len(datagram) <= 200)
+            lines.extend(datagram.decode("utf-8").split("\n"))
+        self.assertIn("lww.ops.add:2|c", lines)
+        self.assertIn("lww.add_set_size:2|g", lines)
+        # counters are sent as increments since the last report
+        lww.add("c", 1)
+        self.assertIn("lww.ops.add:1|c", sink.lines(metrics.snapshot()))
+        sink.close()
+        server.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,37 +1,102 @@
+import sys
+from bisect import bisect_left, bisect_right
+from heapq import merge
 from threading import *
-from lww_interface import LWW_set
+from lww_interface import LWW_set, new_epoch
+import lww_snapshot
+from lww_feed import LWW_feed
+
+
+class Last_element(object):
+    """Sorts after every element string, to bisect index pairs"""
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+LAST_ELEMENT = Last_element()
+
 
 class LWW_python(LWW_set):
     """A Last-Writer-Win element set with Python dict. 
 
+    live_count is updated by every write that makes an element exist
+    or stop existing, so count() is O(1). To see both timestamps of the
+    element, add() and remove() hold both locks.
+
+    With int_timestamps=True, timestamps are exact Python ints, see
+    LWW_set.use_int_timestamps(). With trusted=True, arguments are not
+    validated, see LWW_set.trust_arguments(). A clock stamps add() and
+    remove() calls without a timestamp, see lww_clock.
+
+    With ordered=True, a sorted list of the (add timestamp, element)
+    pairs of all existing elements is kept up to date by the writes,
+    so get_range(), latest() and select() bisect it in O(log n + k)
+    instead of sorting the whole set. Each write that changes an
+    element moves its pair in the list, which costs O(n) memory moves
+    in the worst case.
+
+    Every write that changes an entry moves its element to the end of
+    sequences, numbered by last_sequence, so delta_since() walks back
+    over the elements changed after a watermark only.
+
+    subscribe() and changes() start a change feed, see lww_feed. The
+    writes that flip an element publish their event under the write
+    locks, so the events of an element arrive in the order the writes
+    took effect.
+
     See base class LWW_set for detals. 
     """
-    def __init__(self):
+    REINDEX_ONE_BY_ONE = 32  # larger batches rebuild the index in one pass
+
+    def __init__(self, ordered=False, trusted=False, int_timestamps=False, clock=None):
         self.add_set = {}       
         self.remove_set = {}
         self.add_lock = RLock()
         self.remove_lock = RLock()
+        self.live_count = 0   # the number of existing elements
+        self.sequences = {}   # element -> the sequence number of its last change, oldest first
+        self.last_sequence = 0
+        self.epoch = new_epoch()
+        self.index = None
+        if ordered:
+            self.index = []       # sorted (add timestamp, element) of existing elements
+            self.index_keys = {}  # element -> its pair in index
+            self.index_lock = RLock()
+        self.clock = clock
+        self.feed = None  # an lww_feed.LWW_feed once subscribed
+        if int_timestamps:
+            self.use_int_timestamps()
+        if trusted:
+            self.trust_arguments()
 
-    def add(self, element, timestamp):
+    def add(self, element, timestamp=None):
         """Add an element to lww_set, or update the existing element timestamp
         
         See base class LWW_set docstring for detals. 
         """
         element = self.validate_element(element)
-        timestamp = self.validate_timestamp(timestamp)
+        timestamp = self.write_timestamp(timestamp)
         
         return_flag = True
+        # always acquire add_lock before remove_lock to avoid deadlocks
         self.add_lock.acquire()
+        self.remove_lock.acquire()
         # since the operation is on python dictionarily, there should
         # not be any exceptions at anytime, but to be safe, we use
         # try/except here
         try:                    
-            self.__test_and_add(self.add_set, element, timestamp)
+            if self.__test_and_add(self.add_set, element, timestamp) and self.feed is not None:
+                self.feed.publish([(self.ADD, element, timestamp)])
         except:
             return_flag = False
         finally:
+            self.remove_lock.release()
             self.add_lock.release()  # make sure to release the lock in any situation
 
+        if self.index is not None:
+            self.reindex([element])
         return return_flag
 
     def __test_and_add(self, target_set, element, timestamp):
@@ -51,34 +116,59 @@ class LWW_python(LWW_set):
         element -- an object that has a unique identifier
         timestamp -- a non-negaive number (int or long)
 
+        Keyword returns:
+        1 or -1 if the element started or stopped existing, 0 otherwise
         """
-        if element in target_set:
-            current_timestamp = target_set[element]
-            if current_timestamp < timestamp:
-                target_set[element] = timestamp
-        else:
+        was_live = self.__is_live(element)
+        current_timestamp = target_set.get(element)
+        if current_timestamp is None or current_timestamp < timestamp:
             target_set[element] = timestamp
+            self.__sequence(element)
+        change = self.__is_live(element) - was_live
+        self.live_count += change
+        return change
+
+    def __sequence(self, element):
+        """Gives a changed element the next sequence number, must hold
+        both locks"""
+        self.last_sequence += 1
+        sequences = self.sequences
+        sequences.pop(element, None)  # moves it to the end
+        sequences[element] = self.last_sequence
+
+    def __is_live(self, element):
+        """Returns 1 if the element exists and 0 otherwise"""
+        add_timestamp = self.add_set.get(element)
+        if add_timestamp is None:
+            return 0
+        remove_timestamp = self.remove_set.get(element)
+        return int(remove_timestamp is None or add_timestamp >= remove_timestamp)
 
-    def remove(self, element, timestamp):
+    def remove(self, element, timestamp=None):
         """Remove an element from lww_set 
 
         See base class LWW_set docstring for detals. 
         """
 
         element = self.validate_element(element)
-        timestamp = self.validate_timestamp(timestamp)
+        timestamp = self.write_timestamp(timestamp)
 
         return_flag = True
+        self.add_lock.acquire()
         self.remove_lock.acquire()
         # since the operation is on python dictionarily, there should
         # not be any exceptions at anytime, but to be safe, we use
         # try/except here
         try:
-            self.__test_and_add(self.remove_set, element, timestamp)
+            if self.__test_and_add(self.remove_set, element, timestamp) and self.feed is not None:
+                self.feed.publish([(self.REMOVE, element, timestamp)])
         except:
             return_flag = False
         finally:
             self.remove_lock.release()  # make sure to release the lock in any situation
+            self.add_lock.release()
+        if self.index is not None:
+            self.reindex([element])
         return return_flag
 
     def exist(self, element):
@@ -100,13 +190,424 @@ class LWW_python(LWW_set):
         except:
             raise RuntimeError("An internal error occurs when accessing lww-set. A retry may solve the problem. ")
     
-    def get(self):
-        """Returns an array of all existing elements in lww-set 
+    def exist_many(self, elements):
+        """Check which of many elements exist in lww-set
+
+        All elements are validated before the first lookup, then both
+        dicts are read in one pass.
 
         See base class LWW_set docstring for detals.
         """
+        validate_element = self.validate_element
+        elements = [validate_element(element) for element in elements]
+        add_get = self.add_set.get
+        remove_get = self.remove_set.get
         result = []
-        for element in self.add_set:
-            if self.exist(element):
-                result.append(element)
+        append = result.append
+        try:
+            for element in elements:
+                add_timestamp = add_get(element)
+                if add_timestamp is None:
+                    append(False)
+                else:
+                    remove_timestamp = remove_get(element)
+                    append(remove_timestamp is None or add_timestamp >= remove_timestamp)
+        except:
+            raise RuntimeError("An internal error occurs when accessing lww-set. A retry may solve the problem. ")
         return result
+
+    def timestamps(self, element):
+        """Returns the add and remove timestamps of an element
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+        # each dict read is atomic
+        return self.add_set.get(element), self.remove_set.get(element)
+
+    def get(self):
+        """Returns an array of all existing elements in lww-set 
+
+        See base class LWW_set docstring for detals.
+        """
+        return list(self.iter_elements())
+
+    def iter_elements(self, batch_size=1000):
+        """Iterates over all existing elements in lww-set
+
+        The iteration runs over a list of the keys of add_set taken
+        under add_lock, i.e., one shared reference per element instead
+        of a copy of the dict, so concurrent add() calls cannot break
+        it. The timestamps of batch_size elements at a time are then
+        checked under both locks, as in compact(). An element added
+        during the iteration is not returned, and one removed during
+        it may or may not be. The keys of add_set are validated strings
+        already, so they are not validated again.
+
+        See base class LWW_set docstring for detals.
+        """
+        self.add_lock.acquire()
+        try:
+            elements = list(self.add_set)
+        finally:
+            self.add_lock.release()
+
+        add_set = self.add_set
+        remove_set = self.remove_set
+        for start in range(0, len(elements), batch_size):
+            batch = []
+            self.add_lock.acquire()
+            self.remove_lock.acquire()
+            try:
+                for element in elements[start:start + batch_size]:
+                    add_timestamp = add_set.get(element)
+                    if add_timestamp is None:
+                        continue  # compacted
+                    remove_timestamp = remove_set.get(element)
+                    if remove_timestamp is None or add_timestamp >= remove_timestamp:
+                        batch.append(element)
+            finally:
+                self.remove_lock.release()
+                self.add_lock.release()
+            for element in batch:
+                yield element
+
+    def apply_ops(self, ops):
+        """Apply a batch of add and remove operations
+
+        The whole batch is validated before any write, and then applied
+        under a single acquisition of add_lock and remove_lock.
+
+        See base class LWW_set docstring for detals.
+        """
+        ops = [self.validate_op(op, element, timestamp)
+               for op, element, timestamp in ops]
+
+        return_flag = True
+        # always acquire add_lock before remove_lock to avoid deadlocks
+        self.add_lock.acquire()
+        self.remove_lock.acquire()
+        try:
+            add_set = self.add_set
+            remove_set = self.remove_set
+            feed = self.feed
+            events = []
+            for op, element, timestamp in ops:
+                # inlined __test_and_add(), which is too costly to call
+                # once per operation in a large batch
+                target_set = add_set if op == self.ADD else remove_set
+                current_timestamp = target_set.get(element)
+                if current_timestamp is None or current_timestamp < timestamp:
+                    was_live = self.__is_live(element)
+                    target_set[element] = timestamp
+                    self.__sequence(element)
+                    change = self.__is_live(element) - was_live
+                    if change:
+                        self.live_count += change
+                        if feed is not None:
+                            events.append((self.ADD if change > 0 else self.REMOVE,
+                                           element, timestamp))
+            if events:
+                feed.publish(events)
+        except:
+            return_flag = False
+        finally:
+            self.remove_lock.release()
+            self.add_lock.release()
+
+        if self.index is not None:
+            self.reindex(set(element for _, element, _ in ops))
+        return return_flag
+
+    def changes(self):
+        """Returns a change queue of the elements that flip from now on
+
+        See base class LWW_set docstring for detals.
+        """
+        return self.__feed().changes()
+
+    def subscribe(self, callback):
+        """Calls callback with batches of the elements that flip from now on
+
+        See base class LWW_set docstring for detals.
+        """
+        return self.__feed().subscribe(callback)
+
+    def __feed(self):
+        """Returns the feed, created under the write locks so that every
+        write either publishes to it or happened before it"""
+        self.add_lock.acquire()
+        self.remove_lock.acquire()
+        try:
+            if self.feed is None:
+                self.feed = LWW_feed()
+            return self.feed
+        finally:
+            self.remove_lock.release()
+            self.add_lock.release()
+
+    def count(self):
+        """Returns the number of existing elements in lww-set
+
+        See base class LWW_set docstring for detals.
+        """
+        return self.live_count
+
+    def recount(self):
+        """Recomputes live_count, e.g., after add_set and remove_set were
+        filled directly"""
+        self.add_lock.acquire()
+        self.remove_lock.acquire()
+        try:
+            self.live_count = sum(self.__is_live(element) for element in self.add_set)
+        finally:
+            self.remove_lock.release()
+            self.add_lock.release()
+
+    def reindex(self, elements):
+        """Moves the index pairs of some elements to their current state
+
+        The pair of an element is recomputed from add_set and
+        remove_set under index_lock. Writers update the dicts before
+        calling this, so when an add() and a remove() of one element
+        race, the later reindex sees both writes. A few pairs are moved
+        one by one, and many pairs (e.g., of a large apply_ops() or of
+        load()) by filtering and merging the whole list once.
+        """
+        add_set = self.add_set
+        remove_set = self.remove_set
+        index_keys = self.index_keys
+        self.index_lock.acquire()
+        try:
+            index = self.index
+            one_by_one = len(elements) <= self.REINDEX_ONE_BY_ONE
+            old_keys = set()
+            new_keys = []
+            for element in elements:
+                add_timestamp = add_set.get(element)
+                remove_timestamp = remove_set.get(element)
+                key = None
+                if add_timestamp is not None and (remove_timestamp is None or
+                                                  add_timestamp >= remove_timestamp):
+                    key = (add_timestamp, element)
+                current_key = index_keys.get(element)
+                if current_key == key:
+                    continue
+                if current_key is not None:
+                    del index_keys[element]
+                    if one_by_one:
+                        del index[bisect_left(index, current_key)]
+                    else:
+                        old_keys.add(current_key)
+                if key is not None:
+                    index_keys[element] = key
+                    if one_by_one:
+                        index.insert(bisect_left(index, key), key)
+                    else:
+                        new_keys.append(key)
+            if old_keys:
+                index = [key for key in index if key not in old_keys]
+            if new_keys:
+                new_keys.sort()
+                index = list(merge(index, new_keys))
+            self.index = index
+        finally:
+            self.index_lock.release()
+
+    def get_range(self, start_timestamp, end_timestamp):
+        """Returns the existing elements added between two timestamps
+
+        See base class LWW_set docstring for detals.
+        """
+        if self.index is None:
+            return LWW_set.get_range(self, start_timestamp, end_timestamp)
+        start_timestamp = self.validate_timestamp(start_timestamp)
+        end_timestamp = self.validate_timestamp(end_timestamp)
+        self.index_lock.acquire()
+        try:
+            # a 1-tuple sorts before, and LAST_ELEMENT after, every pair
+            # with the same timestamp
+            start = bisect_left(self.index, (start_timestamp,))
+            end = bisect_right(self.index, (end_timestamp, LAST_ELEMENT))
+            return [element for _, element in self.index[start:end]]
+        finally:
+            self.index_lock.release()
+
+    def latest(self, n):
+        """Returns the n most recently added existing elements
+
+        See base class LWW_set docstring for detals.
+        """
+        if self.index is None:
+            return LWW_set.latest(self, n)
+        n = self.validate_count(n)
+        if n == 0:
+            return []
+        self.index_lock.acquire()
+        try:
+            return [element for _, element in reversed(self.index[-n:])]
+        finally:
+            self.index_lock.release()
+
+    def select(self, offset, limit):
+        """Returns one page of the existing elements
+
+        See base class LWW_set docstring for detals.
+        """
+        if self.index is None:
+            return LWW_set.select(self, offset, limit)
+        offset = self.validate_count(offset)
+        limit = self.validate_count(limit)
+        self.index_lock.acquire()
+        try:
+            return [element for _, element in self.index[offset:offset + limit]]
+        finally:
+            self.index_lock.release()
+
+    def watermark(self):
+        """Returns the (epoch, last_sequence) watermark of this replica
+
+        See base class LWW_set docstring for detals.
+        """
+        return self.epoch, self.last_sequence
+
+    def delta_since(self, watermark=None):
+        """Iterates over the entries changed after a watermark
+
+        The entries of the elements changed after the watermark are
+        collected under both locks, walking sequences back from the
+        newest change, so the cost is O(k) of the k changed elements.
+
+        See base class LWW_set docstring for detals.
+        """
+        since = self.validate_watermark(watermark)
+        delta = []
+        self.add_lock.acquire()
+        self.remove_lock.acquire()
+        try:
+            add_set = self.add_set
+            remove_set = self.remove_set
+            for element, sequence in reversed(self.sequences.items()):
+                if sequence <= since:
+                    break
+                add_timestamp = add_set.get(element)
+                if add_timestamp is not None:
+                    delta.append((self.ADD, element, add_timestamp))
+                remove_timestamp = remove_set.get(element)
+                if remove_timestamp is not None:
+                    delta.append((self.REMOVE, element, remove_timestamp))
+        finally:
+            self.remove_lock.release()
+            self.add_lock.release()
+        return iter(delta)
+
+    def dump(self, path):
+        """Writes the lww-set to a binary snapshot file
+
+        See lww_snapshot for the file format. Timestamps are stored as
+        float64, so int timestamps beyond 2 ** 53 lose precision.
+        """
+        # shallow copies, so that writers can go on while writing the file
+        self.add_lock.acquire()
+        try:
+            add_set = self.add_set.copy()
+        finally:
+            self.add_lock.release()
+        self.remove_lock.acquire()
+        try:
+            remove_set = self.remove_set.copy()
+        finally:
+            self.remove_lock.release()
+        lww_snapshot.write_snapshot(path, add_set, remove_set)
+
+    @classmethod
+    def load(cls, path, ordered=False, trusted=False, int_timestamps=False, clock=None):
+        """Creates an lww-set from a snapshot file written by dump()
+
+        A snapshot holds validated elements and timestamps only, so they
+        are inserted directly instead of being replayed through add()
+        and remove(). To look elements up without loading them all, use
+        lww_snapshot.LWW_snapshot instead.
+
+        A snapshot does not record the modes of the set it was dumped
+        from, so pass them again: the keyword arguments are the ones of
+        LWW_python(). With int_timestamps=True, the float64 timestamps
+        of the file are loaded as ints, and a clock is moved past the
+        loaded timestamps.
+        """
+        lww = cls(ordered, trusted, int_timestamps, clock)
+        add_set = lww.add_set
+        remove_set = lww.remove_set
+        sequences = lww.sequences
+        score_type = int if int_timestamps else float
+        last_timestamp = None
+        with lww_snapshot.LWW_snapshot(path) as snapshot:
+            for element, add_timestamp, remove_timestamp in snapshot.rows():
+                sequences[element] = len(sequences) + 1
+                # a missing timestamp is NaN, and NaN never equals itself
+                if add_timestamp == add_timestamp:
+                    add_set[element] = add_timestamp = score_type(add_timestamp)
+                    if last_timestamp is None or add_timestamp > last_timestamp:
+                        last_timestamp = add_timestamp
+                if remove_timestamp == remove_timestamp:
+                    remove_set[element] = remove_timestamp = score_type(remove_timestamp)
+                    if last_timestamp is None or remove_timestamp > last_timestamp:
+                        last_timestamp = remove_timestamp
+        if clock is not None and last_timestamp is not None:
+            clock.update(last_timestamp)
+        lww.last_sequence = len(sequences)
+        lww.recount()
+        if ordered:
+            lww.reindex(list(add_set))
+        return lww
+
+    def compact(self, horizon_timestamp, slice_size=1000):
+        """Garbage collect redundant entries of add_set and remove_set
+
+        Both locks are held for one slice at a time. The reported bytes
+        are the sizes of the dropped strings and timestamps; the memory
+        of the dict tables themselves is returned to Python only when
+        the dicts shrink.
+
+        See base class LWW_set docstring for detals.
+        """
+        horizon_timestamp = self.validate_timestamp(horizon_timestamp)
+        stats = {"add_entries": 0, "remove_entries": 0, "bytes": 0}
+
+        # every redundant entry belongs to an element of remove_set
+        self.remove_lock.acquire()
+        try:
+            elements = list(self.remove_set)
+        finally:
+            self.remove_lock.release()
+
+        add_set = self.add_set
+        remove_set = self.remove_set
+        for start in range(0, len(elements), slice_size):
+            self.add_lock.acquire()
+            self.remove_lock.acquire()
+            try:
+                for element in elements[start:start + slice_size]:
+                    remove_timestamp = remove_set.get(element)
+                    if remove_timestamp is None:
+                        continue
+                    add_timestamp = add_set.get(element)
+                    if add_timestamp is not None and add_timestamp >= remove_timestamp:
+                        del remove_set[element]
+                        stats["remove_entries"] += 1
+                        stats["bytes"] += sys.getsizeof(remove_timestamp)
+                        continue
+                    if add_timestamp is not None:
+                        del add_set[element]
+                        stats["add_entries"] += 1
+                        stats["bytes"] += sys.getsizeof(add_timestamp)
+                    if remove_timestamp < horizon_timestamp:
+                        del remove_set[element]
+                        del self.sequences[element]  # no entry left to ship
+                        stats["remove_entries"] += 1
+                        stats["bytes"] += sys.getsizeof(element) + sys.getsizeof(remove_timestamp)
+            finally:
+                self.remove_lock.release()
+                self.add_lock.release()
+
+        return stats
@@ -0,0 +1,369 @@
+import sys
+from array import array
+from threading import *
+from lww_interface import LWW_set, new_epoch
+
+MISSING = float("nan")  # marks a missing add or remove timestamp
+MISSING_INT = -(1 << 63)  # the same in int timestamp columns
+
+class LWW_python_compact(LWW_set):
+    """A Last-Writer-Win element set with a single Python dict.
+
+    LWW_python keeps every element up to twice, as a key of add_set and
+    of remove_set, each with a boxed float timestamp. This set stores
+    each element once: index maps an element to a row of two parallel
+    array('d') columns, add_column and remove_column, which hold the
+    raw add and remove timestamps (NaN if missing). Rows freed by
+    compact() are reused. A third column, sequence_column, holds the
+    change sequence number of each row, see delta_since().
+
+    With int_timestamps=True, the columns are array('q') of exact int64
+    timestamps, with the smallest int64 as missing, see
+    LWW_set.use_int_timestamps(). A timestamp is present if it is at
+    least lowest, which is false for NaN and for the int64 marker, so
+    both kinds of columns share the same code.
+
+    All writes are protected by a single lock. Reads take no lock.
+    live_count follows the writes that make an element exist or stop
+    existing, so count() is O(1). With trusted=True, arguments are not
+    validated, see LWW_set.trust_arguments(). A clock stamps add() and
+    remove() calls without a timestamp, see lww_clock.
+
+    See base class LWW_set for detals.
+    """
+    def __init__(self, trusted=False, int_timestamps=False, clock=None):
+        self.index = {}
+        self.add_column = array('d')
+        self.remove_column = array('d')
+        self.sequence_column = array('Q')  # the last change of each row, see LWW_set.watermark()
+        self.last_sequence = 0
+        self.epoch = new_epoch()
+        self.missing = MISSING
+        self.lowest = float("-inf")
+        self.free_rows = []
+        self.lock = RLock()
+        self.live_count = 0  # the number of existing elements
+        self.clock = clock
+        if int_timestamps:
+            self.use_int_timestamps()
+        if trusted:
+            self.trust_arguments()
+
+    def use_int_timestamps(self):
+        """Switches the columns to array('q') of int timestamps
+
+        See base class LWW_set docstring for detals.
+        """
+        if self.index:
+            raise ValueError("use_int_timestamps() must be called before the first write!")
+        self.add_column = array('q')
+        self.remove_column = array('q')
+        self.missing = MISSING_INT
+        self.lowest = MISSING_INT + 1
+        LWW_set.use_int_timestamps(self)
+
+    def add(self, element, timestamp=None):
+        """Add an element to lww_set, or update the existing element timestamp
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+        timestamp = self.write_timestamp(timestamp)
+
+        return_flag = True
+        self.lock.acquire()
+        try:
+            self.__test_and_set(self.add_column, element, timestamp)
+        except:
+            return_flag = False
+        finally:
+            self.lock.release()
+
+        return return_flag
+
+    def remove(self, element, timestamp=None):
+        """Remove an element from lww_set
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+        timestamp = self.write_timestamp(timestamp)
+
+        return_flag = True
+        self.lock.acquire()
+        try:
+            self.__test_and_set(self.remove_column, element, timestamp)
+        except:
+            return_flag = False
+        finally:
+            self.lock.release()
+
+        return return_flag
+
+    def __row(self, element):
+        """Returns the row of the element, allocating one if needed
+
+        Must be called with the lock held.
+        """
+        row = self.index.get(element)
+        if row is None:
+            if self.free_rows:
+                row = self.free_rows.pop()  # compact() left it missing
+            else:
+                row = len(self.add_column)
+                self.add_column.append(self.missing)
+                self.remove_column.append(self.missing)
+                self.sequence_column.append(0)
+            self.index[element] = row
+        return row
+
+    def __test_and_set(self, column, element, timestamp):
+        """A non-atomic test and set function helper
+
+        Updates the timestamp of the element in the column if the
+        passed timestamp is newer(or larger). Must be called with the
+        lock held.
+
+        Keyword arguments:
+        column -- either add_column or remove_column
+        element -- a validated element string
+        timestamp -- a validated timestamp
+        """
+        row = self.__row(element)
+        # a missing timestamp is NaN, which compares False, or smaller
+        # than any int timestamp, so it is replaced
+        if not column[row] >= timestamp:
+            was_live = self.__is_live(row)
+            column[row] = timestamp
+            self.last_sequence += 1
+            self.sequence_column[row] = self.last_sequence
+            self.live_count += self.__is_live(row) - was_live
+
+    def __is_live(self, row):
+        """Returns 1 if the element of the row exists and 0 otherwise"""
+        add_timestamp = self.add_column[row]
+        return int(add_timestamp >= self.lowest and not self.remove_column[row] > add_timestamp)
+
+    def exist(self, element):
+        """Check if the element exists in lww-set
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+
+        try:
+            while True:
+                row = self.index.get(element)
+                if row is None:
+                    return False
+                add_timestamp = self.add_column[row]
+                remove_timestamp = self.remove_column[row]
+                # make sure compact() did not free the row in between
+                if self.index.get(element) == row:
+                    break
+        except:
+            raise RuntimeError("An internal error occurs when accessing lww-set. A retry may solve the problem. ")
+
+        return add_timestamp >= self.lowest and not remove_timestamp > add_timestamp
+
+    def exist_many(self, elements):
+        """Check which of many elements exist in lww-set
+
+        All elements are validated before the first lookup.
+
+        See base class LWW_set docstring for detals.
+        """
+        validate_element = self.validate_element
+        elements = [validate_element(element) for element in elements]
+        index_get = self.index.get
+        add_column = self.add_column
+        remove_column = self.remove_column
+        lowest = self.lowest
+        result = []
+        try:
+            for element in elements:
+                while True:
+                    row = index_get(element)
+                    if row is None:
+                        result.append(False)
+                        break
+                    add_timestamp = add_column[row]
+                    remove_timestamp = remove_column[row]
+                    # make sure compact() did not free the row in between
+                    if index_get(element) == row:
+                        result.append(add_timestamp >= lowest
+                                      and not remove_timestamp > add_timestamp)
+                        break
+        except:
+            raise RuntimeError("An internal error occurs when accessing lww-set. A retry may solve the problem. ")
+        return result
+
+    def timestamps(self, element):
+        """Returns the add and remove timestamps of an element
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+
+        while True:
+            row = self.index.get(element)
+            if row is None:
+                return None, None
+            add_timestamp = self.add_column[row]
+            remove_timestamp = self.remove_column[row]
+            # make sure compact() did not free the row in between
+            if self.index.get(element) == row:
+                break
+
+        return (add_timestamp if add_timestamp >= self.lowest else None,
+                remove_timestamp if remove_timestamp >= self.lowest else None)
+
+    def count(self):
+        """Returns the number of existing elements in lww-set
+
+        See base class LWW_set docstring for detals.
+        """
+        return self.live_count
+
+    def get(self):
+        """Returns an array of all existing elements in lww-set
+
+        See base class LWW_set docstring for detals.
+        """
+        return list(self.iter_elements())
+
+    def iter_elements(self, batch_size=1000):
+        """Iterates over all existing elements in lww-set
+
+        The iteration runs over copies of index and of both columns
+        taken under the lock. The column copies take 16 bytes per row.
+        batch_size is not used.
+
+        See base class LWW_set docstring for detals.
+        """
+        self.lock.acquire()
+        try:
+            index = self.index.copy()
+            add_column = self.add_column[:]
+            remove_column = self.remove_column[:]
+        finally:
+            self.lock.release()
+
+        lowest = self.lowest
+        for element, row in index.items():
+            add_timestamp = add_column[row]
+            if add_timestamp >= lowest and not remove_column[row] > add_timestamp:
+                yield element
+
+    def apply_ops(self, ops):
+        """Apply a batch of add and remove operations
+
+        The whole batch is validated before any write, and then applied
+        under a single acquisition of the lock.
+
+        See base class LWW_set docstring for detals.
+        """
+        ops = [self.validate_op(op, element, timestamp)
+               for op, element, timestamp in ops]
+
+        return_flag = True
+        self.lock.acquire()
+        try:
+            for op, element, timestamp in ops:
+                column = self.add_column if op == self.ADD else self.remove_column
+                self.__test_and_set(column, element, timestamp)
+        except:
+            return_flag = False
+        finally:
+            self.lock.release()
+
+        return return_flag
+
+    def watermark(self):
+        """Returns the (epoch, last_sequence) watermark of this replica
+
+        See base class LWW_set docstring for detals.
+        """
+        return self.epoch, self.last_sequence
+
+    def delta_since(self, watermark=None):
+        """Iterates over the entries changed after a watermark
+
+        The rows changed after the watermark are found by a scan of
+        sequence_column under the lock, which is O(n) but copies only
+        the changed entries.
+
+        See base class LWW_set docstring for detals.
+        """
+        since = self.validate_watermark(watermark)
+        delta = []
+        lowest = self.lowest
+        self.lock.acquire()
+        try:
+            add_column = self.add_column
+            remove_column = self.remove_column
+            sequence_column = self.sequence_column
+            for element, row in self.index.items():
+                if sequence_column[row] > since:
+                    # missing timestamps are below lowest
+                    if add_column[row] >= lowest:
+                        delta.append((self.ADD, element, add_column[row]))
+                    if remove_column[row] >= lowest:
+                        delta.append((self.REMOVE, element, remove_column[row]))
+        finally:
+            self.lock.release()
+        return iter(delta)
+
+    def compact(self, horizon_timestamp, slice_size=1000):
+        """Garbage collect redundant add and remove timestamps
+
+        A dropped timestamp becomes missing in its column. When both are
+        dropped, the element leaves index and its row is reused by a
+        later add() or remove(). The reported bytes count 8 bytes per
+        timestamp plus the size of the element string of a freed row.
+
+        See base class LWW_set docstring for detals.
+        """
+        horizon_timestamp = self.validate_timestamp(horizon_timestamp)
+        stats = {"add_entries": 0, "remove_entries": 0, "bytes": 0}
+
+        self.lock.acquire()
+        try:
+            elements = list(self.index)
+        finally:
+            self.lock.release()
+
+        add_column = self.add_column
+        remove_column = self.remove_column
+        missing = self.missing
+        lowest = self.lowest
+        for start in range(0, len(elements), slice_size):
+            self.lock.acquire()
+            try:
+                for element in elements[start:start + slice_size]:
+                    row = self.index.get(element)
+                    if row is None:
+                        continue
+                    add_timestamp = add_column[row]
+                    remove_timestamp = remove_column[row]
+                    if not remove_timestamp >= lowest:
+                        continue  # no remove timestamp, nothing to drop
+                    if add_timestamp >= remove_timestamp:
+                        remove_column[row] = missing
+                        stats["remove_entries"] += 1
+                        stats["bytes"] += 8
+                        continue
+                    if add_timestamp >= lowest:
+                        add_column[row] = missing
+                        stats["add_entries"] += 1
+                        stats["bytes"] += 8
+                    if remove_timestamp < horizon_timestamp:
+                        remove_column[row] = missing
+                        del self.index[element]
+                        self.free_rows.append(row)
+                        stats["remove_entries"] += 1
+                        stats["bytes"] += 8 + sys.getsizeof(element)
+            finally:
+                self.lock.release()
+
+        return stats
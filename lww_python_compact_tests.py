@@ -0,0 +1,50 @@
+"""unit tests for the lww_python_compact"""
+
+import sys
+import unittest
+import lww_python_tests
+from lww_python_compact import LWW_python_compact
+
+class Test_LWW_Python_Compact(lww_python_tests.Test_LWW_Set):
+    """Runs all lww_python tests on the single-dict engine"""
+    lww_type = LWW_python_compact
+
+    def compacted_bytes(self, n_timestamps, elements):
+        # a timestamp is an 8-byte column entry
+        return 8 * n_timestamps + sum(sys.getsizeof(element) for element in elements)
+
+    def check_compacted(self, lww):
+        self.assertEqual(sorted(lww.index), ["live", "recent"])
+        self.assertEqual(lww.free_rows, [1])  # the row of "dead"
+
+    def check_all_compacted(self, lww):
+        self.assertEqual(lww.index, {})
+        self.assertEqual(len(lww.free_rows), 100)
+
+    def test_compact_reuses_rows(self):
+        lww = self.lww_type()
+        lww.add("live", 1)
+        lww.add("dead", 1)
+        lww.remove("dead", 2)
+        lww.compact(5)
+        self.assertEqual(lww.free_rows, [1])
+        lww.add("new", 3)
+        self.assertEqual(lww.free_rows, [])
+        self.assertEqual(len(lww.add_column), 2)
+        self.assertEqual(lww.index, {"live": 0, "new": 1})
+        self.assertEqual(sorted(lww.get()), ["live", "new"])
+
+    def test_nan_timestamp_columns(self):
+        """Only one row of two raw timestamps is kept per element"""
+        lww = self.lww_type()
+        lww.remove("a", 1)
+        lww.add("a", 2)
+        lww.add("b", 1)
+        self.assertEqual(lww.index, {"a": 0, "b": 1})
+        self.assertEqual(list(lww.add_column), [2.0, 1.0])
+        self.assertEqual(lww.remove_column[0], 1.0)
+        self.assertNotEqual(lww.remove_column[1], lww.remove_column[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+from lww_interface import LWW_set
+from lww_python import LWW_python
+
+class LWW_python_sharded(LWW_set):
+    """A Last-Writer-Win element set striped over several Python sets.
+
+    Each element is hashed to one of n_stripes stripes. A stripe is an
+    independent lww-set (LWW_python by default) with its own dicts and
+    locks, so writers of elements in different stripes never contend
+    on the same lock. This matters on free-threaded (no-GIL) Python
+    builds, where the locks of a single LWW_python serialize all
+    writers. Reads are forwarded to the stripe of the element, and
+    get() merges the stripes. Arguments are validated once by the
+    sharded set, so the stripes trust them.
+
+    Keyword attributes:
+    n_stripes -- the number of stripes
+    stripe_type -- the lww-set class of the stripes, e.g., LWW_python
+    or LWW_python_compact
+    trusted -- skip argument validation, see LWW_set.trust_arguments()
+    int_timestamps -- use int timestamps, see LWW_set.use_int_timestamps()
+    clock -- stamps writes without a timestamp, see lww_clock
+    """
+    def __init__(self, n_stripes=16, stripe_type=LWW_python, trusted=False,
+                 int_timestamps=False, clock=None):
+        self.clock = clock
+        self.stripes = [stripe_type() for _ in range(n_stripes)]
+        for stripe in self.stripes:
+            stripe.trust_arguments()
+        if int_timestamps:
+            self.use_int_timestamps()
+        if trusted:
+            self.trust_arguments()
+
+    def use_int_timestamps(self):
+        """Switches the set and its stripes to int timestamps
+
+        See base class LWW_set docstring for detals.
+        """
+        for stripe in self.stripes:
+            stripe.use_int_timestamps()
+            stripe.trust_arguments()
+        LWW_set.use_int_timestamps(self)
+
+    def stripe(self, element):
+        """Returns the stripe of a validated element"""
+        return self.stripes[hash(element) % len(self.stripes)]
+
+    def add(self, element, timestamp=None):
+        """Add an element to lww_set, or update the existing element timestamp
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+        timestamp = self.write_timestamp(timestamp)
+        return self.stripe(element).add(element, timestamp)
+
+    def remove(self, element, timestamp=None):
+        """Remove an element from lww_set
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+        timestamp = self.write_timestamp(timestamp)
+        return self.stripe(element).remove(element, timestamp)
+
+    def exist(self, element):
+        """Check if the element exists in lww-set
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+        return self.stripe(element).exist(element)
+
+    def exist_many(self, elements):
+        """Check which of many elements exist in lww-set
+
+        Elements are validated once and grouped by stripe, and each
+        stripe checks its group in one exist_many() call.
+
+        See base class LWW_set docstring for detals.
+        """
+        validate_element = self.validate_element
+        elements = [validate_element(element) for element in elements]
+        n_stripes = len(self.stripes)
+        stripe_positions = [[] for _ in self.stripes]  # positions in elements
+        for position, element in enumerate(elements):
+            stripe_positions[hash(element) % n_stripes].append(position)
+        result = [False] * len(elements)
+        for stripe, positions in zip(self.stripes, stripe_positions):
+            if positions:
+                flags = stripe.exist_many([elements[position] for position in positions])
+                for position, flag in zip(positions, flags):
+                    result[position] = flag
+        return result
+
+    def timestamps(self, element):
+        """Returns the add and remove timestamps of an element
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+        return self.stripe(element).timestamps(element)
+
+    def count(self):
+        """Returns the number of existing elements in lww-set
+
+        See base class LWW_set docstring for detals.
+        """
+        return sum(stripe.count() for stripe in self.stripes)
+
+    def get(self):
+        """Returns an array of all existing elements in lww-set
+
+        See base class LWW_set docstring for detals.
+        """
+        return list(self.iter_elements())
+
+    def iter_elements(self, batch_size=1000):
+        """Iterates over all existing elements in lww-set, stripe by stripe
+
+        See base class LWW_set docstring for detals.
+        """
+        for stripe in self.stripes:
+            for element in stripe.iter_elements(batch_size):
+                yield element
+
+    def apply_ops(self, ops):
+        """Apply a batch of add and remove operations
+
+        The whole batch is validated and split by stripe, and then each
+        stripe applies its part under its own locks.
+
+        See base class LWW_set docstring for detals.
+        """
+        batches = [[] for _ in self.stripes]
+        n_stripes = len(self.stripes)
+        for op, element, timestamp in ops:
+            op, element, timestamp = self.validate_op(op, element, timestamp)
+            batches[hash(element) % n_stripes].append((op, element, timestamp))
+
+        return_flag = True
+        for stripe, batch in zip(self.stripes, batches):
+            if batch and not stripe.apply_ops(batch):
+                return_flag = False
+        return return_flag
+
+    def watermark(self):
+        """Returns the tuple of the watermarks of the stripes
+
+        See base class LWW_set docstring for detals.
+        """
+        return tuple(stripe.watermark() for stripe in self.stripes)
+
+    def delta_since(self, watermark=None):
+        """Iterates over the entries changed after a watermark, stripe by stripe
+
+        The watermark is validated by the call, and the delta of each
+        stripe is collected when the iteration reaches it.
+
+        See base class LWW_set docstring for detals.
+        """
+        if watermark is None:
+            watermark = (None,) * len(self.stripes)
+        elif not isinstance(watermark, tuple) or len(watermark) != len(self.stripes):
+            raise ValueError("watermark must be a watermark() of this set!")
+        for stripe, stripe_watermark in zip(self.stripes, watermark):
+            stripe.validate_watermark(stripe_watermark)
+        return self.__delta_since(watermark)
+
+    def __delta_since(self, watermark):
+        for stripe, stripe_watermark in zip(self.stripes, watermark):
+            for op in stripe.delta_since(stripe_watermark):
+                yield op
+
+    def compact(self, horizon_timestamp, slice_size=1000):
+        """Garbage collect redundant entries, stripe by stripe
+
+        See base class LWW_set docstring for detals.
+        """
+        horizon_timestamp = self.validate_timestamp(horizon_timestamp)
+        stats = {"add_entries": 0, "remove_entries": 0, "bytes": 0}
+        for stripe in self.stripes:
+            stripe_stats = stripe.compact(horizon_timestamp, slice_size)
+            for key in stats:
+                stats[key] += stripe_stats[key]
+        return stats
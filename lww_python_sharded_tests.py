@@ -0,0 +1,76 @@
+"""unit tests for the lww_python_sharded"""
+
+import unittest
+import threading
+import lww_python_tests
+from lww_python_compact import LWW_python_compact
+from lww_python_sharded import LWW_python_sharded
+
+class Test_LWW_Python_Sharded(lww_python_tests.Test_LWW_Set):
+    """Runs all lww_python tests on the striped set"""
+    lww_type = LWW_python_sharded
+
+    def entries(self, lww):
+        """Returns the sizes of all add_sets and remove_sets"""
+        return (sum(len(stripe.add_set) for stripe in lww.stripes),
+                sum(len(stripe.remove_set) for stripe in lww.stripes))
+
+    def check_compacted(self, lww):
+        self.assertEqual(self.entries(lww), (1, 1))
+
+    def check_all_compacted(self, lww):
+        self.assertEqual(self.entries(lww), (0, 0))
+
+    def test_iter_elements_concurrent_add(self):
+        """Each stripe is snapshotted when the iteration reaches it"""
+        lww = self.lww_type()
+        lww.add_many((i, 1) for i in range(10))
+        result = []
+        for i, element in enumerate(lww.iter_elements()):
+            lww.add(100 + i, 1)
+            result.append(element)
+        self.assertTrue(set(str(i) for i in range(10)) <= set(result))
+        self.assertEqual(len(set(result)), len(result))
+
+    def test_stripes(self):
+        lww = self.lww_type(n_stripes=4)
+        lww.add_many((i, 1) for i in range(100))
+        self.assertEqual(sum(len(stripe.add_set) for stripe in lww.stripes), 100)
+        self.assertTrue(all(stripe.add_set for stripe in lww.stripes))
+        # the same element always lands on the same stripe
+        lww.add(1, 2)
+        lww.add("1", 3)
+        self.assertEqual(lww.stripe("1").add_set["1"], 3)
+
+    def test_multi_threaded_stripes(self):
+        """Many writer threads on distinct elements"""
+        lww = self.lww_type(n_stripes=8)
+
+        def write(offset):
+            for i in range(offset, 1000, 8):
+                lww.add(i, 1)
+                lww.remove(i, 2 if i % 2 else 0)
+
+        threads = [threading.Thread(target=write, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(lww.get()), sorted(str(i) for i in range(0, 1000, 2)))
+
+    def test_compact_stripes(self):
+        lww = self.lww_type(n_stripes=4, stripe_type=LWW_python_compact)
+        lww.add_many((i, 1) for i in range(10))
+        watermark = lww.watermark()
+        lww.remove(3, 2)
+        self.assertFalse(lww.exist(3))
+        self.assertEqual(len(lww.get()), 9)
+        self.assertEqual(lww.exist_many(range(12)), [i < 10 and i != 3 for i in range(12)])
+        self.assertEqual(sorted(lww.delta_since(watermark)),
+                         [(LWW_python_compact.ADD, "3", 1), (LWW_python_compact.REMOVE, "3", 2)])
+        # a bad stripe watermark raises at the call, not on iteration
+        self.assertRaises(ValueError, lww.delta_since, watermark[:3] + (7,))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,22 @@
 """unit tests for the lww_set"""
 
+import sys
 import unittest
 from lww_python import LWW_python as LWW_set
 import threading
+import time
+from lww_compactor import LWW_compactor
+from lww_interface import pack_timestamp, unpack_timestamp
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class Test_LWW_Set(unittest.TestCase):
+    lww_type = LWW_set  # subclasses run the same tests on other engines
 
     def test_string_add_remove(self):
-        lww = LWW_set()
+        lww = self.lww_type()
         a = "s1"
         b = "s22"
         lww.add(a,1)
@@ -23,7 +32,7 @@ class Test_LWW_Set(unittest.TestCase):
     def test_multi_threaded(self):
         """Uses mutiple add/remove threads to test an lww-set object."""
 
-        lww = LWW_set()
+        lww = self.lww_type()
         base = [1,2,3,4]       
         element = 2
         nTests = 100
@@ -61,9 +70,294 @@ class Test_LWW_Set(unittest.TestCase):
             # overwrites a new one, then the below assertion may fail. 
             self.assertFalse(lww.exist(element))
 
+    def test_add_remove_many(self):
+        lww = self.lww_type()
+        self.assertTrue(lww.add_many([(1, 1), (2, 1), (3, 1), (1, 3)]))
+        self.assertTrue(lww.remove_many([(1, 2), (2, 2)]))
+        self.assertTrue(lww.exist(1))
+        self.assertFalse(lww.exist(2))
+        self.assertTrue(lww.exist(3))
+        self.assertEqual(sorted(lww.get()), ['1', '3'])
+
+    def test_apply_ops(self):
+        lww = self.lww_type()
+        ops = [(LWW_set.REMOVE, "a", 2), (LWW_set.ADD, "a", 1),
+               (LWW_set.ADD, "b", 1), (LWW_set.REMOVE, "b", 1)]
+        self.assertTrue(lww.apply_ops(ops))
+        self.assertFalse(lww.exist("a"))
+        self.assertTrue(lww.exist("b"))
+
+    def test_apply_ops_invalid(self):
+        """A bad operation rejects the whole batch before any write"""
+        lww = self.lww_type()
+        ops = [(LWW_set.ADD, "a", 1), ("update", "b", 1)]
+        self.assertRaises(ValueError, lww.apply_ops, ops)
+        self.assertRaises(ValueError, lww.add_many, [("a", "never")])
+        self.assertEqual(lww.get(), [])
+
+    def test_validation(self):
+        lww = self.lww_type()
+        element = "a" * 10
+        self.assertTrue(lww.validate_element(element) is element)  # no copy
+        self.assertEqual(lww.validate_element(12), "12")
+        self.assertEqual(lww.validate_timestamp(2), 2.0)
+        self.assertEqual(type(lww.validate_timestamp(True)), float)
+        self.assertRaises(ValueError, lww.validate_timestamp, "never")
+        self.assertRaises(ValueError, lww.add, "a", None)
+
+    def test_trusted(self):
+        lww = self.lww_type()
+        lww.trust_arguments()
+        lww.add_many(("e%d" % i, 1.0) for i in range(10))
+        lww.remove("e3", 2.0)
+        self.assertTrue(lww.exist("e1"))
+        self.assertFalse(lww.exist("e3"))
+        self.assertEqual(lww.count(), 9)
+        self.assertEqual(lww.exist_many(["e0", "e3", "x"]), [True, False, False])
+
+    def test_int_timestamps(self):
+        lww = self.lww_type()
+        lww.use_int_timestamps()
+        t = 1700000000000000000  # nanoseconds, beyond the precision of a float
+        lww.add("a", t + 1)
+        lww.remove("a", t + 2)
+        lww.remove("b", t + 1)
+        lww.add("b", t)
+        watermark = lww.watermark()
+        lww.apply_ops([(LWW_set.ADD, "c", t + 3), (LWW_set.REMOVE, "c", t + 2)])
+        self.assertEqual(lww.exist_many(["a", "b", "c"]), [False, False, True])
+        self.assertEqual(lww.timestamps("a"), (t + 1, t + 2))
+        self.assertEqual(type(lww.timestamps("a")[0]), int)
+        self.assertEqual(sorted(lww.delta_since(watermark)),
+                         [(LWW_set.ADD, "c", t + 3), (LWW_set.REMOVE, "c", t + 2)])
+        self.assertEqual(lww.count(), 1)
+        self.assertEqual(lww.validate_timestamp(2.0), 2)
+        self.assertRaises(ValueError, lww.add, "d", 1.5)
+        self.assertRaises(ValueError, lww.add, "d", 1 << 63)
+        self.assertRaises(ValueError, lww.add, "d", "never")
+        stats = lww.compact(t + 10)
+        self.assertEqual(stats["add_entries"] + stats["remove_entries"], 5)
+        self.assertEqual(lww.get(), ["c"])
+
+    def test_pack_timestamp(self):
+        lww = self.lww_type()
+        lww.add("a", pack_timestamp(100, 2))
+        lww.remove("a", pack_timestamp(100, 1))  # same time, lower node id
+        self.assertTrue(lww.exist("a"))
+        lww.remove("a", pack_timestamp(100, 3))
+        self.assertFalse(lww.exist("a"))
+        self.assertEqual(unpack_timestamp(pack_timestamp(100, 3)), (100, 3))
+        self.assertRaises(ValueError, pack_timestamp, 100, 1 << 16)
+
+    def test_iter_elements(self):
+        lww = self.lww_type()
+        lww.add_many((i, 2) for i in range(100))
+        lww.remove_many((i, 1 + i % 2 * 2) for i in range(100))
+        expected_arr = [str(i) for i in range(0, 100, 2)]
+        self.assertEqual(sorted(lww.iter_elements(), key=int), expected_arr)
+        self.assertEqual(sorted(lww.iter_elements(batch_size=7), key=int), expected_arr)
+
+    def test_iter_elements_concurrent_add(self):
+        """Adding elements while iterating does not break the iteration"""
+        lww = self.lww_type()
+        lww.add_many((i, 1) for i in range(10))
+        result = []
+        for i, element in enumerate(lww.iter_elements()):
+            lww.add(100 + i, 1)
+            result.append(element)
+        self.assertEqual(result, [str(i) for i in range(10)])
+        self.assertEqual(len(lww.get()), 20)
+
+    def compacted_bytes(self, n_timestamps, elements):
+        """The bytes compact() reports for dropping some float timestamps
+        and the strings of the elements left without any entry"""
+        return 24 * n_timestamps + sum(sys.getsizeof(element) for element in elements)
+
+    def check_compacted(self, lww):
+        """Engine checks of the set compacted by test_compact"""
+        self.assertEqual(lww.add_set, {"live": 2})
+        self.assertEqual(lww.remove_set, {"recent": 10})
+
+    def check_all_compacted(self, lww):
+        """Engine checks of the set emptied by test_compactor"""
+        self.assertEqual(lww.add_set, {})
+        self.assertEqual(lww.remove_set, {})
+
+    def test_compact(self):
+        lww = self.lww_type()
+        lww.add("live", 2)
+        lww.remove("live", 1)
+        lww.add("dead", 1)
+        lww.remove("dead", 2)
+        lww.remove("recent", 10)
+        stats = lww.compact(5)
+        self.assertEqual(stats, {"add_entries": 1, "remove_entries": 2,
+                                 "bytes": self.compacted_bytes(3, ["dead"])})
+        self.assertEqual(lww.timestamps("live"), (2, None))
+        self.assertEqual(lww.timestamps("dead"), (None, None))
+        self.assertEqual(lww.timestamps("recent"), (None, 10))
+        self.assertTrue(lww.exist("live"))
+        self.assertFalse(lww.exist("dead"))
+        self.assertFalse(lww.exist("recent"))
+        self.assertEqual(lww.get(), ["live"])
+        self.assertEqual(lww.count(), 1)
+        self.check_compacted(lww)
+        # operations newer than the horizon behave as before compaction
+        lww.add("dead", 6)
+        lww.add("recent", 9)
+        lww.remove("live", 7)
+        self.assertEqual(lww.get(), ["dead"])
+        self.assertEqual(lww.compact(5, slice_size=1),
+                         {"add_entries": 2, "remove_entries": 0,
+                          "bytes": self.compacted_bytes(2, [])})
+        self.assertEqual(lww.count(), 1)
+
+    def test_compactor(self):
+        lww = self.lww_type()
+        lww.add_many((i, 1) for i in range(100))
+        lww.remove_many((i, 2) for i in range(100))
+        compactor = LWW_compactor(lww, lambda: 3, interval=0.01, slice_size=10)
+        compactor.start()
+        while compactor.stats["runs"] == 0:
+            time.sleep(0.01)
+        compactor.stop()
+        self.assertEqual(compactor.stats["add_entries"], 100)
+        self.assertEqual(compactor.stats["remove_entries"], 100)
+        self.assertEqual(list(lww.delta_since()), [])
+        self.assertEqual(lww.get(), [])
+        self.assertEqual(lww.count(), 0)
+        self.check_all_compacted(lww)
+
+    def test_delta_since(self):
+        lww = self.lww_type()
+        lww.add("a", 1)
+        lww.add("b", 3)
+        watermark = lww.watermark()
+        lww.remove("a", 4)
+        lww.remove("c", 2)
+        lww.add("b", 2)  # older, changes nothing
+        self.assertEqual(sorted(lww.delta_since()),
+                         [(LWW_set.ADD, "a", 1), (LWW_set.ADD, "b", 3),
+                          (LWW_set.REMOVE, "a", 4), (LWW_set.REMOVE, "c", 2)])
+        # both entries of a changed element are shipped
+        self.assertEqual(sorted(lww.delta_since(watermark)),
+                         [(LWW_set.ADD, "a", 1), (LWW_set.REMOVE, "a", 4),
+                          (LWW_set.REMOVE, "c", 2)])
+        self.assertEqual(list(lww.delta_since(lww.watermark())), [])
+        # a watermark of another replica gives all entries
+        self.assertEqual(len(list(lww.delta_since(self.lww_type().watermark()))), 4)
+        self.assertRaises(ValueError, lww.delta_since, 2)
+
+    def test_merge(self):
+        """Replicas converge in both directions, including across engines"""
+        for other_type in (self.lww_type, LWW_set):
+            lww1 = self.lww_type()
+            lww2 = other_type()
+            lww1.add_many([("a", 1), ("b", 1), ("c", 5)])
+            lww2.add_many([("a", 2), ("d", 1)])
+            lww2.remove_many([("b", 2), ("c", 4)])
+            self.assertTrue(lww1.merge(lww2))
+            self.assertTrue(lww2.merge(lww1))
+            self.assertEqual(sorted(lww1.get()), ["a", "c", "d"])
+            self.assertEqual(sorted(lww2.get()), ["a", "c", "d"])
+            self.assertEqual(sorted(lww1.delta_since()), sorted(lww2.delta_since()))
+            # only changed entries are shipped with a watermark
+            watermark = lww2.watermark()
+            lww2.remove("a", 6)
+            self.assertEqual(list(lww2.delta_since(watermark)),
+                             [(LWW_set.ADD, "a", 2), (LWW_set.REMOVE, "a", 6)])
+            lww1.merge(lww2, watermark)
+            self.assertEqual(sorted(lww1.get()), ["c", "d"])
+
+    def test_merge_late_write(self):
+        """A write older than the entries shipped before is still shipped"""
+        lww1 = self.lww_type()
+        lww2 = self.lww_type()
+        lww1.add("x", 10)
+        watermark = lww1.watermark()
+        lww2.merge(lww1)
+        lww1.add("y", 5)
+        lww2.merge(lww1, watermark)
+        self.assertEqual(sorted(lww1.get()), ["x", "y"])
+        self.assertEqual(sorted(lww2.get()), ["x", "y"])
+
+    def test_exist_many(self):
+        lww = self.lww_type()
+        lww.add_many((i, 1) for i in range(100))
+        lww.remove_many((i, 2) for i in range(0, 100, 3))
+        lww.remove(1, 1)  # a tie, the add wins
+        elements = list(range(-5, 105)) + [7, "7", "x"]
+        self.assertEqual(lww.exist_many(elements), [lww.exist(element) for element in elements])
+        self.assertEqual(lww.exist_many(iter([1, 3])), [True, False])
+        self.assertEqual(lww.exist_many([]), [])
+
+    @unittest.skipUnless(numpy, "numpy is not installed")
+    def test_exist_mask(self):
+        lww = self.lww_type()
+        lww.add_many((i, 1) for i in range(0, 10, 2))
+        candidates = numpy.arange(10)
+        self.assertEqual(list(candidates[lww.exist_mask(candidates)]), [0, 2, 4, 6, 8])
+
+    def test_timestamps(self):
+        lww = self.lww_type()
+        lww.add("a", 1)
+        lww.add("a", 3)
+        lww.remove("a", 2)
+        lww.remove("b", 1)
+        self.assertEqual(lww.timestamps("a"), (3, 2))
+        self.assertEqual(lww.timestamps("b"), (None, 1))
+        self.assertEqual(lww.timestamps("c"), (None, None))
+
+    def test_get_range(self):
+        lww = self.lww_type()
+        lww.add_many((i, i // 2) for i in range(20))
+        lww.remove_many((i, 100) for i in range(0, 20, 3))
+        lww.add("late", 5)
+        self.assertEqual(lww.get_range(2, 5), ["4", "5", "7", "8", "10", "11", "late"])
+        self.assertEqual(lww.get_range(9, 9), ["19"])
+        self.assertEqual(lww.get_range(5, 2), [])
+        # an element moves when its add timestamp grows
+        lww.add("4", 50)
+        self.assertEqual(lww.get_range(2, 2), ["5"])
+        self.assertEqual(lww.get_range(0, 100)[-1], "4")
+        self.assertRaises(ValueError, lww.get_range, "a", 1)
+
+    def test_latest_select(self):
+        lww = self.lww_type()
+        lww.add_many((i, i) for i in range(10))
+        lww.remove(9, 10)
+        lww.remove(3, 10)
+        self.assertEqual(lww.latest(3), ["8", "7", "6"])
+        self.assertEqual(lww.latest(0), [])
+        self.assertEqual(len(lww.latest(100)), 8)
+        self.assertEqual(lww.select(0, 3), ["0", "1", "2"])
+        self.assertEqual(lww.select(3, 3), ["4", "5", "6"])
+        self.assertEqual(lww.select(7, 3), ["8"])
+        # a removed element comes back at its new add timestamp
+        lww.add(3, 11)
+        self.assertEqual(lww.latest(2), ["3", "8"])
+        self.assertRaises(ValueError, lww.select, -1, 3)
+
+    def test_count(self):
+        lww = self.lww_type()
+        self.assertEqual(lww.count(), 0)
+        self.assertEqual(len(lww), 0)
+        self.assertTrue(lww)  # an empty set is still truthy
+        lww.add_many((i, 1) for i in range(10))
+        lww.remove(3, 2)
+        lww.remove(4, 0)   # older than the add, no change
+        lww.remove("x", 5)  # never added
+        self.assertEqual(len(lww), 9)
+        lww.add(3, 3)
+        lww.add(5, 3)      # already exists
+        lww.apply_ops([(LWW_set.REMOVE, 6, 2), (LWW_set.REMOVE, 6, 3),
+                       (LWW_set.ADD, "y", 1), (LWW_set.ADD, "x", 5)])
+        self.assertEqual(lww.count(), 11)
+        self.assertEqual(lww.count(), len(lww.get()))
+
     def test1(self):
         """test1-12 corresponds to a case in README table"""
-        lww = LWW_set()
+        lww = self.lww_type()
         lww.add(1,1)
         self.assertTrue(lww.exist(1))
         lww.add(1,0)
@@ -72,7 +366,7 @@ class Test_LWW_Set(unittest.TestCase):
         self.assertEqual(lww.get(), expected_arr)
 
     def test2(self):
-        lww = LWW_set()
+        lww = self.lww_type()
         lww.add(1,1)
         self.assertTrue(lww.exist(1))
         lww.add(1,1)
@@ -81,7 +375,7 @@ class Test_LWW_Set(unittest.TestCase):
         self.assertEqual(lww.get(), expected_arr)
 
     def test3(self):
-        lww = LWW_set()
+        lww = self.lww_type()
         lww.add(1,1)
         self.assertTrue(lww.exist(1))
         lww.add(1,2)
@@ -90,7 +384,7 @@ class Test_LWW_Set(unittest.TestCase):
         self.assertEqual(lww.get(), expected_arr)
 
     def test4(self):
-        lww = LWW_set()
+        lww = self.lww_type()
         lww.remove(1,1)
         self.assertFalse(lww.exist(1))
         lww.add(1,0)
@@ -99,7 +393,7 @@ class Test_LWW_Set(unittest.TestCase):
         self.assertEqual(lww.get(), expected_arr)
 
     def test5(self):
-        lww = LWW_set()
+        lww = self.lww_type()
         lww.remove(1,1)
         self.assertFalse(lww.exist(1))
         lww.add(1,1)
@@ -108,7 +402,7 @@ class Test_LWW_Set(unittest.TestCase):
         self.assertEqual(lww.get(), expected_arr)
 
     def test6(self):
-        lww = LWW_set()
+        lww = self.lww_type()
         lww.remove(1,1)
         self.assertFalse(lww.exist(1))
         lww.add(1,2)
@@ -117,7 +411,7 @@ class Test_LWW_Set(unittest.TestCase):
         self.assertEqual(lww.get(), expected_arr)
 
     def test7(self):
-        lww = LWW_set()
+        lww = self.lww_type()
         lww.remove(1,1)
         self.assertFalse(lww.exist(1))
         lww.remove(1,0)
@@ -126,7 +420,7 @@ class Test_LWW_Set(unittest.TestCase):
         self.assertEqual(lww.get(), expected_arr)
 
     def test8(self):
-        lww = LWW_set()
+        lww = self.lww_type()
         lww.remove(1,1)
         self.assertFalse(lww.exist(1))
         lww.remove(1,1)
@@ -135,7 +429,7 @@ class Test_LWW_Set(unittest.TestCase):
         self.assertEqual(lww.get(), expected_arr)
 
     def test8(self):
-        lww = LWW_set()
+        lww = self.lww_type()
         lww.remove(1,1)
         self.assertFalse(lww.exist(1))
         lww.remove(1,2)
@@ -144,7 +438,7 @@ class Test_LWW_Set(unittest.TestCase):
         self.assertEqual(lww.get(), expected_arr)
 
     def test9(self):
-        lww = LWW_set()
+        lww = self.lww_type()
         lww.remove(1,1)
         self.assertFalse(lww.exist(1))
         lww.remove(1,0)
@@ -153,7 +447,7 @@ class Test_LWW_Set(unittest.TestCase):
         self.assertEqual(lww.get(), expected_arr)
 
     def test10(self):
-        lww = LWW_set()
+        lww = self.lww_type()
         lww.add(1,1)
         self.assertTrue(lww.exist(1))
         lww.remove(1,0)
@@ -162,7 +456,7 @@ class Test_LWW_Set(unittest.TestCase):
         self.assertEqual(lww.get(), expected_arr)
 
     def test11(self):
-        lww = LWW_set()
+        lww = self.lww_type()
         lww.add(1,1)
         self.assertTrue(lww.exist(1))
         lww.remove(1,1)
@@ -171,7 +465,7 @@ class Test_LWW_Set(unittest.TestCase):
         self.assertEqual(lww.get(), expected_arr)
 
     def test12(self):
-        lww = LWW_set()
+        lww = self.lww_type()
         lww.add(1,1)
         self.assertTrue(lww.exist(1))
         lww.remove(1,2)
@@ -197,6 +491,47 @@ class RemoveThread (threading.Thread):
     def run(self):
         self.lww_set.remove(self.element, self.timestamp)
 
+
+class Test_LWW_Python_Ordered(Test_LWW_Set):
+    """Runs all lww_python tests with the add timestamp index"""
+    lww_type = staticmethod(lambda: LWW_set(ordered=True))
+
+    def test_index(self):
+        """The index matches the set after concurrent and batch writes"""
+        lww = self.lww_type()
+        lww.add_many((i, i % 7) for i in range(100))
+
+        def write(offset):
+            for i in range(offset, 100, 4):
+                lww.remove(i, 3)
+                lww.add(i, 3 if i % 2 else 2)
+
+        threads = [threading.Thread(target=write, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        lww.remove_many((i, 6) for i in range(0, 100, 5))
+        expected = sorted((lww.add_set[element], element) for element in lww.get())
+        self.assertEqual(lww.index, expected)
+        self.assertEqual(lww.select(0, 1000), [element for _, element in expected])
+
+    def test_load_ordered(self):
+        import os
+        import tempfile
+        lww = self.lww_type()
+        lww.add_many((i, 100 - i) for i in range(100))
+        lww.remove(99, 2)
+        path = os.path.join(tempfile.mkdtemp(), "lww.snapshot")
+        try:
+            lww.dump(path)
+            loaded = LWW_set.load(path, ordered=True)
+            self.assertEqual(loaded.index, lww.index)
+            self.assertEqual(loaded.latest(2), ["0", "1"])
+        finally:
+            os.remove(path)
+            os.rmdir(os.path.dirname(path))
+
         
 if __name__ == '__main__':
     unittest.main()
@@ -1,44 +1,687 @@
+import time
+import zlib
+from collections import OrderedDict
+from heapq import merge
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from threading import *
 from lww_interface import LWW_set
+from lww_feed import Change_source, Subscription
+
+# Given a channel, e.g., "<namespace>_changes", the write scripts
+# publish every changed entry to it as "<key> <timestamp> <element>"
+# messages. Subscribers, e.g., the exist() cache of LWW_redis, merge
+# them into their copies. Clients created with publish=False and without
+# a cache pass an empty channel and publish nothing.
+
+# The write scripts also keep the number of existing elements of a
+# bucket in its count key, e.g., lww_count, adjusting it whenever a
+# write makes an element exist or stop existing.
+
+# With a feed, a write that makes an element exist or stop existing
+# also appends an entry with the fields op ('add' or 'remove'), element
+# and timestamp to the feed stream of the bucket, e.g., lww_feed, capped
+# at about the given length. Unlike the channel, a stream keeps its
+# entries, so a consumer resumes from the ID of the last entry it read.
+
+# The write scripts number every element they change with the next
+# value of the sequence key of its bucket, e.g., lww_sequence, and keep
+# that number as its score in the changed ZSET, e.g., lww_changed, so
+# that delta_since() pages through the elements changed after a
+# watermark.
+
+# Returns 1 if an element exists and 0 otherwise, see LWW_set.exist().
+LIVE_FUNCTION = """
+local function live(element)
+    local added = redis.call('ZSCORE', KEYS[1], element)
+    if not added then
+        return 0
+    end
+    local removed = redis.call('ZSCORE', KEYS[2], element)
+    if (not removed) or tonumber(added) >= tonumber(removed) then
+        return 1
+    end
+    return 0
+end
+"""
+
+# Atomic max-timestamp compare and set of one operation.
+#
+# KEYS[1] -- the add set, e.g., lww_add_set
+# KEYS[2] -- the remove set, e.g., lww_remove_set
+# KEYS[3] -- the count key, e.g., lww_count
+# KEYS[4] -- the feed stream, e.g., lww_feed
+# KEYS[5] -- the changed set, e.g., lww_changed
+# KEYS[6] -- the sequence key, e.g., lww_sequence
+# ARGV[1] -- op, 'add' or 'remove'
+# ARGV[2] -- timestamp
+# ARGV[3] -- element
+# ARGV[4] -- the channel a change is published to, '' for none
+# ARGV[5] -- the approximate maximum length of the feed, '0' for no feed
+TEST_AND_ADD_SCRIPT = LIVE_FUNCTION + """
+local key = KEYS[1]
+if ARGV[1] == 'remove' then
+    key = KEYS[2]
+end
+local current = redis.call('ZSCORE', key, ARGV[3])
+if (not current) or tonumber(current) < tonumber(ARGV[2]) then
+    local was_live = live(ARGV[3])
+    redis.call('ZADD', key, ARGV[2], ARGV[3])
+    redis.call('ZADD', KEYS[5], redis.call('INCR', KEYS[6]), ARGV[3])
+    local change = live(ARGV[3]) - was_live
+    if change ~= 0 then
+        redis.call('INCRBY', KEYS[3], change)
+        if ARGV[5] ~= '0' then
+            local flip = 'add'
+            if change < 0 then
+                flip = 'remove'
+            end
+            redis.call('XADD', KEYS[4], 'MAXLEN', '~', ARGV[5], '*',
+                       'op', flip, 'element', ARGV[3], 'timestamp', ARGV[2])
+        end
+    end
+    if ARGV[4] ~= '' then
+        redis.call('PUBLISH', ARGV[4], key .. ' ' .. ARGV[2] .. ' ' .. ARGV[3])
+    end
+    return 1
+end
+return 0
+"""
+
+# Atomic max-timestamp compare and set for a batch of operations.
+#
+# KEYS[1] -- the add set, e.g., lww_add_set
+# KEYS[2] -- the remove set, e.g., lww_remove_set
+# KEYS[3] -- the count key, e.g., lww_count
+# KEYS[4] -- the feed stream, e.g., lww_feed
+# KEYS[5] -- the changed set, e.g., lww_changed
+# KEYS[6] -- the sequence key, e.g., lww_sequence
+# ARGV[1] -- the channel changes are published to, '' for none
+# ARGV[2] -- the approximate maximum length of the feed, '0' for no feed
+# ARGV[3:] -- flattened (op, timestamp, element) triples
+APPLY_OPS_SCRIPT = LIVE_FUNCTION + """
+local change = 0
+for i = 3, #ARGV, 3 do
+    local key = KEYS[1]
+    if ARGV[i] == 'remove' then
+        key = KEYS[2]
+    end
+    local current = redis.call('ZSCORE', key, ARGV[i+2])
+    if (not current) or tonumber(current) < tonumber(ARGV[i+1]) then
+        local was_live = live(ARGV[i+2])
+        redis.call('ZADD', key, ARGV[i+1], ARGV[i+2])
+        redis.call('ZADD', KEYS[5], redis.call('INCR', KEYS[6]), ARGV[i+2])
+        local flip = live(ARGV[i+2]) - was_live
+        change = change + flip
+        if flip ~= 0 and ARGV[2] ~= '0' then
+            local op = 'add'
+            if flip < 0 then
+                op = 'remove'
+            end
+            redis.call('XADD', KEYS[4], 'MAXLEN', '~', ARGV[2], '*',
+                       'op', op, 'element', ARGV[i+2], 'timestamp', ARGV[i+1])
+        end
+        if ARGV[1] ~= '' then
+            redis.call('PUBLISH', ARGV[1], key .. ' ' .. ARGV[i+1] .. ' ' .. ARGV[i+2])
+        end
+    end
+end
+if change ~= 0 then
+    redis.call('INCRBY', KEYS[3], change)
+end
+return (#ARGV - 2) / 3
+"""
+
+# Recomputes the count key of a bucket, e.g., for sets written before
+# the count was kept. Blocks the server for O(n).
+#
+# KEYS[1] -- the add set, e.g., lww_add_set
+# KEYS[2] -- the remove set, e.g., lww_remove_set
+# KEYS[3] -- the count key, e.g., lww_count
+RECOUNT_SCRIPT = LIVE_FUNCTION + """
+local count = 0
+local entries = redis.call('ZRANGE', KEYS[1], 0, -1)
+for i = 1, #entries do
+    count = count + live(entries[i])
+end
+redis.call('SET', KEYS[3], count)
+return count
+"""
+
+# Returns all existing elements, i.e., elements in the add set whose add
+# timestamp is not older than their remove timestamp.
+#
+# KEYS[1] -- the add set, e.g., lww_add_set
+# KEYS[2] -- the remove set, e.g., lww_remove_set
+GET_SCRIPT = """
+local result = {}
+local entries = redis.call('ZRANGE', KEYS[1], 0, -1, 'WITHSCORES')
+for i = 1, #entries, 2 do
+    local removed = redis.call('ZSCORE', KEYS[2], entries[i])
+    if (not removed) or tonumber(entries[i+1]) >= tonumber(removed) then
+        result[#result+1] = entries[i]
+    end
+end
+return result
+"""
+
+# One ZSCAN page of the add set, filtered like GET_SCRIPT.
+#
+# KEYS[1] -- the add set, e.g., lww_add_set
+# KEYS[2] -- the remove set, e.g., lww_remove_set
+# ARGV[1] -- ZSCAN cursor
+# ARGV[2] -- ZSCAN COUNT hint
+# returns {next cursor, existing elements...}
+SCAN_SCRIPT = """
+local page = redis.call('ZSCAN', KEYS[1], ARGV[1], 'COUNT', ARGV[2])
+local result = {page[1]}
+local entries = page[2]
+for i = 1, #entries, 2 do
+    local removed = redis.call('ZSCORE', KEYS[2], entries[i])
+    if (not removed) or tonumber(entries[i+1]) >= tonumber(removed) then
+        result[#result+1] = entries[i]
+    end
+end
+return result
+"""
+
+# exist() for a batch of elements.
+#
+# KEYS[1] -- the add set, e.g., lww_add_set
+# KEYS[2] -- the remove set, e.g., lww_remove_set
+# ARGV    -- elements
+# returns 1 or 0 for each element
+EXIST_MANY_SCRIPT = """
+local result = {}
+for i = 1, #ARGV do
+    local exists = 0
+    local added = redis.call('ZSCORE', KEYS[1], ARGV[i])
+    if added then
+        local removed = redis.call('ZSCORE', KEYS[2], ARGV[i])
+        if (not removed) or tonumber(added) >= tonumber(removed) then
+            exists = 1
+        end
+    end
+    result[i] = exists
+end
+return result
+"""
+
+# Existing elements ordered by add timestamp, then by element. The add
+# set is read by rank in pages between the ranks of the score bounds,
+# so a query costs O(log n + k), plus the removed elements it skips.
+#
+# KEYS[1] -- the add set, e.g., lww_add_set
+# KEYS[2] -- the remove set, e.g., lww_remove_set
+# ARGV[1] -- the smallest add timestamp, inclusive
+# ARGV[2] -- the largest add timestamp, inclusive
+# ARGV[3] -- the number of existing elements skipped
+# ARGV[4] -- the maximum number of elements returned, -1 for all
+# ARGV[5] -- '1' for newest first, '0' for oldest first
+# returns {element, add timestamp, element, add timestamp, ...}
+QUERY_SCRIPT = """
+local first = redis.call('ZCOUNT', KEYS[1], '-inf', '(' .. ARGV[1])
+local last = redis.call('ZCOUNT', KEYS[1], '-inf', ARGV[2]) - 1
+local skip = tonumber(ARGV[3])
+local limit = tonumber(ARGV[4])
+local reverse = ARGV[5] == '1'
+local result = {}
+if limit == 0 then
+    return result
+end
+local position = first
+if reverse then
+    position = last
+end
+while first <= position and position <= last do
+    local low, high = position, math.min(position + 999, last)
+    local from, to, step = 1, 2 * (high - low) + 1, 2
+    if reverse then
+        low, high = math.max(position - 999, first), position
+        from, to, step = 2 * (high - low) + 1, 1, -2
+    end
+    local page = redis.call('ZRANGE', KEYS[1], low, high, 'WITHSCORES')
+    for i = from, to, step do
+        local removed = redis.call('ZSCORE', KEYS[2], page[i])
+        if (not removed) or tonumber(page[i+1]) >= tonumber(removed) then
+            if skip > 0 then
+                skip = skip - 1
+            else
+                result[#result+1] = page[i]
+                result[#result+1] = page[i+1]
+                if #result == 2 * limit then
+                    return result
+                end
+            end
+        end
+    end
+    if reverse then
+        position = low - 1
+    else
+        position = high + 1
+    end
+end
+return result
+"""
+
+# Drops redundant entries of the given elements, and the elements left
+# without entries from the changed set. See LWW_set.compact().
+#
+# KEYS[1] -- the add set, e.g., lww_add_set
+# KEYS[2] -- the remove set, e.g., lww_remove_set
+# KEYS[5] -- the changed set, e.g., lww_changed
+# ARGV[1] -- horizon timestamp
+# ARGV[2:] -- elements of the remove set
+# returns {dropped add entries, dropped remove entries, bytes}
+COMPACT_SCRIPT = """
+local horizon = tonumber(ARGV[1])
+local dropped_add, dropped_remove, bytes = 0, 0, 0
+for i = 2, #ARGV do
+    local element = ARGV[i]
+    local removed = redis.call('ZSCORE', KEYS[2], element)
+    if removed then
+        removed = tonumber(removed)
+        local added = redis.call('ZSCORE', KEYS[1], element)
+        if added and tonumber(added) >= removed then
+            redis.call('ZREM', KEYS[2], element)
+            dropped_remove = dropped_remove + 1
+            bytes = bytes + #element + 8
+        else
+            if added then
+                redis.call('ZREM', KEYS[1], element)
+                dropped_add = dropped_add + 1
+                bytes = bytes + #element + 8
+            end
+            if removed < horizon then
+                redis.call('ZREM', KEYS[2], element)
+                redis.call('ZREM', KEYS[5], element)
+                dropped_remove = dropped_remove + 1
+                bytes = bytes + #element + 8
+            end
+        end
+    end
+end
+return {dropped_add, dropped_remove, bytes}
+"""
+
+# One page of the elements changed after a sequence number, with their
+# entries. The sequence numbers of a bucket are unique, so the next page
+# starts after the last number of this one.
+#
+# KEYS[1] -- the add set, e.g., lww_add_set
+# KEYS[2] -- the remove set, e.g., lww_remove_set
+# KEYS[5] -- the changed set, e.g., lww_changed
+# ARGV[1] -- the sequence number the page starts after
+# ARGV[2] -- the maximum number of elements of the page
+# returns flattened (sequence number, element, add timestamp, remove
+# timestamp) quadruples, with nil for a missing timestamp
+DELTA_SCRIPT = """
+local page = redis.call('ZRANGEBYSCORE', KEYS[5], '(' .. ARGV[1], '+inf',
+                        'WITHSCORES', 'LIMIT', 0, ARGV[2])
+local result = {}
+for i = 1, #page, 2 do
+    result[#result + 1] = page[i + 1]
+    result[#result + 1] = page[i]
+    result[#result + 1] = redis.call('ZSCORE', KEYS[1], page[i])
+    result[#result + 1] = redis.call('ZSCORE', KEYS[2], page[i])
+end
+return result
+"""
+
+def bucket_keys(namespace, n_buckets):
+    """Returns the (add set, remove set, count, feed, changed, sequence)
+    keys of every bucket
+
+    A set of one bucket is stored in "<namespace>_add_set",
+    "<namespace>_remove_set", "<namespace>_count", "<namespace>_feed",
+    "<namespace>_changed" and "<namespace>_sequence", e.g., "lww_add_set"
+    by default. The keys of bucket i are "{<namespace>:<i>}_add_set" and
+    so on. The hash tag
+    in braces maps all keys of a bucket to the same Redis Cluster slot,
+    so the scripts can use them together, while different buckets are
+    spread over the slots.
+    """
+    names = ("add_set", "remove_set", "count", "feed", "changed", "sequence")
+    if n_buckets == 1:
+        return [tuple("%s_%s" % (namespace, name) for name in names)]
+    return [tuple("{%s:%d}_%s" % (namespace, i, name) for name in names)
+            for i in range(n_buckets)]
+
+
+def bucket_index(element, n_buckets):
+    """Returns the bucket of a validated element
+
+    CRC32 of the UTF-8 element, unlike hash(), is the same in every
+    process and on every host. Lone surrogates are encoded as in
+    lww_snapshot, so every valid str has a bucket.
+    """
+    if n_buckets == 1:
+        return 0
+    return zlib.crc32(element.encode("utf-8", "surrogatepass")) % n_buckets
+
+
+def decode_element(member):
+    """Returns the str element of a ZSET member
+
+    A client without decode_responses returns members as bytes.
+    """
+    if isinstance(member, bytes):
+        return member.decode("utf-8", "surrogatepass")
+    return member
+
+
+def pooled_client(url, max_connections=50, pool_options=None):
+    """Returns a redis client of a URL with a blocking connection pool
+
+    Threads wait for one of max_connections connections instead of
+    opening one connection each. pool_options are extra options of the
+    pool, e.g., {"socket_timeout": 1.0}.
+    """
+    import redis
+    pool = redis.BlockingConnectionPool.from_url(url, max_connections=max_connections,
+                                                 **(pool_options or {}))
+    return redis.StrictRedis(connection_pool=pool)
+
+
+class Stream_reader(Change_source):
+    """Reads the change events of LWW_redis from its feed streams.
+
+    Each get_batch() is one XREAD of at most batch_size entries per
+    stream. A reader that falls more than the feed length behind misses
+    the trimmed entries, and should resync, e.g., from get().
+
+    Keyword attributes:
+    redis -- see LWW_redis
+    offsets -- stream key -> the ID of the last entry read; pass it to
+    LWW_redis.changes() to resume after this reader
+    batch_size -- the XREAD COUNT
+    score_type -- the type of the returned timestamps
+    """
+    POLL_INTERVAL = 0.1  # seconds an XREAD blocks before close() is checked
+
+    def __init__(self, redis, offsets, batch_size, score_type):
+        self.redis = redis
+        self.offsets = offsets
+        self.batch_size = batch_size
+        self.score_type = score_type
+        self.closed = False
+
+    def get_batch(self, timeout=None):
+        """Returns the next batch of change events
+
+        See base class Change_source docstring for detals.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.closed:
+            block = self.POLL_INTERVAL
+            if deadline is not None:
+                block = min(block, deadline - time.time())
+            try:
+                reply = self.redis.xread(self.offsets, count=self.batch_size,
+                                         block=max(int(block * 1000), 1))
+            except:
+                raise RuntimeError("An internal error occurs, e.g., disconnection from network. A retry may solve the problem. ")
+            events = []
+            for key, entries in reply or ():
+                if isinstance(key, bytes):
+                    key = key.decode("utf-8")
+                for entry_id, fields in entries:
+                    self.offsets[key] = entry_id
+                    events.append(self.__event(fields))
+            if events:
+                return events
+            if deadline is not None and time.time() >= deadline:
+                return []
+        return None
+
+    def __event(self, fields):
+        """Returns the (op, element, timestamp) event of a stream entry"""
+        event = {}
+        for name, value in fields.items():
+            if isinstance(name, bytes):
+                name, value = name.decode("utf-8"), value.decode("utf-8")
+            event[name] = value
+        return event["op"], event["element"], self.score_type(float(event["timestamp"]))
+
+    def close(self):
+        """Stops the reader within POLL_INTERVAL seconds"""
+        self.closed = True
+
 
 class LWW_redis(LWW_set):
     """A Last-Writer-Win element set based on redis ZSET. 
 
     lww-set stores the add/remove operations in a remote 
-    redis server. 
+    redis server. The test & set of add() and remove() runs as a Lua
+    script on the server, so it is atomic across threads, processes and
+    hosts sharing the same redis server.
 
-    Keyword attributes:
-    redis -- an opened connection with a redis server
+    With cache_size > 0, the add and remove timestamps read by exist()
+    and timestamps() are kept in a local LRU cache of at most
+    cache_size elements. The write scripts publish the entries they
+    change to the "<namespace>_changes" channel, and a listener thread
+    merges them into the cached pairs, as are the writes of this
+    client. A client created with publish=False and no cache of its own
+    skips the PUBLISH; only use it for sets that no client caches, or
+    the caches miss its writes for good. Since
+    timestamps only grow, merging keeps a cached pair up to date
+    instead of invalidating it. If the subscription is lost, the cache
+    is cleared and bypassed until the listener has subscribed again.
+    The cache assumes that the sets are only written by the scripts
+    (of LWW_redis or AsyncLWW_redis). Compaction does not change
+    exist(), so it does not publish. Call close() to stop the
+    listener.
+
+    Several independent sets can share a redis server under different
+    namespaces. A set can also be split into n_buckets pairs of ZSETs
+    by element hash, with keys hash-tagged for Redis Cluster (see
+    bucket_keys()), so that a cluster spreads one large set over its
+    nodes. Both entries of an element are always in the same bucket.
+    Writes of different buckets are sent in one pipeline, and get()
+    reads the buckets in parallel.
+
+    With int_timestamps=True, timestamps are validated and returned as
+    ints, see LWW_set.use_int_timestamps(). ZSET scores are doubles,
+    which hold ints exactly up to 2 ** 53, so larger timestamps raise
+    ValueError instead of silently colliding, e.g., use microseconds
+    rather than nanoseconds since the epoch.
+
+    With feed_length > 0, the write scripts append the elements they
+    flip to the feed stream of their bucket, capped at about
+    feed_length entries, and changes() and subscribe() read the
+    streams (see lww_feed). All clients writing the set, including
+    AsyncLWW_redis, need the same feed_length, or their flips are
+    missing from the feed.
+
+    Reads, i.e., exist(), exist_many(), timestamps(), get(),
+    iter_elements(), count() and the ordered queries, go to the
+    read_redis replicas in turn, and writes to redis. watermark() and
+    delta_since() stay on redis: a delta read from a lagging replica
+    would miss changes that a watermark of redis already counts. A replica
+    lags behind, but since timestamps only grow, it always holds an
+    earlier state of the set, never one that did not exist. With
+    max_staleness, that state is at most max_staleness seconds old:
+    every max_staleness / 2 seconds, a read writes the time to the
+    "<namespace>_heartbeat" key of redis and reads the previous
+    heartbeat back from each replica. A replica holds every write made
+    before the heartbeat it returns, so it is used until that heartbeat
+    is max_staleness old, and reads fall back to redis while no
+    replica is fresh enough. The heartbeat assumes the clocks of the
+    clients are synchronized. A client does not read its own writes
+    from a replica; reads of the cache go to redis. from_url() creates
+    the clients with bounded connection pools.
 
+    Keyword attributes:
+    redis -- an opened connection with a redis server, or a
+    redis.cluster.RedisCluster client
+    read_redis -- a client or a list of clients of replicas of redis
+    max_staleness -- the maximum seconds a read from a replica lags
+    behind, None for no bound
+    cache_size -- the maximum number of cached elements, 0 for no cache
+    namespace -- the prefix of the keys and of the changes channel
+    n_buckets -- the number of ZSET pairs the set is split into
+    int_timestamps -- whether timestamps are ints
+    clock -- stamps writes without a timestamp, see lww_clock
+    feed_length -- the approximate number of entries kept in a feed
+    stream, 0 for no feed
+    publish -- publish the changes of this client for the caches of
+    other clients; False saves the PUBLISH of a set that no client
+    caches, and is ignored with a cache
     """
-    def __init__(self, redis):
+    BATCH_SIZE = 1000  # operations or elements sent per script call
+    # the ints that a double score holds exactly
+    MIN_INT_TIMESTAMP = -(1 << 53)
+    MAX_INT_TIMESTAMP = 1 << 53
+
+    def __init__(self, redis, cache_size=0, namespace="lww", n_buckets=1,
+                 int_timestamps=False, clock=None, feed_length=0, read_redis=None,
+                 max_staleness=None, publish=True):
         self.redis = redis
-        self.add_lock = RLock()
-        self.remove_lock = RLock()
+        self.replicas = []
+        if read_redis is not None:
+            self.replicas = list(read_redis) if isinstance(read_redis, (list, tuple)) else [read_redis]
+        self.max_staleness = max_staleness
+        self.heartbeat_key = "%s_heartbeat" % namespace
+        self.fresh_until = [0.0] * len(self.replicas)  # time.time() until a replica is used
+        self.next_check = 0.0
+        self.next_replica = 0
+        self.check_lock = Lock()
+        self.clock = clock
+        self.score_type = float  # the type of the returned timestamps
+        if int_timestamps:
+            self.score_type = int
+            self.use_int_timestamps()
+        self.namespace = namespace
+        self.buckets = bucket_keys(namespace, n_buckets)
+        self.channel = "%s_changes" % namespace
+        # the channel passed to the write scripts, '' to publish nothing
+        self.publish_channel = self.channel if cache_size > 0 or publish else ""
+        self.feed_length = str(int(feed_length))
+        # the key of every underlying ZSET -> 0 for add sets, 1 for remove sets
+        self.key_kinds = {}
+        for keys in self.buckets:
+            self.key_kinds[keys[0]] = 0
+            self.key_kinds[keys[1]] = 1
+        self.executor = None
+        if n_buckets > 1:
+            self.executor = ThreadPoolExecutor(min(n_buckets, 16))
+        # register_script() caches the script SHA and sends EVALSHA,
+        # reloading the script if the server replies with NOSCRIPT
+        self.test_and_add_script = self.redis.register_script(TEST_AND_ADD_SCRIPT)
+        self.apply_ops_script = self.redis.register_script(APPLY_OPS_SCRIPT)
+        self.get_script = self.redis.register_script(GET_SCRIPT)
+        self.scan_script = self.redis.register_script(SCAN_SCRIPT)
+        self.compact_script = self.redis.register_script(COMPACT_SCRIPT)
+        self.query_script = self.redis.register_script(QUERY_SCRIPT)
+        self.recount_script = self.redis.register_script(RECOUNT_SCRIPT)
+        self.exist_many_script = self.redis.register_script(EXIST_MANY_SCRIPT)
+        self.delta_script = self.redis.register_script(DELTA_SCRIPT)
+
+        self.cache = None
+        self.closed = False
+        if cache_size > 0:
+            self.cache_size = cache_size
+            # element -> [add_timestamp, remove_timestamp, filled], where
+            # filled is False until the pair was read from the server
+            self.cache = OrderedDict()
+            self.cache_lock = Lock()
+            self.cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "updates": 0}
+            self.cache_ready = Event()  # set while the listener is subscribed
+            self.listener = Thread(target=self.__run_listener)
+            self.listener.daemon = True
+            self.listener.start()
+
+    @classmethod
+    def from_url(cls, url, max_connections=50, read_urls=(), pool_options=None, **kwargs):
+        """Creates a set with its own clients, e.g., from
+        "redis://localhost:6379/0"
+
+        Every client uses its own pool, see pooled_client().
 
-    def add(self, element, timestamp):
+        Keyword arguments:
+        url -- the URL of the server written to
+        max_connections -- the size of the pool of each server
+        read_urls -- the URLs of the replicas read from, see read_redis
+        pool_options -- extra options of the pools, see pooled_client()
+        kwargs -- passed to LWW_redis()
+        """
+        if read_urls:
+            kwargs["read_redis"] = [pooled_client(read_url, max_connections, pool_options)
+                                    for read_url in read_urls]
+        return cls(pooled_client(url, max_connections, pool_options), **kwargs)
+
+    def keys(self, element):
+        """Returns the bucket_keys() of a validated element"""
+        return self.buckets[bucket_index(element, len(self.buckets))]
+
+    def reader(self):
+        """Returns the client the next read goes to, see read_redis"""
+        replicas = self.replicas
+        if not replicas:
+            return self.redis
+        if self.max_staleness is not None:
+            now = time.time()
+            if now >= self.next_check:
+                self.check_replicas()
+            replicas = [replica for replica, fresh_until in zip(replicas, self.fresh_until)
+                        if fresh_until > now]
+            if not replicas:
+                return self.redis
+        # a race on next_replica only skews the rotation
+        self.next_replica += 1
+        return replicas[self.next_replica % len(replicas)]
+
+    def check_replicas(self):
+        """Measures how far every replica lags behind with a heartbeat
+
+        See the max_staleness of the class docstring. A thread that
+        finds another one checking returns at once.
+
+        Keyword returns:
+        the time.time() until which each replica is used
+        """
+        if not self.check_lock.acquire(False):
+            return self.fresh_until
+        try:
+            now = time.time()
+            self.next_check = now + self.max_staleness / 2.0
+            fresh_until = []
+            for replica in self.replicas:
+                try:
+                    heartbeat = replica.get(self.heartbeat_key)
+                except Exception:
+                    heartbeat = None  # an unreachable replica is not used
+                fresh_until.append(0.0 if heartbeat is None
+                                   else float(heartbeat) + self.max_staleness)
+            self.fresh_until = fresh_until
+            try:
+                self.redis.set(self.heartbeat_key, repr(now))
+            except Exception:
+                pass  # the replicas go stale, and reads fall back to redis
+            return fresh_until
+        finally:
+            self.check_lock.release()
+
+    def add(self, element, timestamp=None):
         """Add an element to lww_set, or update the existing element timestamp
 
         """
 
         element = self.validate_element(element)
-        timestamp = self.validate_timestamp(timestamp)        
+        timestamp = self.write_timestamp(timestamp)        
         
         return_flag = True
-        self.add_lock.acquire()
         try:
-            self.__test_and_add("lww_add_set", element, timestamp)
+            self.__test_and_add(self.ADD, element, timestamp)
         except:
             return_flag = False
-        finally: 
-            self.add_lock.release()
         
         return return_flag
 
-    def __test_and_add(self, target_set, element, timestamp):
+    def __test_and_add(self, op, element, timestamp):
         """A supposedly private function to lww_redis. 
 
-        A wrapper function to do test and add. 
+        A wrapper function to do test and add in one round trip.
 
         Keyword raises:
         redis.exceptions.ResponseError -- A response error that
@@ -46,29 +689,26 @@ class LWW_redis(LWW_set):
         wrong type of set and the underlying redis set may be corrupted and need
         to be repaired. 
         """
-        existing_timestamp = self.redis.zscore(target_set, element)
-        if existing_timestamp != None:
-            if existing_timestamp < timestamp:
-                self.redis.zadd(target_set, timestamp, element)
-        else:
-            self.redis.zadd(target_set, timestamp, element)
+        keys = self.keys(element)
+        self.test_and_add_script(keys=list(keys),
+                                 args=[op, repr(timestamp), element, self.publish_channel,
+                                       self.feed_length])
+        if self.cache is not None:
+            self.__cache_merge(keys[0] if op == self.ADD else keys[1], element, timestamp)
 
-    def remove(self, element, timestamp):
+    def remove(self, element, timestamp=None):
         """Remove an element from lww_set 
 
         """
 
         element = self.validate_element(element)
-        timestamp = self.validate_timestamp(timestamp)        
+        timestamp = self.write_timestamp(timestamp)        
 
         return_flag = True
-        self.remove_lock.acquire()
         try:
-            self.__test_and_add("lww_remove_set", element, timestamp)
+            self.__test_and_add(self.REMOVE, element, timestamp)
         except:
             return_flag = False
-        finally: 
-            self.remove_lock.release()
         
         return return_flag
 
@@ -79,9 +719,16 @@ class LWW_redis(LWW_set):
 
         element = self.validate_element(element)
 
+        if self.cache is not None:
+            add_timestamp, remove_timestamp = self.timestamps(element)
+            return add_timestamp is not None and (remove_timestamp is None or
+                                                  add_timestamp >= remove_timestamp)
+
+        add_key, remove_key = self.keys(element)[:2]
         try:
-            add_timestamp = self.redis.zscore("lww_add_set", element)
-            remove_timestamp = self.redis.zscore("lww_remove_set", element) 
+            redis = self.reader()
+            add_timestamp = redis.zscore(add_key, element)
+            remove_timestamp = redis.zscore(remove_key, element) 
         except:
             raise RuntimeError("An internal error occurs, e.g., disconnection from network. A retry may solve the problem. ")
 
@@ -93,14 +740,484 @@ class LWW_redis(LWW_set):
             return True
         else:
             return False        
+
+    def exist_many(self, elements):
+        """Check which of many elements exist in lww-set
+
+        Elements are sent in chunks of BATCH_SIZE, one script call per
+        bucket and one pipelined round trip per chunk, instead of two
+        ZSCORE round trips per element. The cache is not used.
+
+        See base class LWW_set docstring for detals.
+        """
+        validate_element = self.validate_element
+        elements = [validate_element(element) for element in elements]
+        result = []
+        for start in range(0, len(elements), self.BATCH_SIZE):
+            chunk = elements[start:start + self.BATCH_SIZE]
+            bucket_positions = {}  # keys -> positions in chunk
+            for position in range(len(chunk)):
+                bucket_positions.setdefault(self.keys(chunk[position]), []).append(position)
+            try:
+                pipeline = self.reader().pipeline(transaction=False)
+                for keys, positions in bucket_positions.items():
+                    self.exist_many_script(keys=list(keys), args=[chunk[position] for position in positions],
+                                           client=pipeline)
+                replies = pipeline.execute()
+            except:
+                raise RuntimeError("An internal error occurs, e.g., disconnection from network. A retry may solve the problem. ")
+            flags = [False] * len(chunk)
+            for positions, reply in zip(bucket_positions.values(), replies):
+                for position, flag in zip(positions, reply):
+                    flags[position] = bool(flag)
+            result.extend(flags)
+        return result
+
+    def timestamps(self, element):
+        """Returns the add and remove timestamps of an element
+
+        Both scores are read in one round trip, or from the cache.
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+
+        entry = None
+        if self.cache is not None and self.cache_ready.is_set():
+            with self.cache_lock:
+                entry = self.cache.get(element)
+                if entry is not None and entry[2]:
+                    self.cache.move_to_end(element)
+                    self.cache_stats["hits"] += 1
+                    return self.__scores(entry[0], entry[1])
+                self.cache_stats["misses"] += 1
+                if entry is None:
+                    # a placeholder collects the changes published while
+                    # the scores are read
+                    entry = [None, None, False]
+                    self.cache[element] = entry
+                    if len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+                        self.cache_stats["evictions"] += 1
+
+        add_key, remove_key = self.keys(element)[:2]
+        try:
+            # a cached pair merges the changes published after the read,
+            # so it must not be filled from a replica that lags behind
+            redis = self.redis if entry is not None else self.reader()
+            pipeline = redis.pipeline(transaction=False)
+            pipeline.zscore(add_key, element)
+            pipeline.zscore(remove_key, element)
+            add_timestamp, remove_timestamp = pipeline.execute()
+        except:
+            raise RuntimeError("An internal error occurs, e.g., disconnection from network. A retry may solve the problem. ")
+
+        if entry is not None:
+            with self.cache_lock:
+                if add_timestamp is not None and (entry[0] is None or entry[0] < add_timestamp):
+                    entry[0] = add_timestamp
+                if remove_timestamp is not None and (entry[1] is None or entry[1] < remove_timestamp):
+                    entry[1] = remove_timestamp
+                entry[2] = True
+                return self.__scores(entry[0], entry[1])
+        return self.__scores(add_timestamp, remove_timestamp)
+
+    def __scores(self, add_timestamp, remove_timestamp):
+        """Returns a pair of scores as timestamps of score_type"""
+        if self.score_type is float:
+            return add_timestamp, remove_timestamp
+        return (None if add_timestamp is None else int(add_timestamp),
+                None if remove_timestamp is None else int(remove_timestamp))
+
+    def __cache_merge(self, target_set, element, timestamp, published=False):
+        """Merges a changed entry into the cached pair of its element,
+        counting the published ones as updates"""
+        with self.cache_lock:
+            if published:
+                self.cache_stats["updates"] += 1
+            entry = self.cache.get(element)
+            if entry is not None:
+                i = self.key_kinds[target_set]
+                if entry[i] is None or entry[i] < timestamp:
+                    entry[i] = timestamp
+
+    def __run_listener(self):
+        """Merges the published changes into the cache until close()"""
+        while not self.closed:
+            pubsub = self.redis.pubsub()
+            try:
+                pubsub.subscribe(self.channel)
+                while not self.closed:
+                    message = pubsub.get_message(timeout=0.1)
+                    if message is None:
+                        continue
+                    if message["type"] == "subscribe":
+                        self.cache_ready.set()
+                        continue
+                    if message["type"] != "message":
+                        continue
+                    data = message["data"]
+                    if isinstance(data, bytes):
+                        data = data.decode("utf-8")
+                    target_set, timestamp, element = data.split(" ", 2)
+                    self.__cache_merge(target_set, element, float(timestamp), True)
+            except Exception:
+                # changes may have been missed while disconnected
+                self.cache_ready.clear()
+                with self.cache_lock:
+                    self.cache.clear()
+                time.sleep(0.1)
+            finally:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+        self.cache_ready.clear()
+
+    def close(self):
+        """Stops the cache listener and the get() threads, if any"""
+        self.closed = True
+        if self.cache is not None:
+            self.listener.join()
+        if self.executor is not None:
+            self.executor.shutdown()
     
     def get(self):
         """Returns an array of all existing elements in lww-set 
 
+        The existing elements are computed on the server by one script
+        call per bucket, and the buckets are read in parallel. For a
+        large set, iter_elements() avoids blocking the server and
+        holding the whole result in memory.
         """
-        result = []
-        all_add_elements = self.redis.zrange("lww_add_set", 0, -1)
-        for element in all_add_elements:
-            if self.exist(element):
-                result.append(element)
-        return result
+        try:
+            if self.executor is None:
+                return self.__get_bucket(self.buckets[0])
+            result = []
+            for elements in self.executor.map(self.__get_bucket, self.buckets):
+                result.extend(elements)
+            return result
+        except:
+            raise RuntimeError("An internal error occurs, e.g., disconnection from network. A retry may solve the problem. ")
+
+    def __get_bucket(self, keys):
+        return self.get_script(keys=list(keys), client=self.reader())
+
+    def iter_elements(self, batch_size=1000):
+        """Iterates over all existing elements in lww-set page by page
+
+        Each page is one ZSCAN step over an add set, filtered on the
+        server, so the client holds at most one page at a time. Buckets
+        are iterated one after the other. Like
+        ZSCAN, an element that is added or removed during the iteration
+        may or may not be returned, and an element may be returned more
+        than once if the set is modified during the iteration.
+
+        Keyword arguments:
+        batch_size -- the ZSCAN COUNT hint, i.e., about how many
+        elements of an add set are checked per round trip
+
+        Keyword raise:
+        RuntimeError -- An internal error occurs, e.g., disconnection
+        from network. A retry may solve the problem.
+        """
+        for keys in self.buckets:
+            cursor = 0
+            redis = self.reader()  # a cursor is only valid on its server
+            while True:
+                try:
+                    page = self.scan_script(keys=list(keys), args=[cursor, batch_size],
+                                            client=redis)
+                except:
+                    raise RuntimeError("An internal error occurs, e.g., disconnection from network. A retry may solve the problem. ")
+                cursor = int(page[0])
+                for element in page[1:]:
+                    yield element
+                if cursor == 0:
+                    break
+
+    def apply_ops(self, ops):
+        """Apply a batch of add and remove operations
+
+        The batch is sent in chunks of BATCH_SIZE operations, one script
+        call per bucket and one pipelined round trip per chunk, so the
+        memory held by the client and the server reply stay bounded.
+        Each chunk is
+        validated before it is sent. If a later chunk raises ValueError,
+        the earlier chunks remain applied, which is harmless since
+        operations are idempotent.
+
+        See base class LWW_set docstring for detals.
+        """
+        ops = iter(ops)
+        return_flag = True
+        while True:
+            chunk = list(islice(ops, self.BATCH_SIZE))
+            if not chunk:
+                break
+            bucket_args = {}  # keys -> script arguments
+            for op, element, timestamp in chunk:
+                op, element, timestamp = self.validate_op(op, element, timestamp)
+                keys = self.keys(element)
+                args = bucket_args.get(keys)
+                if args is None:
+                    args = bucket_args[keys] = [self.publish_channel, self.feed_length]
+                args.extend((op, repr(timestamp), element))
+            try:
+                pipeline = self.redis.pipeline(transaction=False)
+                for keys, args in bucket_args.items():
+                    self.apply_ops_script(keys=list(keys), args=args, client=pipeline)
+                pipeline.execute()
+            except:
+                return_flag = False
+                continue
+            if self.cache is not None:
+                for keys, args in bucket_args.items():
+                    for i in range(2, len(args), 3):
+                        target_set = keys[0] if args[i] == self.ADD else keys[1]
+                        self.__cache_merge(target_set, args[i + 2], float(args[i + 1]))
+
+        return return_flag
+
+    def count(self):
+        """Returns the number of existing elements in lww-set
+
+        The write scripts keep a counter per bucket, so this reads one
+        key per bucket in a single round trip. For sets written by an
+        older version without counters, call recount() once.
+
+        See base class LWW_set docstring for detals.
+        """
+        try:
+            pipeline = self.reader().pipeline(transaction=False)
+            for keys in self.buckets:
+                pipeline.get(keys[2])
+            return sum(int(count or 0) for count in pipeline.execute())
+        except:
+            raise RuntimeError("An internal error occurs, e.g., disconnection from network. A retry may solve the problem. ")
+
+    def recount(self):
+        """Recomputes the counters from the sets on the server
+
+        Each bucket is counted by one script call, which blocks the
+        server for O(n) of the bucket.
+        """
+        try:
+            return sum(self.recount_script(keys=list(keys)) for keys in self.buckets)
+        except:
+            raise RuntimeError("An internal error occurs, e.g., disconnection from network. A retry may solve the problem. ")
+
+    def changes(self, offsets=None, batch_size=1000):
+        """Returns a Stream_reader of the feed streams
+
+        Keyword arguments:
+        offsets -- stream key -> the ID of the last entry already read,
+        "$" for the entries added from now on and "0" for all kept
+        entries, e.g., the offsets of an earlier reader; None reads the
+        streams of all buckets from now on. On Redis Cluster, where one
+        XREAD cannot span slots, read each bucket with its own reader.
+        batch_size -- the maximum number of entries read per stream and
+        round trip
+
+        See base class LWW_set docstring for detals.
+        """
+        if offsets is None:
+            offsets = dict((keys[3], "$") for keys in self.buckets)
+        offsets = dict(offsets)
+        try:
+            # "$" is resolved once, so the entries added between two
+            # reads are not skipped
+            for key in offsets:
+                if offsets[key] == "$":
+                    last = self.redis.xrevrange(key, count=1)
+                    offsets[key] = last[0][0] if last else "0-0"
+        except:
+            raise RuntimeError("An internal error occurs, e.g., disconnection from network. A retry may solve the problem. ")
+        return Stream_reader(self.redis, offsets, batch_size, self.score_type)
+
+    def subscribe(self, callback, offsets=None):
+        """Calls callback with batches of the feed entries
+
+        offsets is the one of changes().
+
+        See base class LWW_set docstring for detals.
+        """
+        subscription = Subscription(self.changes(offsets), callback)
+        subscription.start()
+        return subscription
+
+    def get_range(self, start_timestamp, end_timestamp):
+        """Returns the existing elements added between two timestamps
+
+        The add set is the ZSET index of add timestamps, so the range is
+        read by rank on the server and removed elements are filtered
+        there. See QUERY_SCRIPT.
+
+        See base class LWW_set docstring for detals.
+        """
+        start_timestamp = self.validate_timestamp(start_timestamp)
+        end_timestamp = self.validate_timestamp(end_timestamp)
+        return self.__query(start_timestamp, end_timestamp, 0, -1, False)
+
+    def latest(self, n):
+        """Returns the n most recently added existing elements
+
+        See base class LWW_set docstring for detals.
+        """
+        n = self.validate_count(n)
+        return self.__query(float("-inf"), float("inf"), 0, n, True)
+
+    def select(self, offset, limit):
+        """Returns one page of the existing elements
+
+        The skipped elements are still walked on the server, so a page
+        costs O(log n + offset + limit).
+
+        See base class LWW_set docstring for detals.
+        """
+        offset = self.validate_count(offset)
+        limit = self.validate_count(limit)
+        return self.__query(float("-inf"), float("inf"), offset, limit, False)
+
+    def __query(self, start_timestamp, end_timestamp, offset, limit, reverse):
+        """Runs QUERY_SCRIPT on every bucket and merges the results
+
+        A bucket cannot skip offset elements on its own, so with several
+        buckets each one returns its first offset + limit elements, and
+        the offset is applied to the merged result.
+        """
+        if len(self.buckets) == 1:
+            bucket_offset, bucket_limit = offset, limit
+        else:
+            bucket_offset, bucket_limit = 0, (-1 if limit < 0 else offset + limit)
+        args = [repr(start_timestamp), repr(end_timestamp), bucket_offset, bucket_limit,
+                1 if reverse else 0]
+
+        def query(keys):
+            page = self.query_script(keys=list(keys), args=args, client=self.reader())
+            return [(float(page[i + 1]), page[i]) for i in range(0, len(page), 2)]
+
+        try:
+            if self.executor is None:
+                pairs = query(self.buckets[0])
+            else:
+                pairs = list(merge(*self.executor.map(query, self.buckets), reverse=reverse))
+                pairs = pairs[offset:] if limit < 0 else pairs[offset:offset + limit]
+        except:
+            raise RuntimeError("An internal error occurs, e.g., disconnection from network. A retry may solve the problem. ")
+        return [element for _, element in pairs]
+
+    def watermark(self):
+        """Returns the tuple of the sequence keys of the buckets
+
+        Read from redis, like delta_since(), since a replica may not
+        hold every change numbered by the watermark yet.
+
+        See base class LWW_set docstring for detals.
+        """
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            for keys in self.buckets:
+                pipeline.get(keys[5])
+            return tuple(int(sequence or 0) for sequence in pipeline.execute())
+        except:
+            raise RuntimeError("An internal error occurs, e.g., disconnection from network. A retry may solve the problem. ")
+
+    def delta_since(self, watermark=None):
+        """Iterates over the entries changed after a watermark
+
+        With a watermark, the changed set of every bucket is paged by
+        sequence number by DELTA_SCRIPT, BATCH_SIZE elements per call,
+        so a page costs O(log n + BATCH_SIZE) and an element changed
+        again during the iteration moves to a later page instead of
+        being skipped. Without a watermark, the add and remove sets are
+        walked with ZSCAN, which returns every entry that exists during
+        the whole iteration, including those of sets written before the
+        changed sets were kept. Both read redis, not the replicas.
+        Elements are returned as str, see decode_element(), so that
+        another lww-set can apply them. The watermark is validated by
+        the call, and the pages are read as they are iterated.
+
+        See base class LWW_set docstring for detals.
+        """
+        if watermark is None:
+            return self.__all_entries()
+        if not isinstance(watermark, tuple) or len(watermark) != len(self.buckets):
+            raise ValueError("watermark must be a watermark() of this set!")
+        try:
+            watermark = [int(since) for since in watermark]
+        except (TypeError, ValueError):
+            raise ValueError("watermark must be a watermark() of this set!")
+        return self.__changed_entries(watermark)
+
+    def __all_entries(self):
+        """Yields every entry of the buckets by ZSCAN"""
+        for keys in self.buckets:
+            for op, target_set in ((self.ADD, keys[0]), (self.REMOVE, keys[1])):
+                for entry in self.__scan_entries(op, target_set):
+                    yield entry
+
+    def __changed_entries(self, watermark):
+        """Yields the entries changed after the sequences of the buckets"""
+        score_type = self.score_type
+        for keys, since in zip(self.buckets, watermark):
+            while True:
+                try:
+                    page = self.delta_script(keys=list(keys), args=[since, self.BATCH_SIZE])
+                except:
+                    raise RuntimeError("An internal error occurs, e.g., disconnection from network. A retry may solve the problem. ")
+                for i in range(0, len(page), 4):
+                    element = decode_element(page[i + 1])
+                    if page[i + 2] is not None:
+                        yield self.ADD, element, score_type(float(page[i + 2]))
+                    if page[i + 3] is not None:
+                        yield self.REMOVE, element, score_type(float(page[i + 3]))
+                if len(page) < 4 * self.BATCH_SIZE:
+                    break
+                since = int(page[-4])
+
+    def __scan_entries(self, op, target_set):
+        """Yields the (op, element, timestamp) entries of a ZSET by ZSCAN"""
+        score_type = self.score_type
+        cursor = 0
+        while True:
+            try:
+                cursor, page = self.redis.zscan(target_set, cursor, count=self.BATCH_SIZE)
+            except:
+                raise RuntimeError("An internal error occurs, e.g., disconnection from network. A retry may solve the problem. ")
+            for element, timestamp in page:
+                yield op, decode_element(element), score_type(timestamp)
+            if int(cursor) == 0:
+                break
+
+    def compact(self, horizon_timestamp, slice_size=1000):
+        """Garbage collect redundant entries of add_set and remove_set
+
+        Each remove set is walked with ZSCAN, and each page is checked
+        and compacted atomically by one script call. The reported bytes
+        are the member and score sizes of the dropped entries, not
+        counting redis' own per-entry overhead.
+
+        See base class LWW_set docstring for detals.
+        """
+        horizon_timestamp = self.validate_timestamp(horizon_timestamp)
+        stats = {"add_entries": 0, "remove_entries": 0, "bytes": 0}
+
+        for keys in self.buckets:
+            cursor = 0
+            while True:
+                try:
+                    cursor, entries = self.redis.zscan(keys[1], cursor, count=slice_size)
+                    if entries:
+                        args = [repr(horizon_timestamp)]
+                        args.extend(element for element, _ in entries)
+                        dropped = self.compact_script(keys=list(keys), args=args)
+                        stats["add_entries"] += dropped[0]
+                        stats["remove_entries"] += dropped[1]
+                        stats["bytes"] += dropped[2]
+                except:
+                    raise RuntimeError("An internal error occurs, e.g., disconnection from network. A retry may solve the problem. ")
+                if int(cursor) == 0:
+                    break
+
+        return stats
@@ -0,0 +1,278 @@
+import asyncio
+from itertools import islice
+from lww_interface import LWW_set
+from lww_redis import (TEST_AND_ADD_SCRIPT, APPLY_OPS_SCRIPT, GET_SCRIPT,
+                       SCAN_SCRIPT, EXIST_MANY_SCRIPT, LWW_redis, bucket_keys,
+                       bucket_index)
+
+class AsyncLWW_redis(LWW_set):
+    """An asyncio Last-Writer-Win element set based on redis ZSET.
+
+    The asyncio counterpart of LWW_redis: it shares the same keys,
+    namespaces, buckets and server-side scripts, so both can be used on
+    the same set, but
+    add(), remove(), exist(), get() and apply_ops() are coroutines and
+    never block the event loop. Connections come from the pool of the
+    asyncio redis client.
+
+    exist() calls are coalesced: all calls made while the event loop is
+    busy with other ready tasks are checked together by one script call
+    (in chunks of BATCH_SIZE elements), instead of two ZSCORE round
+    trips per call. Requests to different buckets run concurrently.
+
+    Keyword attributes:
+    redis -- a redis.asyncio client, e.g., redis.asyncio.StrictRedis
+    namespace -- see LWW_redis
+    n_buckets -- see LWW_redis
+    int_timestamps -- see LWW_redis
+    clock -- see LWW_redis
+    feed_length -- see LWW_redis; the feed is read with
+    LWW_redis.changes()
+    publish -- publish the changes for the exist() caches of LWW_redis
+    clients; see LWW_redis for publish=False
+    """
+    BATCH_SIZE = 1000  # operations or elements sent per script call
+    MIN_INT_TIMESTAMP = LWW_redis.MIN_INT_TIMESTAMP
+    MAX_INT_TIMESTAMP = LWW_redis.MAX_INT_TIMESTAMP
+
+    def __init__(self, redis, namespace="lww", n_buckets=1, int_timestamps=False,
+                 clock=None, feed_length=0, publish=True):
+        self.redis = redis
+        self.clock = clock
+        if int_timestamps:
+            self.use_int_timestamps()
+        self.namespace = namespace
+        self.buckets = bucket_keys(namespace, n_buckets)
+        self.channel = "%s_changes" % namespace
+        self.publish_channel = self.channel if publish else ""
+        self.feed_length = str(int(feed_length))
+        self.test_and_add_script = self.redis.register_script(TEST_AND_ADD_SCRIPT)
+        self.apply_ops_script = self.redis.register_script(APPLY_OPS_SCRIPT)
+        self.get_script = self.redis.register_script(GET_SCRIPT)
+        self.scan_script = self.redis.register_script(SCAN_SCRIPT)
+        self.exist_many_script = self.redis.register_script(EXIST_MANY_SCRIPT)
+        self.pending_exist = {}  # element -> futures waiting for it
+        # the running exist() batches; the event loop keeps only weak
+        # references to tasks, so a batch must be referenced until done
+        self.exist_tasks = set()
+
+    def keys(self, element):
+        """Returns the bucket_keys() of a validated element"""
+        return self.buckets[bucket_index(element, len(self.buckets))]
+
+    @classmethod
+    def from_url(cls, url, max_connections=50, **kwargs):
+        """Creates a set with its own client, e.g., from
+        "redis://localhost:6379/0"
+
+        The client uses a blocking connection pool, so that a burst of
+        coroutines waits for one of max_connections connections instead
+        of failing. Extra keyword arguments are passed to the pool.
+        """
+        import redis.asyncio
+        pool = redis.asyncio.BlockingConnectionPool.from_url(url, max_connections=max_connections, **kwargs)
+        return cls(redis.asyncio.StrictRedis(connection_pool=pool))
+
+    async def add(self, element, timestamp=None):
+        """Add an element to lww_set, or update the existing element timestamp
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+        timestamp = self.write_timestamp(timestamp)
+        try:
+            await self.test_and_add_script(keys=list(self.keys(element)),
+                                           args=[self.ADD, repr(timestamp), element, self.publish_channel,
+                                                 self.feed_length])
+        except Exception:
+            return False
+        return True
+
+    async def remove(self, element, timestamp=None):
+        """Remove an element from lww_set
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+        timestamp = self.write_timestamp(timestamp)
+        try:
+            await self.test_and_add_script(keys=list(self.keys(element)),
+                                           args=[self.REMOVE, repr(timestamp), element, self.publish_channel,
+                                                 self.feed_length])
+        except Exception:
+            return False
+        return True
+
+    async def apply_ops(self, ops):
+        """Apply a batch of add and remove operations
+
+        See LWW_redis.apply_ops() for detals.
+        """
+        ops = iter(ops)
+        return_flag = True
+        while True:
+            chunk = list(islice(ops, self.BATCH_SIZE))
+            if not chunk:
+                break
+            bucket_args = {}  # keys -> script arguments
+            for op, element, timestamp in chunk:
+                op, element, timestamp = self.validate_op(op, element, timestamp)
+                keys = self.keys(element)
+                args = bucket_args.get(keys)
+                if args is None:
+                    args = bucket_args[keys] = [self.publish_channel, self.feed_length]
+                args.extend((op, repr(timestamp), element))
+            results = await asyncio.gather(
+                *[self.apply_ops_script(keys=list(keys), args=args)
+                  for keys, args in bucket_args.items()],
+                return_exceptions=True)
+            if any(isinstance(result, Exception) for result in results):
+                return_flag = False
+        return return_flag
+
+    async def merge(self, other, watermark=None):
+        """Merge the state of another replica into this lww-set
+
+        other is a synchronous lww-set, e.g., an LWW_python or an
+        LWW_redis, whose delta is applied by apply_ops().
+
+        See base class LWW_set docstring for detals.
+        """
+        return await self.apply_ops(other.delta_since(watermark))
+
+    async def add_many(self, pairs):
+        return await self.apply_ops((self.ADD, element, timestamp)
+                                    for element, timestamp in pairs)
+
+    async def remove_many(self, pairs):
+        return await self.apply_ops((self.REMOVE, element, timestamp)
+                                    for element, timestamp in pairs)
+
+    async def exist(self, element):
+        """Check if the element exists in lww-set
+
+        The check is queued and sent with the other exist() calls made
+        in the same event loop iteration.
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not self.pending_exist:
+            # runs after the tasks that are ready now had their turn
+            loop.call_soon(self.__flush_exist)
+        self.pending_exist.setdefault(element, []).append(future)
+        if len(self.pending_exist) >= self.BATCH_SIZE:
+            self.__flush_exist()
+        return await future
+
+    async def exist_many(self, elements):
+        """Check which of many elements exist in lww-set
+
+        Elements are sent in chunks of BATCH_SIZE, one script call per
+        bucket, and all calls run concurrently.
+
+        See base class LWW_set docstring for detals.
+        """
+        validate_element = self.validate_element
+        elements = [validate_element(element) for element in elements]
+        calls = []  # (positions, script call)
+        for start in range(0, len(elements), self.BATCH_SIZE):
+            bucket_positions = {}  # keys -> positions in elements
+            for position in range(start, min(start + self.BATCH_SIZE, len(elements))):
+                bucket_positions.setdefault(self.keys(elements[position]), []).append(position)
+            for keys, positions in bucket_positions.items():
+                calls.append((positions, self.exist_many_script(
+                    keys=list(keys), args=[elements[position] for position in positions])))
+        try:
+            replies = await asyncio.gather(*[call for _, call in calls])
+        except Exception:
+            raise RuntimeError("An internal error occurs, e.g., disconnection from network. A retry may solve the problem. ")
+        result = [False] * len(elements)
+        for (positions, _), reply in zip(calls, replies):
+            for position, flag in zip(positions, reply):
+                result[position] = bool(flag)
+        return result
+
+    async def exist_mask(self, elements):
+        """Returns exist_many() as a NumPy boolean array
+
+        See base class LWW_set docstring for detals.
+        """
+        import numpy
+        return numpy.array(await self.exist_many(elements), dtype=bool)
+
+    def __flush_exist(self):
+        if self.pending_exist:
+            batch, self.pending_exist = self.pending_exist, {}
+            task = asyncio.ensure_future(self.__exist_batch(batch))
+            self.exist_tasks.add(task)
+            task.add_done_callback(self.exist_tasks.discard)
+
+    async def __exist_batch(self, batch):
+        bucket_elements = {}  # keys -> elements
+        for element in batch:
+            bucket_elements.setdefault(self.keys(element), []).append(element)
+        await asyncio.gather(*[self.__exist_bucket(keys, elements, batch)
+                               for keys, elements in bucket_elements.items()])
+
+    async def __exist_bucket(self, keys, elements, batch):
+        try:
+            flags = await self.exist_many_script(keys=list(keys), args=elements)
+        except Exception:
+            error = RuntimeError("An internal error occurs, e.g., disconnection from network. A retry may solve the problem. ")
+            for element in elements:
+                for future in batch[element]:
+                    if not future.done():
+                        future.set_exception(error)
+            return
+        for element, flag in zip(elements, flags):
+            for future in batch[element]:
+                if not future.done():
+                    future.set_result(bool(flag))
+
+    async def count(self):
+        """Returns the number of existing elements in lww-set
+
+        See LWW_redis.count() for detals.
+        """
+        try:
+            counts = await asyncio.gather(*[self.redis.get(keys[2])
+                                            for keys in self.buckets])
+        except Exception:
+            raise RuntimeError("An internal error occurs, e.g., disconnection from network. A retry may solve the problem. ")
+        return sum(int(count or 0) for count in counts)
+
+    async def get(self):
+        """Returns an array of all existing elements in lww-set
+
+        See LWW_redis.get() for detals.
+        """
+        try:
+            pages = await asyncio.gather(*[self.get_script(keys=list(keys))
+                                           for keys in self.buckets])
+        except Exception:
+            raise RuntimeError("An internal error occurs, e.g., disconnection from network. A retry may solve the problem. ")
+        result = []
+        for page in pages:
+            result.extend(page)
+        return result
+
+    async def iter_elements(self, batch_size=1000):
+        """Asynchronously iterates over all existing elements in lww-set
+
+        See LWW_redis.iter_elements() for detals.
+        """
+        for keys in self.buckets:
+            cursor = 0
+            while True:
+                try:
+                    page = await self.scan_script(keys=list(keys), args=[cursor, batch_size])
+                except Exception:
+                    raise RuntimeError("An internal error occurs, e.g., disconnection from network. A retry may solve the problem. ")
+                cursor = int(page[0])
+                for element in page[1:]:
+                    yield element
+                if cursor == 0:
+                    break
@@ -0,0 +1,118 @@
+"""unit tests for the lww_redis_async"""
+
+import asyncio
+import unittest
+import redis
+import redis.asyncio
+from lww_redis_async import AsyncLWW_redis as LWW_set
+from lww_python import LWW_python
+from lww_redis import LWW_redis
+
+class Test_LWW_Redis_Async(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.r = redis.asyncio.StrictRedis(host='localhost', port=6379, db=0)
+        await self.r.delete(*LWW_set(self.r).buckets[0])
+
+    async def asyncTearDown(self):
+        await self.r.delete(*LWW_set(self.r).buckets[0])
+        await self.r.aclose()
+
+    async def test_string_add_remove(self):
+        lww = LWW_set(self.r)
+        a = "s1"
+        b = "s22"
+        await lww.add(a, 1)
+        self.assertTrue(await lww.exist(a))
+        self.assertFalse(await lww.exist(b))
+        await lww.add(b, 1)
+        await lww.remove(a, 2)
+        self.assertTrue(await lww.exist(b))
+        self.assertFalse(await lww.exist(a))
+        self.assertEqual(await lww.get(), [b])
+
+    async def test_table(self):
+        """The cases of the README table"""
+        cases = [("add", 1, "add", 0, True), ("add", 1, "add", 1, True),
+                 ("add", 1, "add", 2, True), ("remove", 1, "add", 0, False),
+                 ("remove", 1, "add", 1, True), ("remove", 1, "add", 2, True),
+                 ("remove", 1, "remove", 0, False), ("remove", 1, "remove", 1, False),
+                 ("remove", 1, "remove", 2, False), ("add", 1, "remove", 0, True),
+                 ("add", 1, "remove", 1, True), ("add", 1, "remove", 2, False)]
+        lww = LWW_set(self.r)
+        for i, (op1, timestamp1, op2, timestamp2, exists) in enumerate(cases):
+            await lww.apply_ops([(op1, i, timestamp1), (op2, i, timestamp2)])
+            self.assertEqual(await lww.exist(i), exists)
+
+    async def test_coalesced_exist(self):
+        lww = LWW_set(self.r)
+        await lww.add_many((i, 2) for i in range(100))
+        await lww.remove_many((i, 1 + i % 2 * 2) for i in range(100))
+        calls = []
+        script = lww.exist_many_script
+
+        async def counting_script(**kwargs):
+            calls.append(len(kwargs["args"]))
+            return await script(**kwargs)
+        lww.exist_many_script = counting_script
+
+        elements = list(range(200)) + list(range(50))
+        flags = await asyncio.gather(*[lww.exist(i) for i in elements])
+        self.assertEqual(flags, [i < 100 and i % 2 == 0 for i in elements])
+        self.assertEqual(calls, [200])  # one script call, duplicates merged
+        await asyncio.sleep(0.01)  # the batch task finishes after its futures
+        self.assertEqual(lww.exist_tasks, set())
+
+    async def test_merge(self):
+        lww = LWW_set(self.r)
+        replica = LWW_python()
+        replica.add_many([("a", 1), ("b", 1)])
+        replica.remove("a", 2)
+        self.assertTrue(await lww.merge(replica))
+        self.assertEqual(await lww.get(), ["b"])
+
+    async def test_buckets(self):
+        lww = LWW_set(self.r, namespace="test_buckets", n_buckets=4)
+        keys = [key for pair in lww.buckets for key in pair]
+        try:
+            await lww.add_many((i, 2) for i in range(100))
+            await lww.remove_many((i, 1 + i % 2 * 2) for i in range(100))
+            expected_arr = [str(i) for i in range(0, 100, 2)]
+            flags = await asyncio.gather(*[lww.exist(i) for i in range(100)])
+            self.assertEqual(flags, [i % 2 == 0 for i in range(100)])
+            self.assertEqual(await lww.count(), 50)
+            lww.BATCH_SIZE = 7
+            self.assertEqual(await lww.exist_many(range(-5, 105)),
+                             [0 <= i < 100 and i % 2 == 0 for i in range(-5, 105)])
+            self.assertEqual(sorted(await lww.get(), key=int), expected_arr)
+            self.assertEqual(sorted([element async for element in lww.iter_elements()], key=int),
+                             expected_arr)
+        finally:
+            await self.r.delete(*keys)
+
+    async def test_iter_elements(self):
+        lww = LWW_set(self.r)
+        await lww.add_many((i, 1) for i in range(50))
+        await lww.remove(3, 2)
+        elements = [element async for element in lww.iter_elements(batch_size=10)]
+        self.assertEqual(sorted(elements), sorted(str(i) for i in range(50) if i != 3))
+
+    async def test_cache_sees_writes(self):
+        """Writes publish by default, so the caches of LWW_redis see them"""
+        cached = LWW_redis(redis.StrictRedis(host='localhost', port=6379, db=0), cache_size=10)
+        try:
+            while not cached.cache_ready.is_set():
+                await asyncio.sleep(0.01)
+            self.assertFalse(cached.exist("a"))
+            await LWW_set(self.r).add("a", 1)
+            for _ in range(500):
+                if cached.exist("a"):
+                    break
+                await asyncio.sleep(0.01)
+            self.assertTrue(cached.exist("a"))
+            self.assertEqual(cached.cache_stats["misses"], 1)
+        finally:
+            cached.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
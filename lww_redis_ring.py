@@ -0,0 +1,295 @@
+import hashlib
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+from lww_interface import LWW_set
+from lww_redis import LWW_redis, pooled_client
+
+
+def ring_hash(key):
+    """Returns the position of a str or bytes key on the ring, in
+    [0, 2 ** 64)
+
+    MD5, as in ketama, spreads the points of the nodes evenly and is
+    independent of the CRC32 that picks the bucket inside a node. A str
+    is hashed as its UTF-8 bytes, so the elements a node returns as
+    bytes, from a client without decode_responses, hash to the same
+    position as their str.
+    """
+    if not isinstance(key, bytes):
+        key = key.encode("utf-8", "surrogatepass")
+    return int.from_bytes(hashlib.md5(key).digest()[:8], "big")
+
+
+class LWW_redis_ring(LWW_set):
+    """A Last-Writer-Win element set consistent-hashed over independent
+    redis servers.
+
+    Each node owns the elements that hash to the arcs of the ring before
+    its vnodes points, and stores them as an ordinary LWW_redis, so
+    writes of different nodes never meet on one server and the write
+    capacity grows with the number of nodes. Both entries of an element
+    are on its node. Reads and writes of one element go to its node,
+    batches are split by node and sent to the nodes in parallel, and
+    get(), count() and compact() combine all nodes. The ordered queries
+    use the LWW_set defaults over delta_since(), and changes() is read
+    per node, e.g., nodes[name].changes().
+
+    Adding or removing a node moves only the elements of the arcs it
+    takes or gives back, about 1 / len(nodes) of them. Once every client
+    uses the new list of nodes, rebalance() moves those entries to their
+    new node; until then, they are missing from reads. Every client of a
+    set must use the same node names and vnodes.
+
+    Keyword attributes:
+    nodes -- node name -> a redis client, or an LWW_redis for options of
+    its own, e.g., read_redis; the name, not the address, places a node
+    on the ring
+    vnodes -- the number of points of each node on the ring
+    trusted -- skip argument validation, see LWW_set.trust_arguments()
+    int_timestamps -- use int timestamps, see LWW_redis
+    clock -- stamps writes without a timestamp, see lww_clock
+    kwargs -- passed to the LWW_redis of every node given as a client,
+    e.g., namespace, n_buckets, cache_size or feed_length
+    """
+    BATCH_SIZE = 1000  # operations per node and round trip of apply_ops()
+    MIN_INT_TIMESTAMP = LWW_redis.MIN_INT_TIMESTAMP
+    MAX_INT_TIMESTAMP = LWW_redis.MAX_INT_TIMESTAMP
+
+    def __init__(self, nodes, vnodes=160, trusted=False, int_timestamps=False, clock=None,
+                 **kwargs):
+        if not nodes:
+            raise ValueError("An lww-set ring needs at least one node")
+        self.clock = clock
+        self.nodes = {}
+        for name, node in nodes.items():
+            if not isinstance(node, LWW_redis):
+                node = LWW_redis(node, int_timestamps=int_timestamps, **kwargs)
+            node.trust_arguments()  # validated once by the ring
+            self.nodes[name] = node
+        self.vnodes = vnodes
+        points = sorted((ring_hash("%s#%d" % (name, i)), name)
+                        for name in self.nodes for i in range(vnodes))
+        self.points = [point for point, _ in points]
+        self.owners = [self.nodes[name] for _, name in points]
+        self.executor = ThreadPoolExecutor(len(self.nodes))
+        if int_timestamps:
+            LWW_set.use_int_timestamps(self)
+        if trusted:
+            self.trust_arguments()
+
+    @classmethod
+    def from_urls(cls, urls, max_connections=50, pool_options=None, **kwargs):
+        """Creates a ring of the servers of some URLs, named by their URL
+
+        See LWW_redis.from_url() for the connection pools. Other keyword
+        arguments are the ones of LWW_redis_ring().
+        """
+        return cls(dict((url, pooled_client(url, max_connections, pool_options)) for url in urls),
+                   **kwargs)
+
+    def use_int_timestamps(self):
+        """Switches the set and its nodes to int timestamps
+
+        See base class LWW_set docstring for detals.
+        """
+        for node in self.nodes.values():
+            node.use_int_timestamps()
+            node.trust_arguments()
+        LWW_set.use_int_timestamps(self)
+
+    def node(self, element):
+        """Returns the LWW_redis of a validated element"""
+        return self.owners[bisect_right(self.points, ring_hash(element)) % len(self.owners)]
+
+    def add(self, element, timestamp=None):
+        """Add an element to lww_set, or update the existing element timestamp
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+        timestamp = self.write_timestamp(timestamp)
+        return self.node(element).add(element, timestamp)
+
+    def remove(self, element, timestamp=None):
+        """Remove an element from lww_set
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+        timestamp = self.write_timestamp(timestamp)
+        return self.node(element).remove(element, timestamp)
+
+    def exist(self, element):
+        """Check if the element exists in lww-set
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+        return self.node(element).exist(element)
+
+    def exist_many(self, elements):
+        """Check which of many elements exist in lww-set
+
+        Elements are grouped by node, and the nodes check their groups
+        in parallel.
+
+        See base class LWW_set docstring for detals.
+        """
+        validate_element = self.validate_element
+        elements = [validate_element(element) for element in elements]
+        node_positions = {}  # node -> positions in elements
+        for position, element in enumerate(elements):
+            node_positions.setdefault(self.node(element), []).append(position)
+
+        def exist_many(node):
+            return node.exist_many([elements[position] for position in node_positions[node]])
+
+        result = [False] * len(elements)
+        for node, flags in zip(node_positions, self.executor.map(exist_many, node_positions)):
+            for position, flag in zip(node_positions[node], flags):
+                result[position] = flag
+        return result
+
+    def timestamps(self, element):
+        """Returns the add and remove timestamps of an element
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+        return self.node(element).timestamps(element)
+
+    def count(self):
+        """Returns the number of existing elements in lww-set
+
+        See base class LWW_set docstring for detals.
+        """
+        return sum(self.executor.map(lambda node: node.count(), self.nodes.values()))
+
+    def get(self):
+        """Returns an array of all existing elements in lww-set, read
+        from the nodes in parallel
+
+        See base class LWW_set docstring for detals.
+        """
+        result = []
+        for elements in self.executor.map(lambda node: node.get(), self.nodes.values()):
+            result.extend(elements)
+        return result
+
+    def iter_elements(self, batch_size=1000):
+        """Iterates over all existing elements in lww-set, node by node
+
+        See base class LWW_set docstring for detals.
+        """
+        for node in self.nodes.values():
+            for element in node.iter_elements(batch_size):
+                yield element
+
+    def apply_ops(self, ops):
+        """Apply a batch of add and remove operations
+
+        Operations are validated and split by node in chunks, and the
+        nodes apply their parts of a chunk in parallel. See
+        LWW_redis.apply_ops() for a failed chunk.
+
+        See base class LWW_set docstring for detals.
+        """
+        ops = iter(ops)
+        return_flag = True
+        while True:
+            chunk = list(islice(ops, self.BATCH_SIZE * len(self.nodes)))
+            if not chunk:
+                break
+            batches = {}  # node -> operations
+            for op, element, timestamp in chunk:
+                op, element, timestamp = self.validate_op(op, element, timestamp)
+                batches.setdefault(self.node(element), []).append((op, element, timestamp))
+            if not all(self.executor.map(lambda node: node.apply_ops(batches[node]), batches)):
+                return_flag = False
+        return return_flag
+
+    def watermark(self):
+        """Returns the dict of the watermarks of the nodes, by node name
+
+        See base class LWW_set docstring for detals.
+        """
+        return dict((name, node.watermark()) for name, node in self.nodes.items())
+
+    def delta_since(self, watermark=None):
+        """Iterates over the entries changed after a watermark, node by node
+
+        A node missing from the watermark, e.g., one added since,
+        returns all of its entries. The watermarks of the nodes are
+        validated by the call, and the nodes are read as they are
+        iterated.
+
+        See base class LWW_set docstring for detals.
+        """
+        if watermark is None:
+            watermark = {}
+        elif not isinstance(watermark, dict):
+            raise ValueError("watermark must be a watermark() of this set!")
+        return chain.from_iterable([node.delta_since(watermark.get(name))
+                                    for name, node in self.nodes.items()])
+
+    def compact(self, horizon_timestamp, slice_size=1000):
+        """Garbage collect redundant entries, node by node
+
+        See base class LWW_set docstring for detals.
+        """
+        horizon_timestamp = self.validate_timestamp(horizon_timestamp)
+        stats = {"add_entries": 0, "remove_entries": 0, "bytes": 0}
+        for node in self.nodes.values():
+            node_stats = node.compact(horizon_timestamp, slice_size)
+            for key in stats:
+                stats[key] += node_stats[key]
+        return stats
+
+    def rebalance(self):
+        """Moves the entries a node holds for elements of other nodes
+
+        The entries of each node are merged into their owners, and then
+        dropped from the node. Call it after the list of nodes changed,
+        once every client uses the new list; an entry written to its
+        old node by a client still using the old list is lost.
+
+        Keyword returns:
+        the number of moved entries
+
+        Keyword raise:
+        RuntimeError -- An internal error occurs, e.g., disconnection
+        from network. A retry may solve the problem.
+        """
+        moved = 0
+        for node in self.nodes.values():
+            misplaced = [(op, element, timestamp) for op, element, timestamp in node.delta_since()
+                         if self.node(element) is not node]
+            if not misplaced:
+                continue
+            if not self.apply_ops(misplaced):
+                raise RuntimeError("An internal error occurs, e.g., disconnection from network. A retry may solve the problem. ")
+            try:
+                pipeline = node.redis.pipeline(transaction=False)
+                for op, element, _ in misplaced:
+                    keys = node.keys(element)
+                    pipeline.zrem(keys[0] if op == self.ADD else keys[1], element)
+                    pipeline.zrem(keys[4], element)  # no entry of it left
+                pipeline.execute()
+            except:
+                raise RuntimeError("An internal error occurs, e.g., disconnection from network. A retry may solve the problem. ")
+            node.recount()
+            moved += len(misplaced)
+        return moved
+
+    def close(self):
+        """Closes the LWW_redis of every node"""
+        for node in self.nodes.values():
+            node.close()
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,132 @@
+"""unit tests for the lww_redis_ring"""
+
+import unittest
+import redis
+from lww_redis import LWW_redis, decode_element
+from lww_redis_ring import LWW_redis_ring, ring_hash
+
+# databases 1 to 3 stand in for independent servers
+nodes = dict(("node%d" % db, redis.StrictRedis(host='localhost', port=6379, db=db))
+             for db in (1, 2, 3))
+NAMESPACE = "test_ring"
+
+
+def clear():
+    for client in nodes.values():
+        lww = LWW_redis(client, namespace=NAMESPACE, n_buckets=2)
+        client.delete(*[key for keys in lww.buckets for key in keys])
+        lww.close()
+
+
+class Test_LWW_Redis_Ring(unittest.TestCase):
+    def setUp(self):
+        clear()
+        self.ring = LWW_redis_ring(nodes, namespace=NAMESPACE, n_buckets=2)
+
+    def tearDown(self):
+        self.ring.close()
+        clear()
+
+    def test_add_remove(self):
+        lww = self.ring
+        lww.add_many((i, 2) for i in range(300))
+        lww.remove_many((i, 1 + i % 2 * 2) for i in range(300))
+        lww.add("x", 1)
+        self.assertTrue(lww.exist("x"))
+        self.assertTrue(lww.exist(0))
+        self.assertFalse(lww.exist(1))
+        self.assertFalse(lww.exist("y"))
+        self.assertEqual(lww.timestamps(1), (2, 3))
+        expected = sorted([str(i) for i in range(0, 300, 2)] + ["x"])
+        self.assertEqual(sorted(lww.get()), expected)
+        self.assertEqual(sorted(lww.iter_elements(batch_size=10)), expected)
+        self.assertEqual(lww.count(), 151)
+        self.assertEqual(lww.exist_many(["x", 1, 2, "y"]), [True, False, True, False])
+        self.assertEqual(len(list(lww.delta_since())), 601)
+        self.assertEqual(lww.get_range(0, 1), ["x"])
+        self.assertEqual(lww.compact(10)["add_entries"], 150)
+        self.assertEqual(lww.count(), 151)
+        watermark = lww.watermark()
+        lww.add("y", 0)
+        self.assertEqual(list(lww.delta_since(watermark)), [(LWW_redis.ADD, "y", 0)])
+        self.assertRaises(ValueError, lww.delta_since, 7)
+        self.assertRaises(ValueError, lww.delta_since, {"node1": 7})
+
+    def test_spread(self):
+        lww = self.ring
+        lww.add_many((i, 1) for i in range(3000))
+        counts = [node.count() for node in lww.nodes.values()]
+        self.assertEqual(sum(counts), 3000)
+        self.assertTrue(min(counts) > 700, counts)
+        # every element is on its node only
+        for name, node in lww.nodes.items():
+            for element in node.get():
+                self.assertTrue(lww.node(element) is node)
+
+    def test_rebalance(self):
+        """A third node takes about a third of the entries"""
+        two = LWW_redis_ring(dict((name, nodes[name]) for name in ("node1", "node2")),
+                             namespace=NAMESPACE, n_buckets=2)
+        try:
+            two.add_many((i, 1) for i in range(2000))
+            two.remove_many((i, 2) for i in range(0, 2000, 2))
+        finally:
+            two.close()
+        lww = self.ring
+        self.assertEqual(lww.count(), 1000)
+        self.assertTrue(lww.exist_many(range(2000)).count(True) < 1000)
+        moved = lww.rebalance()
+        self.assertTrue(3000 * 0.2 < moved < 3000 * 0.45, moved)
+        self.assertEqual(lww.exist_many(range(2000)), [i % 2 == 1 for i in range(2000)])
+        self.assertEqual(lww.count(), 1000)
+        self.assertEqual(len(list(lww.delta_since())), 3000)
+        self.assertEqual(lww.rebalance(), 0)
+
+    def test_rebalance_bytes(self):
+        """Entries read back as bytes move as their str elements"""
+        raw_nodes = dict((name, redis.StrictRedis(host='localhost', port=6379, db=db,
+                                                  decode_responses=False))
+                         for name, db in (("node1", 1), ("node2", 2), ("node3", 3)))
+        one = LWW_redis_ring({"node1": raw_nodes["node1"]}, namespace=NAMESPACE, n_buckets=2)
+        try:
+            one.add_many((i, 1) for i in range(50))
+            one.add(u"élément", 1)
+            one.remove(0, 2)
+        finally:
+            one.close()
+        with LWW_redis_ring(raw_nodes, namespace=NAMESPACE, n_buckets=2) as lww:
+            self.assertTrue(lww.rebalance() > 0)
+            self.assertEqual(lww.exist_many(range(50)), [i != 0 for i in range(50)])
+            self.assertTrue(lww.exist(u"élément"))
+            self.assertEqual(lww.count(), 50)
+            self.assertEqual(sorted(decode_element(element) for element in lww.get()),
+                             sorted([str(i) for i in range(1, 50)] + [u"élément"]))
+            self.assertEqual(lww.rebalance(), 0)
+
+    def test_bytes_elements(self):
+        """Elements read back as bytes hash to the node of their str"""
+        self.assertEqual(ring_hash(b"x"), ring_hash("x"))
+        self.assertEqual(ring_hash(u"élément".encode("utf-8")), ring_hash(u"élément"))
+        lww = self.ring
+        lww.add_many((i, 1) for i in range(100))
+        for name, node in lww.nodes.items():
+            for _, element, _ in node.delta_since():
+                self.assertTrue(lww.node(element) is node)
+        self.assertEqual(lww.rebalance(), 0)
+
+    def test_int_timestamps(self):
+        lww = LWW_redis_ring(nodes, namespace=NAMESPACE, n_buckets=2, int_timestamps=True)
+        try:
+            t = (1 << 53) - 10
+            lww.add("a", t + 1)
+            lww.remove("a", t)
+            self.assertEqual(lww.timestamps("a"), (t + 1, t))
+            self.assertEqual(type(lww.timestamps("a")[0]), int)
+            self.assertRaises(ValueError, lww.add, "b", 1.5)
+        finally:
+            lww.close()
+        self.assertRaises(ValueError, LWW_redis_ring, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
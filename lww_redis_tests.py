@@ -3,8 +3,18 @@
 import unittest
 import redis
 from lww_redis import LWW_redis as LWW_set
+from lww_python import LWW_python
+from lww_coalescer import LWW_coalescer
+from lww_clock import LWW_clock
+from lww_metrics import LWW_metrics, instrument, uninstrument
 import threading
 import random
+import time
+from itertools import islice
+import os
+import shutil
+import tempfile
+from lww_snapshot import LWW_snapshot, dump
 
 r = redis.StrictRedis(host='localhost', port=6379, db=0)
 
@@ -13,12 +23,14 @@ class Test_LWW_Redis(unittest.TestCase):
         #print "Clearing up lww_add_set and remove set before test"
         r.zremrangebyrank('lww_add_set',0,-1)
         r.zremrangebyrank('lww_remove_set',0,-1)
+        r.delete('lww_count', 'lww_changed', 'lww_sequence')
         self.a = random.randint(1,100)  # a random number each time
 
     def tearDown(self):
         #print "Clearing up lww_add_set and remove set after test"
         r.zremrangebyrank('lww_add_set',0,-1)
         r.zremrangebyrank('lww_remove_set',0,-1)
+        r.delete('lww_count', 'lww_changed', 'lww_sequence')
 
     def test_string_add_remove(self):
         lww = LWW_set(r)
@@ -74,6 +86,459 @@ class Test_LWW_Redis(unittest.TestCase):
             # overwrites a new one, then the below assertion may fail. 
             self.assertFalse(lww.exist(element))
 
+    def test_multi_client(self):
+        """Writers on separate lww-set objects share no client-side lock."""
+
+        lww1 = LWW_set(r)
+        lww2 = LWW_set(r)
+        element = "shared"
+        threads = []
+        for i in range(1, 51):
+            threads.append(AddThread(lww1, element, 2*i))
+            threads.append(RemoveThread(lww2, element, 2*i+1))
+
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        # The largest timestamp (101) is a remove from lww2
+        self.assertFalse(lww1.exist(element))
+        lww1.add(element, 101)
+        self.assertTrue(lww2.exist(element))
+
+    def test_add_remove_many(self):
+        lww = LWW_set(r)
+        self.assertTrue(lww.add_many([(1, 1), (2, 1), (3, 1), (1, 3)]))
+        self.assertTrue(lww.remove_many([(1, 2), (2, 2)]))
+        self.assertTrue(lww.exist(1))
+        self.assertFalse(lww.exist(2))
+        self.assertTrue(lww.exist(3))
+        self.assertEqual(sorted(lww.get()), ['1', '3'])
+
+    def test_apply_ops_chunked(self):
+        lww = LWW_set(r)
+        lww.BATCH_SIZE = 7
+        ops = []
+        for i in range(100):
+            ops.append((LWW_set.ADD, i, 1))
+            ops.append((LWW_set.REMOVE, i, i % 3))
+        self.assertTrue(lww.apply_ops(ops))
+        expected_arr = sorted(str(i) for i in range(100) if i % 3 != 2)
+        self.assertEqual(sorted(lww.get()), expected_arr)
+
+    def test_iter_elements(self):
+        lww = LWW_set(r)
+        lww.add_many((i, 2) for i in range(500))
+        lww.remove_many((i, 1 + i % 2 * 2) for i in range(500))
+        expected_arr = sorted(str(i) for i in range(0, 500, 2))
+        self.assertEqual(sorted(lww.get()), expected_arr)
+        self.assertEqual(sorted(lww.iter_elements(batch_size=10)), expected_arr)
+
+    def test_compact(self):
+        lww = LWW_set(r)
+        lww.add("live", 2)
+        lww.remove("live", 1)
+        lww.add("dead", 1)
+        lww.remove("dead", 2)
+        lww.remove("recent", 10)
+        stats = lww.compact(5)
+        self.assertEqual(stats["add_entries"], 1)
+        self.assertEqual(stats["remove_entries"], 2)
+        self.assertEqual(r.zcard("lww_add_set"), 1)
+        self.assertEqual(r.zcard("lww_remove_set"), 1)
+        self.assertEqual(lww.get(), ["live"])
+        lww.add("dead", 6)
+        lww.remove("live", 7)
+        self.assertEqual(lww.get(), ["dead"])
+
+    def test_delta_since(self):
+        lww = LWW_set(r)
+        lww.BATCH_SIZE = 3
+        self.assertEqual(lww.watermark(), (0,))
+        lww.add_many((i, i) for i in range(10))
+        lww.remove("a", 4)
+        watermark = lww.watermark()
+        self.assertEqual(len(list(lww.delta_since())), 11)
+        self.assertEqual(len(list(lww.delta_since((0,)))), 11)
+        # a late write with an old timestamp is still after the watermark
+        lww.apply_ops([(LWW_set.ADD, "8", 7), (LWW_set.REMOVE, "8", 1), (LWW_set.ADD, "x", 0)])
+        lww.add("2", 5)
+        self.assertEqual(sorted(lww.delta_since(watermark)),
+                         [(LWW_set.ADD, "2", 5), (LWW_set.ADD, "8", 8),
+                          (LWW_set.ADD, "x", 0), (LWW_set.REMOVE, "8", 1)])
+        self.assertEqual(list(lww.delta_since(lww.watermark())), [])
+        self.assertRaises(ValueError, lww.delta_since, 7)
+        self.assertRaises(ValueError, lww.delta_since, ("x",))
+
+    def test_delta_since_concurrent(self):
+        """Elements changed while paging are never skipped"""
+        lww = LWW_set(r)
+        lww.BATCH_SIZE = 10
+        lww.add_many((i, 1) for i in range(100))
+        seen = set()
+        for i, (_, element, _) in enumerate(lww.delta_since((0,))):
+            if i == 5:
+                # moves elements of earlier and later pages to the end
+                lww.add_many((j, 2) for j in range(0, 100, 7))
+            seen.add(element)
+        self.assertEqual(seen, set(str(i) for i in range(100)))
+
+    def test_merge_python(self):
+        lww = LWW_set(r)
+        replica = LWW_python()
+        lww.add_many([("a", 1), ("b", 1), ("c", 5)])
+        replica.add_many([("a", 2), ("d", 1)])
+        replica.remove_many([("b", 2), ("c", 4)])
+        self.assertTrue(lww.merge(replica))
+        self.assertTrue(replica.merge(lww))
+        self.assertEqual(sorted(lww.get()), ["a", "c", "d"])
+        self.assertEqual(sorted(replica.get()), ["a", "c", "d"])
+        watermark = replica.watermark()
+        replica.remove("a", 6)
+        lww.merge(replica, watermark)
+        self.assertEqual(sorted(lww.get()), ["c", "d"])
+        watermark = lww.watermark()
+        lww.add("e", 1)
+        replica.merge(lww, watermark)
+        self.assertEqual(sorted(replica.get()), ["c", "d", "e"])
+
+    def test_merge_bytes(self):
+        """Deltas of a client without decode_responses carry str elements"""
+        raw = redis.StrictRedis(host='localhost', port=6379, db=0, decode_responses=False)
+        lww = LWW_set(raw)
+        lww.add_many([("x", 1), (u"élément", 1)])
+        lww.remove("y", 2)
+        self.assertEqual(sorted(lww.delta_since()),
+                         [(LWW_set.ADD, "x", 1), (LWW_set.ADD, u"élément", 1),
+                          (LWW_set.REMOVE, "y", 2)])
+        replica = LWW_python()
+        self.assertTrue(replica.merge(lww))
+        self.assertEqual(sorted(replica.get()), ["x", u"élément"])
+        self.assertTrue(replica.exist("x"))
+        self.assertEqual(replica.timestamps("y"), (None, 2))
+        other = LWW_set(raw, namespace="test_merge_bytes")
+        try:
+            self.assertTrue(other.merge(lww, (0,)))
+            self.assertEqual(sorted(other.delta_since()), sorted(lww.delta_since()))
+            self.assertTrue(other.exist(u"élément"))
+        finally:
+            other.close()
+            raw.delete(*other.buckets[0])
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "lww.snapshot")
+            dump(lww, path)
+            with LWW_snapshot(path) as snapshot:
+                self.assertEqual(sorted(snapshot.get()), ["x", u"élément"])
+        finally:
+            shutil.rmtree(directory)
+        lww.close()
+
+    def test_timestamps(self):
+        lww = LWW_set(r)
+        lww.add("a", 3)
+        lww.remove("a", 2)
+        self.assertEqual(lww.timestamps("a"), (3, 2))
+        self.assertEqual(lww.timestamps("b"), (None, None))
+
+    def test_coalescer(self):
+        lww = LWW_set(r)
+        lww.add("a", 5)
+        with LWW_coalescer(lww, max_delay=60) as coalescer:
+            for timestamp in range(100):
+                coalescer.add("b", timestamp)
+            coalescer.remove("a", 6)
+            self.assertTrue(coalescer.exist("b"))
+            self.assertFalse(coalescer.exist("a"))
+            self.assertEqual(lww.get(), ["a"])
+        self.assertEqual(lww.get(), ["b"])
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_cache(self):
+        lww = LWW_set(r, cache_size=2)
+        writer = LWW_set(r)  # publishes by default
+        try:
+            self.wait_for(lww.cache_ready.is_set)
+            writer.add("a", 1)
+            self.assertTrue(lww.exist("a"))
+            self.assertTrue(lww.exist("a"))
+            self.assertEqual(lww.cache_stats["misses"], 1)
+            self.assertEqual(lww.cache_stats["hits"], 1)
+            # a write of another client is merged into the cached pair
+            writer.remove("a", 2)
+            self.wait_for(lambda: lww.cache_stats["updates"] >= 1)
+            self.assertFalse(lww.exist("a"))
+            self.assertEqual(lww.cache_stats["misses"], 1)
+            # so are local writes, without waiting for the listener
+            lww.add("a", 3)
+            self.assertTrue(lww.exist("a"))
+            lww.apply_ops([(LWW_set.REMOVE, "a", 4)])
+            self.assertEqual(lww.timestamps("a"), (3, 4))
+            # least recently used elements are evicted
+            lww.exist("b")
+            lww.exist("c")
+            self.assertEqual(lww.cache_stats["evictions"], 1)
+            self.assertEqual(list(lww.cache), ["b", "c"])
+        finally:
+            lww.close()
+
+    def test_publish(self):
+        """Clients publish their writes unless created with publish=False
+        and without a cache"""
+        pubsub = r.pubsub()
+
+        def next_data():
+            data = pubsub.get_message(timeout=1)["data"]
+            return data.decode("utf-8") if isinstance(data, bytes) else data
+
+        try:
+            pubsub.subscribe("lww_changes")
+            self.assertEqual(pubsub.get_message(timeout=1)["type"], "subscribe")
+            LWW_set(r, publish=False).add("a", 1)
+            LWW_set(r, publish=False).apply_ops([(LWW_set.REMOVE, "a", 2)])
+            LWW_set(r).add("a", 3)
+            self.assertEqual(next_data(), "lww_add_set 3.0 a")
+            LWW_set(r).apply_ops([(LWW_set.REMOVE, "a", 4)])
+            self.assertEqual(next_data(), "lww_remove_set 4.0 a")
+            self.assertEqual(pubsub.get_message(timeout=0.1), None)
+        finally:
+            pubsub.close()
+
+    def test_namespaces(self):
+        lww1 = LWW_set(r, namespace="test_set1")
+        lww2 = LWW_set(r, namespace="test_set2")
+        try:
+            lww1.add("a", 1)
+            lww2.add("b", 1)
+            lww2.remove("a", 2)
+            self.assertEqual(lww1.get(), ["a"])
+            self.assertEqual(lww2.get(), ["b"])
+            self.assertEqual(r.zcard("lww_add_set"), 0)
+            self.assertEqual(lww1.keys("a"),
+                             ("test_set1_add_set", "test_set1_remove_set", "test_set1_count",
+                              "test_set1_feed", "test_set1_changed", "test_set1_sequence"))
+        finally:
+            r.delete(*(lww1.buckets[0] + lww2.buckets[0]))
+
+    def test_buckets(self):
+        lww = LWW_set(r, namespace="test_buckets", n_buckets=4)
+        keys = [key for pair in lww.buckets for key in pair]
+        try:
+            self.assertEqual(lww.keys("a")[0][:len("{test_buckets:")], "{test_buckets:")
+            self.assertTrue(lww.keys(u"\ud800") in lww.buckets)
+            lww.add_many((i, 2) for i in range(100))
+            lww.remove_many((i, 1 + i % 2 * 2) for i in range(100))
+            lww.add("x", 1)
+            lww.remove("y", 1)
+            expected_arr = sorted([str(i) for i in range(0, 100, 2)] + ["x"])
+            self.assertTrue(all(r.zcard(keys[0]) > 0 for keys in lww.buckets))
+            self.assertEqual(sorted(lww.get()), expected_arr)
+            self.assertEqual(sorted(lww.iter_elements(batch_size=10)), expected_arr)
+            self.assertTrue(lww.exist("x"))
+            self.assertFalse(lww.exist("1"))
+            self.assertEqual(len(list(lww.delta_since())), 202)
+            stats = lww.compact(10)
+            self.assertEqual(stats["add_entries"], 50)
+            self.assertEqual(stats["remove_entries"], 101)
+            self.assertEqual(sorted(lww.get()), expected_arr)
+            # another client with the same buckets sees the same set
+            self.assertEqual(sorted(LWW_set(r, namespace="test_buckets", n_buckets=4).get()),
+                             expected_arr)
+        finally:
+            lww.close()
+            r.delete(*keys)
+
+    def test_exist_many(self):
+        for n_buckets in (1, 4):
+            lww = LWW_set(r, namespace="test_exist_many", n_buckets=n_buckets)
+            lww.BATCH_SIZE = 7
+            keys = [key for pair in lww.buckets for key in pair]
+            try:
+                lww.add_many((i, 1) for i in range(50))
+                lww.remove_many((i, 2) for i in range(0, 50, 3))
+                lww.remove(1, 1)
+                elements = list(range(-5, 55)) + [7, "x"]
+                self.assertEqual(lww.exist_many(elements), [lww.exist(element) for element in elements])
+                self.assertEqual(lww.exist_many([]), [])
+            finally:
+                lww.close()
+                r.delete(*keys)
+
+    def test_int_timestamps(self):
+        lww = LWW_set(r, int_timestamps=True)
+        t = (1 << 53) - 10  # consecutive ints are still distinct doubles
+        lww.add("a", t + 1)
+        lww.remove("a", t + 2)
+        watermark = lww.watermark()
+        lww.apply_ops([(LWW_set.ADD, "b", t + 3), (LWW_set.REMOVE, "b", t + 2)])
+        self.assertEqual(lww.exist_many(["a", "b"]), [False, True])
+        self.assertEqual(lww.timestamps("a"), (t + 1, t + 2))
+        self.assertEqual(type(lww.timestamps("a")[0]), int)
+        self.assertEqual(sorted(lww.delta_since(watermark)),
+                         [(LWW_set.ADD, "b", t + 3), (LWW_set.REMOVE, "b", t + 2)])
+        self.assertRaises(ValueError, lww.add, "c", (1 << 53) + 1)
+        self.assertRaises(ValueError, lww.add, "c", 1.5)
+        self.assertEqual(lww.get(), ["b"])
+
+    def test_clock(self):
+        lww = LWW_set(r, int_timestamps=True, clock=LWW_clock())
+        lww.add("a")
+        lww.remove("a")
+        lww.add("b")
+        self.assertEqual(lww.get(), ["b"])
+        add_timestamp, remove_timestamp = lww.timestamps("a")
+        self.assertTrue(add_timestamp < remove_timestamp)
+        ahead = remove_timestamp + (1 << 30)  # a replica minutes ahead
+        lww.clock.update(ahead)
+        lww.add("a")
+        self.assertEqual(lww.timestamps("a")[0], ahead + 1)
+
+    def test_count(self):
+        for n_buckets in (1, 4):
+            lww = LWW_set(r, namespace="test_count", n_buckets=n_buckets)
+            keys = [key for pair in lww.buckets for key in pair]
+            try:
+                self.assertEqual(len(lww), 0)
+                lww.add_many((i, 1) for i in range(100))
+                lww.remove_many((i, 2) for i in range(0, 100, 4))
+                lww.remove(1, 0)
+                lww.add(4, 3)
+                lww.remove("x", 1)
+                self.assertEqual(lww.count(), 76)
+                self.assertEqual(len(lww), len(lww.get()))
+                # sets written without counters are counted by recount()
+                for count_key in [keys[2] for keys in lww.buckets]:
+                    r.delete(count_key)
+                self.assertEqual(lww.count(), 0)
+                self.assertEqual(lww.recount(), 76)
+                self.assertEqual(lww.count(), 76)
+            finally:
+                lww.close()
+                r.delete(*keys)
+
+    def test_changes(self):
+        for n_buckets in (1, 2):
+            lww = LWW_set(r, namespace="test_feed", n_buckets=n_buckets, feed_length=100)
+            keys = [key for pair in lww.buckets for key in pair]
+            try:
+                lww.add("before", 1)
+                changes = lww.changes()
+                lww.add("a", 1)
+                lww.add("a", 2)     # already exists
+                lww.remove("a", 2)  # the add wins the tie
+                lww.remove("a", 3)
+                lww.remove("b", 1)  # never existed
+                lww.apply_ops([(LWW_set.ADD, "b", 2), (LWW_set.ADD, "c", 1),
+                               (LWW_set.REMOVE, "c", 1)])
+                events = []
+                while len(events) < 4:
+                    events.extend(changes.get_batch(1))
+                self.assertEqual(sorted(events), [("add", "a", 1), ("add", "b", 2),
+                                                  ("add", "c", 1), ("remove", "a", 3)])
+                self.assertEqual(changes.get_batch(0.01), [])
+                # a new reader resumes after the offsets of the first one
+                lww.remove("b", 3)
+                resumed = lww.changes(changes.offsets)
+                self.assertEqual(resumed.get_batch(1), [("remove", "b", 3)])
+                self.assertEqual(len(list(islice(lww.changes({keys[3]: "0"}), 1))), 1)
+                changes.close()
+                self.assertEqual(changes.get_batch(), None)
+
+                batches = []
+                subscription = lww.subscribe(batches.append)
+                lww.add_many(("e%d" % i, 1) for i in range(50))
+                while sum(len(batch) for batch in batches) < 50:
+                    time.sleep(0.01)
+                subscription.close()
+                # the streams are capped
+                lww.add_many(("f%d" % i, 1) for i in range(500))
+                self.assertTrue(sum(r.xlen(pair[3]) for pair in lww.buckets) < 500)
+            finally:
+                lww.close()
+                r.delete(*keys)
+        lww = LWW_set(r)
+        lww.add("a", 1)
+        self.assertEqual(r.exists("lww_feed"), 0)  # no feed by default
+
+    def test_read_replica(self):
+        # db 1 stands in for a replica, synced by hand
+        replica = redis.StrictRedis(host='localhost', port=6379, db=1)
+        lww = LWW_set(r, namespace="test_replica", read_redis=replica, max_staleness=60)
+        keys = [key for pair in lww.buckets for key in pair] + [lww.heartbeat_key]
+        try:
+            lww.add("a", 1)
+            # the replica has no heartbeat yet, so reads go to the primary
+            self.assertTrue(lww.exist("a"))
+            self.assertEqual(lww.fresh_until, [0.0])
+            replica.set(lww.heartbeat_key, r.get(lww.heartbeat_key))
+            self.assertTrue(lww.check_replicas()[0] > time.time())
+            self.assertFalse(lww.exist("a"))  # a fresh replica that lags behind
+            self.assertEqual(lww.get(), [])
+            self.assertEqual(lww.count(), 0)
+            self.assertEqual(lww.exist_many(["a"]), [False])
+            # deltas are read from the primary, like their watermarks
+            self.assertEqual(list(lww.delta_since()), [(LWW_set.ADD, "a", 1)])
+            self.assertEqual(list(lww.delta_since((0,))), [(LWW_set.ADD, "a", 1)])
+            replica.set(lww.heartbeat_key, repr(time.time() - 61))
+            lww.check_replicas()
+            self.assertTrue(lww.exist("a"))  # too stale, back to the primary
+            self.assertEqual(lww.count(), 1)
+            lww.max_staleness = None
+            self.assertFalse(lww.exist("a"))  # no bound
+        finally:
+            lww.close()
+            r.delete(*keys)
+            replica.delete(*keys)
+
+    def test_metrics(self):
+        metrics = LWW_metrics()
+        lww = instrument(LWW_set(r, namespace="test_metrics", n_buckets=2), metrics)
+        keys = [key for pair in lww.buckets for key in pair]
+        try:
+            lww.add("a", 1)
+            lww.exist("a")
+            lww.add_many((i, 1) for i in range(10))
+            self.assertEqual(lww.exist_many(["a", "b"]), [True, False])
+            self.assertEqual(lww.count(), 11)
+            # one script call, two ZSCOREs and three pipelines
+            self.assertEqual(metrics.phases["backend"].total, 6)
+            self.assertEqual(metrics.ops["count"], 1)
+            uninstrument(lww)
+            self.assertTrue(lww.redis is r)
+        finally:
+            lww.close()
+            r.delete(*keys)
+
+    def test_get_range_latest_select(self):
+        for n_buckets in (1, 3):
+            lww = LWW_set(r, namespace="test_query", n_buckets=n_buckets)
+            keys = [key for pair in lww.buckets for key in pair]
+            python_lww = LWW_python(ordered=True)
+            try:
+                for replica in (lww, python_lww):
+                    replica.add_many((i, i // 2) for i in range(3000))
+                    replica.remove_many((i, 2000) for i in range(0, 3000, 3))
+                    replica.add("late", 5)
+                    replica.add("1", 1500)
+                self.assertEqual(lww.get_range(2, 5), ["4", "5", "7", "8", "10", "11", "late"])
+                self.assertEqual(lww.get_range(0, 1e9), python_lww.get_range(0, 1e9))
+                self.assertEqual(lww.get_range(5, 2), [])
+                self.assertEqual(lww.latest(3), ["1", "2999", "2998"])
+                self.assertEqual(lww.latest(2500), python_lww.latest(2500))
+                self.assertEqual(lww.select(0, 3), ["2", "4", "5"])
+                self.assertEqual(lww.select(1500, 1200), python_lww.select(1500, 1200))
+                self.assertEqual(lww.select(5000, 10), [])
+            finally:
+                lww.close()
+                r.delete(*keys)
+
     def test1(self):
         """test1-12 corresponds to a case in README table"""
         lww = LWW_set(r)
@@ -0,0 +1,502 @@
+"""An lww-set in shared memory for several processes
+
+All state lives in one multiprocessing.shared_memory segment, laid out
+as (integers and floats in native byte order):
+
+    header        -- 8-byte magic b"LWWSHM01", the capacity, the arena
+                     size, the arena bytes used and the number of slots
+                     used, as uint64, then one int64 live count per lock
+                     and one uint64 change counter per lock
+    seq column    -- capacity uint32 seqlock counters, 0 if the slot is free
+    tag column    -- capacity uint64 tags of the elements, the CRC32 of
+                     the element plus its length in bytes << 32
+    offset column -- capacity uint64 arena offsets of the elements
+    add column    -- capacity float64 add timestamps, NaN if missing
+    remove column -- capacity float64 remove timestamps, NaN if missing
+    change column -- capacity uint64 change counts of the last change of
+                     each slot, numbered per lock, see delta_since()
+    arena         -- the UTF-8 element strings, back to back
+
+The slots form an open-addressing hash table with linear probing. A
+slot is never freed, so a probe stops at the first free slot.
+"""
+
+import os
+import struct
+import zlib
+import multiprocessing
+from multiprocessing import shared_memory
+from lww_interface import LWW_set
+import lww_clock
+import lww_snapshot
+
+encode = lww_snapshot.encode
+crc32 = zlib.crc32
+
+MAGIC = b"LWWSHM01"
+HEADER = struct.Struct("=8s4Q")
+MISSING = float("nan")
+
+
+class LWW_shared(LWW_set):
+    """A Last-Writer-Win element set in shared memory.
+
+    Processes started by multiprocessing (fork or spawn) after the set
+    is created share it: pass the set to the process, e.g., as an
+    argument of multiprocessing.Process, and every process reads and
+    writes the same table. A process only maps the segment, so its
+    memory does not grow with the set.
+
+    Writers of an element take one of n_locks striped locks, chosen by
+    slot, and a new element also takes the insert lock. Readers take no
+    lock: a writer makes the seq counter of the slot odd while it
+    changes the timestamps, and exist() retries until it reads them
+    under the same even counter. exist() compares the element with the
+    arena in place, without copying it.
+
+    The capacity and the arena are fixed when the set is created. Once
+    three quarters of the slots, or the arena, are used, writes of new
+    elements fail and return False. compact() drops redundant
+    timestamps, but slots and arena space are never reclaimed. The
+    process that created the set unlinks the segment on close().
+
+    Timestamps are stored as float64, so with int_timestamps=True they
+    are limited to +-2 ** 53, as in LWW_redis: nanosecond epoch
+    timestamps are not supported and raise ValueError.
+
+    Keyword attributes:
+    capacity -- the number of slots, rounded up to a power of two
+    arena_size -- the bytes of element strings, 32 per slot by default
+    n_locks -- the number of striped write locks
+    context -- the multiprocessing context the locks are created in,
+    which must be the one of the processes, e.g.,
+    multiprocessing.get_context("spawn")
+    trusted -- skip argument validation, see LWW_set.trust_arguments()
+    int_timestamps -- whether timestamps are ints
+    clock -- stamps writes without a timestamp, see lww_clock; every
+    other process gets a new clock with the same wall clock
+    """
+    # the ints that a float64 column holds exactly
+    MIN_INT_TIMESTAMP = -(1 << 53)
+    MAX_INT_TIMESTAMP = 1 << 53
+
+    def __init__(self, capacity=1 << 16, arena_size=None, n_locks=64, context=None,
+                 trusted=False, int_timestamps=False, clock=None):
+        self.clock = clock
+        self.score_type = float  # the type of the returned timestamps
+        if int_timestamps:
+            self.use_int_timestamps()
+        if trusted:
+            self.trust_arguments()
+        capacity = 1 << max(capacity - 1, 1).bit_length()
+        if arena_size is None:
+            arena_size = 32 * capacity
+        self.n_locks = n_locks
+        if context is None:
+            context = multiprocessing.get_context()
+        self.locks = [context.Lock() for _ in range(n_locks)]
+        self.insert_lock = context.Lock()
+        size = HEADER.size + 16 * n_locks + 44 * capacity + arena_size
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.owner = os.getpid()
+        HEADER.pack_into(self.shm.buf, 0, MAGIC, capacity, arena_size, 0, 0)
+        self.__map()
+
+    def __map(self):
+        """Sets up the column views of the mapped segment"""
+        self.view = self.shm.buf
+        magic, capacity, arena_size, _, _ = HEADER.unpack_from(self.view, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not an lww-set segment!" % self.shm.name)
+        self.capacity = capacity
+        self.mask = capacity - 1
+        position = 8
+        self.meta = self.view[position:position + 32].cast('Q')  # capacity, arena size, arena used, slots used
+        position = HEADER.size
+        self.live_counts = self.view[position:position + 8 * self.n_locks].cast('q')
+        position += 8 * self.n_locks
+        self.change_counts = self.view[position:position + 8 * self.n_locks].cast('Q')
+        position += 8 * self.n_locks
+        columns = []
+        for code, width in (('I', 4), ('Q', 8), ('Q', 8), ('d', 8), ('d', 8), ('Q', 8)):
+            columns.append(self.view[position:position + width * capacity].cast(code))
+            position += width * capacity
+        (self.seqs, self.tags, self.offsets, self.add_column, self.remove_column,
+         self.changes) = columns
+        self.arena = self.view[position:position + arena_size]
+
+    def use_int_timestamps(self):
+        """Switches the set to int timestamps, up to +-2 ** 53
+
+        See base class LWW_set docstring for detals.
+        """
+        self.score_type = int
+        LWW_set.use_int_timestamps(self)
+
+    def __getstate__(self):
+        # the segment is mapped again by name in the other process, and
+        # the locks are passed as multiprocessing passes them
+        wall_clock = None if self.clock is None else self.clock.wall_clock
+        return (self.shm.name, self.owner, self.n_locks, self.locks, self.insert_lock,
+                wall_clock, self.score_type is int,
+                self.validate_element is LWW_set.trusted_argument)
+
+    def __setstate__(self, state):
+        (name, self.owner, self.n_locks, self.locks, self.insert_lock,
+         wall_clock, int_timestamps, trusted) = state
+        self.clock = None if wall_clock is None else lww_clock.LWW_clock(wall_clock)
+        self.score_type = float
+        if int_timestamps:
+            self.use_int_timestamps()
+        if trusted:
+            self.trust_arguments()
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.__map()
+
+    @property
+    def name(self):
+        """The name of the shared memory segment"""
+        return self.shm.name
+
+    def close(self):
+        """Unmaps the segment, and unlinks it in the process that created it"""
+        for name in ("meta", "live_counts", "change_counts", "seqs", "tags", "offsets",
+                     "add_column", "remove_column", "changes", "arena"):
+            view = self.__dict__.pop(name, None)
+            if view is not None:
+                view.release()
+        self.view = None
+        self.shm.close()
+        if self.owner == os.getpid():
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __find(self, key, tag):
+        """Returns the slot of an encoded element, or None"""
+        seqs = self.seqs
+        tags = self.tags
+        mask = self.mask
+        slot = tag & mask
+        while seqs[slot]:
+            if tags[slot] == tag:
+                offset = self.offsets[slot]
+                # a memoryview compares with bytes in place
+                if self.arena[offset:offset + len(key)] == key:
+                    return slot
+            slot = (slot + 1) & mask
+        return None
+
+    def __insert(self, key, tag):
+        """Returns the slot of an encoded element, inserting it with
+        missing timestamps if needed"""
+        self.insert_lock.acquire()
+        try:
+            slot = self.__find(key, tag)
+            if slot is not None:
+                return slot
+            meta = self.meta
+            if meta[3] + 1 > self.capacity * 3 // 4:
+                raise MemoryError("the lww-set %s is full!" % self.shm.name)
+            offset = meta[2]
+            if offset + len(key) > len(self.arena):
+                raise MemoryError("the arena of the lww-set %s is full!" % self.shm.name)
+            self.arena[offset:offset + len(key)] = key
+            meta[2] = offset + len(key)
+            meta[3] += 1
+
+            slot = tag & self.mask
+            while self.seqs[slot]:
+                slot = (slot + 1) & self.mask
+            self.tags[slot] = tag
+            self.offsets[slot] = offset
+            self.add_column[slot] = MISSING
+            self.remove_column[slot] = MISSING
+            self.changes[slot] = 0
+            self.seqs[slot] = 2  # publishes the slot, after its fields
+            return slot
+        finally:
+            self.insert_lock.release()
+
+    def __test_and_set(self, column, element, timestamp):
+        """Updates the timestamp of a validated element in a column if
+        the passed timestamp is newer"""
+        key = lww_snapshot.encode(element)
+        tag = zlib.crc32(key) | len(key) << 32
+        slot = self.__find(key, tag)
+        if slot is None:
+            slot = self.__insert(key, tag)
+        stripe = slot % self.n_locks
+        lock = self.locks[stripe]
+        lock.acquire()
+        try:
+            # a NaN (missing) timestamp compares False, so it is replaced
+            if not column[slot] >= timestamp:
+                was_live = self.__is_live(slot)
+                change = self.change_counts[stripe] + 1
+                seq = self.__begin_write(slot)
+                column[slot] = timestamp
+                self.changes[slot] = change
+                self.__end_write(slot, seq)
+                # counted once the slot is written, see delta_since()
+                self.change_counts[stripe] = change
+                self.live_counts[stripe] += self.__is_live(slot) - was_live
+        finally:
+            lock.release()
+
+    def __begin_write(self, slot):
+        """Makes the seq counter of a slot odd, must hold its lock"""
+        seq = self.seqs[slot] + 1
+        self.seqs[slot] = seq
+        return seq
+
+    def __end_write(self, slot, seq):
+        """Makes the seq counter of a slot even again; it wraps around
+        to 2, since 0 marks a free slot"""
+        self.seqs[slot] = seq + 1 if seq < 0xffffffff else 2
+
+    def __is_live(self, slot):
+        """Returns 1 if the element of a slot exists and 0 otherwise"""
+        add_timestamp = self.add_column[slot]
+        # add_timestamp is NaN if missing, and NaN never equals itself
+        return int(add_timestamp == add_timestamp and not self.remove_column[slot] > add_timestamp)
+
+    def __read(self, slot):
+        """Returns the (add, remove) timestamps of a slot, consistently"""
+        seqs = self.seqs
+        while True:
+            seq = seqs[slot]
+            if seq & 1:
+                continue  # a writer is changing the timestamps
+            add_timestamp = self.add_column[slot]
+            remove_timestamp = self.remove_column[slot]
+            if seqs[slot] == seq:
+                return add_timestamp, remove_timestamp
+
+    def add(self, element, timestamp=None):
+        """Add an element to lww_set, or update the existing element timestamp
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+        timestamp = self.write_timestamp(timestamp)
+
+        return_flag = True
+        try:
+            self.__test_and_set(self.add_column, element, timestamp)
+        except:
+            return_flag = False
+        return return_flag
+
+    def remove(self, element, timestamp=None):
+        """Remove an element from lww_set
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+        timestamp = self.write_timestamp(timestamp)
+
+        return_flag = True
+        try:
+            self.__test_and_set(self.remove_column, element, timestamp)
+        except:
+            return_flag = False
+        return return_flag
+
+    def apply_ops(self, ops):
+        """Apply a batch of add and remove operations
+
+        The whole batch is validated before any write. Each operation
+        takes the lock of its slot, so the batch is not atomic.
+
+        See base class LWW_set docstring for detals.
+        """
+        ops = [self.validate_op(op, element, timestamp)
+               for op, element, timestamp in ops]
+
+        return_flag = True
+        try:
+            for op, element, timestamp in ops:
+                column = self.add_column if op == self.ADD else self.remove_column
+                self.__test_and_set(column, element, timestamp)
+        except:
+            return_flag = False
+        return return_flag
+
+    def exist(self, element):
+        """Check if the element exists in lww-set
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+        key = encode(element)
+        tag = crc32(key) | len(key) << 32
+        # __find() and __read() inlined, this is the hot path of readers
+        try:
+            seqs = self.seqs
+            tags = self.tags
+            mask = self.mask
+            slot = tag & mask
+            while True:
+                seq = seqs[slot]
+                if not seq:
+                    return False
+                if tags[slot] == tag:
+                    offset = self.offsets[slot]
+                    if self.arena[offset:offset + len(key)] == key:
+                        break
+                slot = (slot + 1) & mask
+            while True:
+                add_timestamp = self.add_column[slot]
+                remove_timestamp = self.remove_column[slot]
+                if not seq & 1 and seqs[slot] == seq:
+                    break
+                seq = seqs[slot]
+        except:
+            raise RuntimeError("An internal error occurs when accessing lww-set. A retry may solve the problem. ")
+        return add_timestamp == add_timestamp and not remove_timestamp > add_timestamp
+
+    def timestamps(self, element):
+        """Returns the add and remove timestamps of an element
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+        key = lww_snapshot.encode(element)
+        slot = self.__find(key, zlib.crc32(key) | len(key) << 32)
+        if slot is None:
+            return None, None
+        add_timestamp, remove_timestamp = self.__read(slot)
+        score_type = self.score_type
+        return (score_type(add_timestamp) if add_timestamp == add_timestamp else None,
+                score_type(remove_timestamp) if remove_timestamp == remove_timestamp else None)
+
+    def count(self):
+        """Returns the number of existing elements in lww-set
+
+        See base class LWW_set docstring for detals.
+        """
+        return sum(self.live_counts)
+
+    def rows(self):
+        """Iterates over (element, add_timestamp, remove_timestamp) of
+        every used slot, with NaN for a missing timestamp"""
+        seqs = self.seqs
+        for slot in range(self.capacity):
+            if seqs[slot]:
+                add_timestamp, remove_timestamp = self.__read(slot)
+                offset = self.offsets[slot]
+                element = lww_snapshot.decode(bytes(self.arena[offset:offset + (self.tags[slot] >> 32)]))
+                yield element, add_timestamp, remove_timestamp
+
+    def get(self):
+        """Returns an array of all existing elements in lww-set
+
+        See base class LWW_set docstring for detals.
+        """
+        return list(self.iter_elements())
+
+    def iter_elements(self, batch_size=1000):
+        """Iterates over all existing elements in lww-set, in slot order
+
+        Elements written during the iteration may be missed.
+        batch_size is not used.
+
+        See base class LWW_set docstring for detals.
+        """
+        for element, add_timestamp, remove_timestamp in self.rows():
+            if add_timestamp == add_timestamp and not remove_timestamp > add_timestamp:
+                yield element
+
+    def watermark(self):
+        """Returns the (segment name, change counts) watermark of the set
+
+        A change of a slot is numbered by the change counter of its
+        lock, which is only advanced once the slot is written, so every
+        change counted by the watermark is visible to delta_since().
+
+        See base class LWW_set docstring for detals.
+        """
+        return self.shm.name, tuple(self.change_counts)
+
+    def delta_since(self, watermark=None):
+        """Iterates over the entries changed after a watermark, in slot order
+
+        The slots are scanned for a change count above the one of
+        their lock in the watermark, which is O(capacity). The watermark
+        is validated by the call, and the slots as they are iterated.
+
+        See base class LWW_set docstring for detals.
+        """
+        since = (0,) * self.n_locks
+        if watermark is not None:
+            try:
+                name, change_counts = watermark
+            except:
+                raise ValueError("watermark must be a watermark() of this set!")
+            if name == self.shm.name:
+                if len(change_counts) != self.n_locks:
+                    raise ValueError("watermark must be a watermark() of this set!")
+                since = change_counts
+        return self.__delta_since(since)
+
+    def __delta_since(self, since):
+        seqs = self.seqs
+        changes = self.changes
+        n_locks = self.n_locks
+        score_type = self.score_type
+        for slot in range(self.capacity):
+            if seqs[slot] and changes[slot] > since[slot % n_locks]:
+                add_timestamp, remove_timestamp = self.__read(slot)
+                offset = self.offsets[slot]
+                element = lww_snapshot.decode(bytes(self.arena[offset:offset + (self.tags[slot] >> 32)]))
+                # NaN (missing) timestamps never equal themselves
+                if add_timestamp == add_timestamp:
+                    yield self.ADD, element, score_type(add_timestamp)
+                if remove_timestamp == remove_timestamp:
+                    yield self.REMOVE, element, score_type(remove_timestamp)
+
+    def compact(self, horizon_timestamp, slice_size=1000):
+        """Garbage collect redundant add and remove timestamps
+
+        A dropped timestamp becomes NaN in its slot. Slots and arena
+        space stay allocated, so the reported bytes are always 0.
+        slice_size is not used, each slot is compacted under its own
+        lock.
+
+        See base class LWW_set docstring for detals.
+        """
+        horizon_timestamp = self.validate_timestamp(horizon_timestamp)
+        stats = {"add_entries": 0, "remove_entries": 0, "bytes": 0}
+        seqs = self.seqs
+        add_column = self.add_column
+        remove_column = self.remove_column
+        for slot in range(self.capacity):
+            if not seqs[slot]:
+                continue
+            lock = self.locks[slot % self.n_locks]
+            lock.acquire()
+            try:
+                add_timestamp = add_column[slot]
+                remove_timestamp = remove_column[slot]
+                if remove_timestamp != remove_timestamp:
+                    continue  # no remove timestamp, nothing to drop
+                seq = self.__begin_write(slot)
+                if add_timestamp >= remove_timestamp:
+                    remove_column[slot] = MISSING
+                    stats["remove_entries"] += 1
+                else:
+                    if add_timestamp == add_timestamp:
+                        add_column[slot] = MISSING
+                        stats["add_entries"] += 1
+                    if remove_timestamp < horizon_timestamp:
+                        remove_column[slot] = MISSING
+                        stats["remove_entries"] += 1
+                self.__end_write(slot, seq)
+            finally:
+                lock.release()
+        return stats
@@ -0,0 +1,141 @@
+"""unit tests for the lww_shared"""
+
+import multiprocessing
+import unittest
+from multiprocessing import shared_memory
+import lww_python_tests
+from lww_clock import LWW_clock
+from lww_shared import LWW_shared
+
+def write_range(lww, start, stop):
+    """Adds start..stop-1 and removes the odd ones, in another process
+
+    The process unmaps the segment before it exits, since its views
+    keep SharedMemory from closing at exit.
+    """
+    try:
+        lww.add_many((i, 1) for i in range(start, stop))
+        lww.remove_many((i, 2) for i in range(start + 1, stop, 2))
+    finally:
+        lww.close()
+
+
+class Test_LWW_Shared(lww_python_tests.Test_LWW_Set):
+    """Runs all lww_python tests on the shared memory table"""
+
+    def lww_type(self, **kwargs):
+        """A shared set with 4096 slots, closed and unlinked after the test"""
+        return self.shared(capacity=1 << 12, n_locks=8, **kwargs)
+
+    def shared(self, **kwargs):
+        lww = LWW_shared(**kwargs)
+        self.addCleanup(lww.close)
+        return lww
+
+    def compacted_bytes(self, n_timestamps, elements):
+        return 0  # slots and arena space are never reclaimed
+
+    def check_compacted(self, lww):
+        self.assertEqual(lww.meta[3], 3)  # slots used
+
+    def check_all_compacted(self, lww):
+        self.assertEqual(lww.meta[3], 100)
+
+    def test_iter_elements_concurrent_add(self):
+        """Elements added while iterating may or may not be seen"""
+        lww = self.lww_type()
+        lww.add_many((i, 1) for i in range(10))
+        result = []
+        for i, element in enumerate(lww.iter_elements()):
+            if i < 10:
+                lww.add(100 + i, 1)
+            result.append(element)
+        self.assertTrue(set(str(i) for i in range(10)) <= set(result))
+        self.assertEqual(len(set(result)), len(result))
+        self.assertEqual(len(lww.get()), 20)
+
+    def test_int_timestamps(self):
+        lww = self.lww_type()
+        lww.use_int_timestamps()
+        t = (1 << 53) - 10  # the largest ints a float64 holds exactly
+        lww.add("a", t + 1)
+        lww.remove("a", t + 2)
+        lww.remove("b", t + 1)
+        lww.add("b", t)
+        watermark = lww.watermark()
+        lww.apply_ops([(LWW_shared.ADD, "c", t + 3), (LWW_shared.REMOVE, "c", t + 2)])
+        self.assertEqual(lww.exist_many(["a", "b", "c"]), [False, False, True])
+        self.assertEqual(lww.timestamps("a"), (t + 1, t + 2))
+        self.assertEqual(type(lww.timestamps("a")[0]), int)
+        self.assertEqual(sorted(lww.delta_since(watermark)),
+                         [(LWW_shared.ADD, "c", t + 3), (LWW_shared.REMOVE, "c", t + 2)])
+        self.assertEqual(lww.count(), 1)
+        self.assertRaises(ValueError, lww.add, "d", 1.5)
+        self.assertRaises(ValueError, lww.add, "d", (1 << 53) + 1)
+
+    def test_slots(self):
+        lww = self.lww_type()
+        self.assertEqual(lww.capacity, 1 << 12)
+        self.assertEqual(self.shared(capacity=100, arena_size=10).capacity, 128)
+        lww.add("a", 1)
+        lww.add("a", 2)
+        lww.remove("a", 3)
+        lww.add("é", 1)  # stored as UTF-8 in the arena
+        self.assertEqual(lww.meta[3], 2)  # slots used
+        self.assertEqual(lww.meta[2], 3)  # arena bytes used
+        self.assertEqual(lww.timestamps("é"), (1, None))
+        # a write makes the seq counter odd and then even again
+        self.assertEqual(sorted(seq for seq in lww.seqs if seq), [4, 8])
+
+    def test_full(self):
+        lww = self.shared(capacity=8, arena_size=1000)
+        self.assertTrue(lww.add_many(("e%d" % i, 1) for i in range(6)))
+        self.assertFalse(lww.add("e6", 1))  # three quarters of the slots
+        self.assertTrue(lww.add("e0", 2))   # existing elements still work
+        self.assertEqual(lww.count(), 6)
+        lww = self.shared(capacity=64, arena_size=4)
+        self.assertTrue(lww.add("abcd", 1))
+        self.assertFalse(lww.add("e", 1))  # the arena is full
+        self.assertFalse(lww.exist("e"))
+
+    def test_close(self):
+        lww = LWW_shared(capacity=64)
+        name = lww.name
+        with lww:
+            lww.add("a", 1)
+            other = shared_memory.SharedMemory(name=name)
+            other.close()
+        self.assertRaises(FileNotFoundError, shared_memory.SharedMemory, name=name)
+
+    def test_processes(self):
+        """Forked processes write one table, read by all of them"""
+        context = multiprocessing.get_context("fork")
+        lww = self.lww_type()
+        processes = [context.Process(target=write_range, args=(lww, i * 250, (i + 1) * 250))
+                     for i in range(4)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+            self.assertEqual(p.exitcode, 0)
+        self.assertEqual(lww.count(), 500)
+        self.assertEqual(sorted(lww.get(), key=int), [str(i) for i in range(0, 1000, 2)])
+        self.assertFalse(lww.exist(1))
+
+    def test_spawn(self):
+        """A spawned process maps the segment by name"""
+        context = multiprocessing.get_context("spawn")
+        lww = self.lww_type(context=context, int_timestamps=True, clock=LWW_clock())
+        lww.add(0, 3)
+        p = context.Process(target=write_range, args=(lww, 0, 10))
+        p.start()
+        p.join()
+        self.assertEqual(p.exitcode, 0)
+        self.assertEqual(sorted(lww.get()), ["0", "2", "4", "6", "8"])
+        self.assertEqual(lww.timestamps(0), (3, None))
+        self.assertEqual(lww.timestamps(1), (1, 2))
+        self.assertEqual(type(lww.timestamps(1)[0]), int)
+
+
+if __name__ == '__main__':
+    unittest.main()
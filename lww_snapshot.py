@@ -0,0 +1,286 @@
+"""Compact binary snapshots of lww-sets
+
+A snapshot file is laid out as (all integers and floats little-endian):
+
+    header         -- 8-byte magic b"LWWSNAP1" and the number of elements n
+    add column     -- n float64 add timestamps, NaN if missing
+    remove column  -- n float64 remove timestamps, NaN if missing
+    offsets        -- n uint64 file offsets of the element records
+    records        -- n element records, each a uint32 length followed
+                      by the UTF-8 element string
+
+Elements are sorted by their UTF-8 bytes, so LWW_snapshot can look an
+element up by binary search directly in the memory-mapped file, without
+loading the whole set.
+"""
+
+import mmap
+import os
+import struct
+import sys
+from array import array
+from lww_interface import LWW_set, new_epoch
+
+MAGIC = b"LWWSNAP1"
+HEADER = struct.Struct("<8sQ")
+LENGTH = struct.Struct("<I")
+MISSING = float("nan")
+
+
+def encode(element):
+    return element.encode("utf-8", "surrogatepass")
+
+
+def decode(data):
+    return data.decode("utf-8", "surrogatepass")
+
+
+def write_snapshot(path, add_set, remove_set):
+    """Writes a snapshot file
+
+    The file is written next to path, fsync'ed and renamed over it, and
+    then the directory is fsync'ed, so readers never see a partial
+    snapshot and the snapshot survives a crash once this returns.
+
+    Keyword arguments:
+    path -- the snapshot file path
+    add_set -- a dict of validated elements to add timestamps
+    remove_set -- a dict of validated elements to remove timestamps
+    """
+    elements = list(add_set)
+    elements.extend(element for element in remove_set if element not in add_set)
+    # code point order of strings is the byte order of their UTF-8
+    elements.sort()
+    n = len(elements)
+    add_column = array('d', [add_set.get(element, MISSING) for element in elements])
+    remove_column = array('d', [remove_set.get(element, MISSING) for element in elements])
+    records = [encode(element) for element in elements]
+    offsets = array('Q')
+    position = HEADER.size + 3 * 8 * n
+    for record in records:
+        offsets.append(position)
+        position += LENGTH.size + len(record)
+    if sys.byteorder != "little":
+        for column in (add_column, remove_column, offsets):
+            column.byteswap()
+
+    temp_path = "%s.tmp" % path
+    with open(temp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, n))
+        add_column.tofile(f)
+        remove_column.tofile(f)
+        offsets.tofile(f)
+        pack = LENGTH.pack
+        f.write(b"".join([pack(len(record)) + record for record in records]))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    fsync_directory(path)
+
+
+def fsync_directory(path):
+    """fsyncs the directory of path, making a rename to path durable"""
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def dump(lww_set, path):
+    """Writes the state of any lww-set to a snapshot file"""
+    add_set = {}
+    remove_set = {}
+    for op, element, timestamp in lww_set.delta_since():
+        if op == LWW_set.ADD:
+            add_set[element] = timestamp
+        else:
+            remove_set[element] = timestamp
+    write_snapshot(path, add_set, remove_set)
+
+
+class LWW_snapshot(LWW_set):
+    """A read-only lww-set backed by a memory-mapped snapshot file.
+
+    Opening a snapshot only maps the file. exist() binary searches the
+    sorted element records, and the timestamp columns are read in place
+    through memoryviews, so a cold snapshot is usable right away and
+    only the pages that are touched are read from disk. Use merge() to
+    copy a snapshot into a writable lww-set.
+
+    Keyword attributes:
+    path -- the snapshot file path
+    """
+    def __init__(self, path):
+        if sys.byteorder != "little":
+            raise ValueError("memory-mapped snapshots require a little-endian host!")
+        self.file = open(path, "rb")
+        self.mmap = None
+        try:
+            # an empty file cannot be mapped, and a short one has no header
+            if os.fstat(self.file.fileno()).st_size < HEADER.size:
+                raise ValueError("%s is not an lww-set snapshot!" % path)
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, n = HEADER.unpack_from(self.mmap, 0)
+            if magic != MAGIC or len(self.mmap) < HEADER.size + 24 * n:
+                raise ValueError("%s is not an lww-set snapshot!" % path)
+            self.n = n
+            self.view = memoryview(self.mmap)
+            start = HEADER.size
+            self.add_column = self.view[start:start + 8 * n].cast('d')
+            self.remove_column = self.view[start + 8 * n:start + 16 * n].cast('d')
+            self.offsets = self.view[start + 16 * n:start + 24 * n].cast('Q')
+            # records are contiguous, so the last one ends the file
+            if n:
+                end = self.offsets[n - 1] + LENGTH.size
+                if end > len(self.mmap) or \
+                        end + LENGTH.unpack_from(self.mmap, end - LENGTH.size)[0] > len(self.mmap):
+                    raise ValueError("%s is not an lww-set snapshot!" % path)
+        except:
+            self.close()
+            raise
+        self.live_count = None  # counted on the first count()
+        self.epoch = new_epoch()
+
+    def close(self):
+        """Unmaps the snapshot file"""
+        for name in ("add_column", "remove_column", "offsets", "view"):
+            view = self.__dict__.pop(name, None)
+            if view is not None:
+                view.release()
+        if self.mmap is not None:
+            self.mmap.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def record(self, row):
+        """Returns the UTF-8 bytes of the element in the given row"""
+        offset = self.offsets[row]
+        length = LENGTH.unpack_from(self.mmap, offset)[0]
+        return self.mmap[offset + LENGTH.size:offset + LENGTH.size + length]
+
+    def find(self, element):
+        """Returns the row of a validated element, or None"""
+        key = encode(element)
+        low, high = 0, self.n
+        while low < high:
+            middle = (low + high) // 2
+            candidate = self.record(middle)
+            if candidate < key:
+                low = middle + 1
+            elif candidate > key:
+                high = middle
+            else:
+                return middle
+        return None
+
+    def elements(self):
+        """Iterates over the elements of all rows, in row order"""
+        mm = self.mmap
+        unpack_from = LENGTH.unpack_from
+        position = HEADER.size + 24 * self.n  # records are contiguous
+        for _ in range(self.n):
+            length = unpack_from(mm, position)[0]
+            position += LENGTH.size
+            yield decode(mm[position:position + length])
+            position += length
+
+    def rows(self):
+        """Iterates over (element, add_timestamp, remove_timestamp) of every
+        row, with NaN for a missing timestamp"""
+        return zip(self.elements(), self.add_column, self.remove_column)
+
+    def add(self, element, timestamp):
+        raise NotImplementedError("LWW_snapshot is read-only!")
+
+    def remove(self, element, timestamp):
+        raise NotImplementedError("LWW_snapshot is read-only!")
+
+    def apply_ops(self, ops):
+        raise NotImplementedError("LWW_snapshot is read-only!")
+
+    def exist(self, element):
+        """Check if the element exists in lww-set
+
+        See base class LWW_set docstring for detals.
+        """
+        row = self.find(self.validate_element(element))
+        if row is None:
+            return False
+        add_timestamp = self.add_column[row]
+        return add_timestamp == add_timestamp and not self.remove_column[row] > add_timestamp
+
+    def timestamps(self, element):
+        """Returns the add and remove timestamps of an element
+
+        See base class LWW_set docstring for detals.
+        """
+        row = self.find(self.validate_element(element))
+        if row is None:
+            return None, None
+        add_timestamp = self.add_column[row]
+        remove_timestamp = self.remove_column[row]
+        return (add_timestamp if add_timestamp == add_timestamp else None,
+                remove_timestamp if remove_timestamp == remove_timestamp else None)
+
+    def count(self):
+        """Returns the number of existing elements in lww-set
+
+        The timestamp columns are scanned once, without decoding the
+        elements, and the result is kept since a snapshot never changes.
+
+        See base class LWW_set docstring for detals.
+        """
+        if self.live_count is None:
+            self.live_count = sum(1 for add_timestamp, remove_timestamp
+                                  in zip(self.add_column, self.remove_column)
+                                  if add_timestamp == add_timestamp
+                                  and not remove_timestamp > add_timestamp)
+        return self.live_count
+
+    def get(self):
+        """Returns an array of all existing elements in lww-set
+
+        See base class LWW_set docstring for detals.
+        """
+        return list(self.iter_elements())
+
+    def iter_elements(self, batch_size=1000):
+        """Iterates over all existing elements in lww-set, in UTF-8 order
+
+        See base class LWW_set docstring for detals.
+        """
+        for element, add_timestamp, remove_timestamp in self.rows():
+            if add_timestamp == add_timestamp and not remove_timestamp > add_timestamp:
+                yield element
+
+    def watermark(self):
+        """Returns the watermark of the snapshot, which never changes
+        after it was opened
+
+        See base class LWW_set docstring for detals.
+        """
+        return self.epoch, 1
+
+    def delta_since(self, watermark=None):
+        """Iterates over all entries, or none for a watermark() of this
+        snapshot
+
+        See base class LWW_set docstring for detals.
+        """
+        if self.validate_watermark(watermark) >= 1:
+            return iter(())
+        return self.__entries()
+
+    def __entries(self):
+        # NaN (missing) timestamps never equal themselves
+        for element, add_timestamp, remove_timestamp in self.rows():
+            if add_timestamp == add_timestamp:
+                yield self.ADD, element, add_timestamp
+            if remove_timestamp == remove_timestamp:
+                yield self.REMOVE, element, remove_timestamp
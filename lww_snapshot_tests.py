@@ -0,0 +1,93 @@
+"""unit tests for the lww_snapshot"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from lww_clock import LWW_clock
+from lww_python import LWW_python
+from lww_python_compact import LWW_python_compact
+from lww_snapshot import LWW_snapshot, dump
+
+class Test_LWW_Snapshot(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "lww.snapshot")
+        self.lww = LWW_python()
+        self.lww.add_many([("a", 1), ("b", 2), (u"élément", 3), ("", 1), ("d", 1)])
+        self.lww.remove_many([("b", 3), ("c", 1), ("d", 1)])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_dump_load(self):
+        self.lww.dump(self.path)
+        lww = LWW_python.load(self.path)
+        self.assertEqual(lww.add_set, self.lww.add_set)
+        self.assertEqual(lww.remove_set, self.lww.remove_set)
+        self.assertTrue(lww.add("b", 4))
+        self.assertTrue(lww.exist("b"))
+
+    def test_cold_lookup(self):
+        self.lww.dump(self.path)
+        with LWW_snapshot(self.path) as snapshot:
+            for element in ("a", "b", "c", "d", "", u"élément", "missing", "zzz"):
+                self.assertEqual(snapshot.exist(element), self.lww.exist(element))
+                self.assertEqual(snapshot.timestamps(element), self.lww.timestamps(element))
+            self.assertEqual(sorted(snapshot.get()), sorted(self.lww.get()))
+            self.assertEqual(sorted(snapshot.delta_since()), sorted(self.lww.delta_since()))
+            self.assertEqual(list(snapshot.delta_since(snapshot.watermark())), [])
+            self.assertRaises(ValueError, snapshot.delta_since, 2)
+            self.assertRaises(NotImplementedError, snapshot.add, "a", 5)
+
+    def test_merge_snapshot(self):
+        dump(self.lww, self.path)
+        lww = LWW_python_compact()
+        lww.add("a", 5)
+        lww.remove("a", 6)
+        with LWW_snapshot(self.path) as snapshot:
+            lww.merge(snapshot)
+        self.assertEqual(sorted(lww.get()), sorted(e for e in self.lww.get() if e != "a"))
+
+    def test_empty(self):
+        LWW_python().dump(self.path)
+        with LWW_snapshot(self.path) as snapshot:
+            self.assertFalse(snapshot.exist("a"))
+            self.assertEqual(snapshot.get(), [])
+        self.assertEqual(LWW_python.load(self.path).get(), [])
+
+    def test_load_modes(self):
+        lww = LWW_python(int_timestamps=True)
+        lww.add_many([("a", 5), ("b", 1)])
+        lww.remove("b", 7)
+        lww.dump(self.path)
+        clock = LWW_clock()
+        loaded = LWW_python.load(self.path, trusted=True, int_timestamps=True, clock=clock)
+        self.assertEqual(loaded.timestamps("b"), (1, 7))
+        self.assertEqual(type(loaded.timestamps("a")[0]), int)
+        self.assertEqual(loaded.get(), ["a"])
+        self.assertTrue(clock.last >= 7)
+        self.assertTrue(loaded.validate_element is LWW_python.trusted_argument)
+        loaded = LWW_python.load(self.path, int_timestamps=True)
+        self.assertRaises(ValueError, loaded.add, "c", 1.5)
+        self.assertEqual(type(LWW_python.load(self.path).timestamps("a")[0]), float)
+
+    def test_bad_file(self):
+        with open(self.path, "wb") as f:
+            f.write(b"not a snapshot file")
+        self.assertRaises(ValueError, LWW_snapshot, self.path)
+
+    def test_truncated_file(self):
+        self.lww.dump(self.path)
+        with open(self.path, "rb") as f:
+            data = f.read()
+        records = 16 + 24 * 6
+        # empty, inside the header, inside the columns, inside the records
+        for size in (0, 3, 16, 40, records, records + 2, records + 5, len(data) - 1):
+            with open(self.path, "wb") as f:
+                f.write(data[:size])
+            self.assertRaises(ValueError, LWW_snapshot, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
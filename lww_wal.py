@@ -0,0 +1,363 @@
+"""Write-ahead log (WAL) for LWW_python
+
+Every add() and remove() is appended to a binary log file. Records are
+buffered and written in blocks by group commit: a block is written and
+fsync'ed when commit_size records are pending or every commit_interval
+seconds, so one fsync is shared by many operations. A block is
+
+    header  -- uint32 payload length, uint32 record count, uint32 CRC32
+    payload -- records of uint8 op (0 add, 1 remove, or 2 add and 3
+               remove with int timestamps), float64 timestamp (int64
+               for ops 2 and 3), uint32 element length and the UTF-8
+               element string
+
+all little-endian. On startup, an optional snapshot is loaded and the log
+is replayed. Since lww-set operations are commutative and idempotent,
+replaying in any order, or replaying operations that the snapshot
+already contains, gives the same state. This lets replay fold the log
+into per-element maximum timestamps, split over several processes.
+A torn block at the end of the log (e.g., a crash during a write) fails
+its length or CRC check and is cut off.
+"""
+
+import os
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from threading import *
+from lww_python import LWW_python
+import lww_snapshot
+
+BLOCK_HEADER = struct.Struct("<III")
+RECORD_HEADER = struct.Struct("<BdI")
+INT_RECORD_HEADER = struct.Struct("<BqI")  # same size, exact int timestamps
+RECORD_HEADERS = (RECORD_HEADER, INT_RECORD_HEADER)  # by op code >> 1
+OP_CODES = {LWW_python.ADD: 0, LWW_python.REMOVE: 1}
+INT_OP_CODES = {LWW_python.ADD: 2, LWW_python.REMOVE: 3}
+
+
+def encode_ops(ops, int_timestamps=False):
+    """Returns the log payload of validated (op, element, timestamp) ops
+
+    With int_timestamps, the records hold int64 timestamps, which
+    replay exactly beyond 2 ** 53.
+    """
+    if int_timestamps:
+        pack, op_codes = INT_RECORD_HEADER.pack, INT_OP_CODES
+    else:
+        pack, op_codes = RECORD_HEADER.pack, OP_CODES
+    records = []
+    for op, element, timestamp in ops:
+        data = lww_snapshot.encode(element)
+        records.append(pack(op_codes[op], timestamp, len(data)))
+        records.append(data)
+    return b"".join(records)
+
+
+def scan_blocks(data):
+    """Returns the (start, end) offsets of the intact blocks of a log"""
+    blocks = []
+    position = 0
+    while position + BLOCK_HEADER.size <= len(data):
+        length, count, crc = BLOCK_HEADER.unpack_from(data, position)
+        start = position + BLOCK_HEADER.size
+        end = start + length
+        if end > len(data) or zlib.crc32(data[start:end]) & 0xffffffff != crc:
+            break
+        blocks.append((start, end))
+        position = end
+    return blocks
+
+
+def replay_blocks(path, blocks):
+    """Folds the records of some log blocks into timestamp dicts
+
+    Keyword arguments:
+    path -- the log file path
+    blocks -- (start, end) payload offsets, see scan_blocks()
+
+    Keyword returns:
+    (add_set, remove_set) dicts of the largest timestamp per element
+    """
+    sets = ({}, {})
+    if not blocks:
+        return sets
+    # read only the range of the blocks, not the log before them
+    base = blocks[0][0]
+    with open(path, "rb") as f:
+        f.seek(base)
+        data = f.read(blocks[-1][1] - base)
+    for start, end in blocks:
+        position, end = start - base, end - base
+        while position < end:
+            code, timestamp, length = RECORD_HEADERS[data[position] >> 1].unpack_from(data, position)
+            position += RECORD_HEADER.size
+            element = lww_snapshot.decode(data[position:position + length])
+            position += length
+            target_set = sets[code & 1]
+            current_timestamp = target_set.get(element)
+            if current_timestamp is None or current_timestamp < timestamp:
+                target_set[element] = timestamp
+    return sets
+
+
+class LWW_python_wal(LWW_python):
+    """An LWW_python whose operations are made durable in a write-ahead log.
+
+    By default add() and remove() return as soon as the operation is
+    applied and buffered, and become durable at the next group commit,
+    i.e., within commit_interval seconds. With durable=True they wait
+    for the group commit that contains them. commit() forces one. A
+    failed commit keeps the records buffered for the next one, and the
+    durable writers waiting for it raise RuntimeError.
+
+    Keyword attributes:
+    path -- the log file path
+    snapshot_path -- an optional snapshot file loaded on startup and
+    written by checkpoint()
+    commit_interval -- the maximum seconds between two group commits
+    commit_size -- the number of pending records that triggers a commit
+    durable -- whether add() and remove() wait for their group commit
+    replay_workers -- the number of processes replaying the log
+    int_timestamps -- log and replay exact int64 timestamps, see
+    LWW_set.use_int_timestamps(); snapshots store float64 timestamps,
+    so it cannot be used with a snapshot_path
+    """
+    def __init__(self, path, snapshot_path=None, commit_interval=0.01,
+                 commit_size=1000, durable=False, replay_workers=1, int_timestamps=False):
+        if int_timestamps and snapshot_path is not None:
+            raise ValueError("int_timestamps cannot be used with a snapshot_path!")
+        self.int_timestamps = False  # set by use_int_timestamps()
+        LWW_python.__init__(self, int_timestamps=int_timestamps)
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.commit_interval = commit_interval
+        self.commit_size = commit_size
+        self.durable = durable
+
+        if snapshot_path is not None and os.path.exists(snapshot_path):
+            snapshot = LWW_python.load(snapshot_path)
+            self.add_set = snapshot.add_set
+            self.remove_set = snapshot.remove_set
+            self.sequences = snapshot.sequences
+            self.last_sequence = snapshot.last_sequence
+        self.replay(replay_workers)
+        self.recount()
+
+        self.file = open(path, "ab")
+        self.buffer = []            # encoded, not yet written records
+        self.pending = 0            # the number of records in buffer
+        self.appended = 0           # records appended since startup
+        self.committed = 0          # records fsync'ed since startup
+        self.failures = 0           # failed commits since startup
+        self.error = None           # the exception of the last failed commit
+        self.buffer_lock = Lock()
+        self.commit_done = Condition(self.buffer_lock)
+        self.commit_lock = RLock()  # serializes writes to the log file
+        self.wake = Event()
+        self.closed = False
+        self.committer = Thread(target=self.__run_committer)
+        self.committer.daemon = True
+        self.committer.start()
+
+    def use_int_timestamps(self):
+        """Validates timestamps as ints and logs them as int64 from now on
+
+        See base class LWW_set docstring for detals.
+        """
+        self.int_timestamps = True
+        LWW_python.use_int_timestamps(self)
+
+    def replay(self, workers=1):
+        """Replays the log into the lww-set and cuts off a torn tail"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            data = f.read()
+        blocks = scan_blocks(data)
+        valid_length = blocks[-1][1] if blocks else 0
+        del data
+
+        if workers > 1 and len(blocks) > 1:
+            step = (len(blocks) + workers - 1) // workers
+            parts = [blocks[i:i + step] for i in range(0, len(blocks), step)]
+            with ProcessPoolExecutor(len(parts)) as executor:
+                results = list(executor.map(replay_blocks, [self.path] * len(parts), parts))
+        else:
+            results = [replay_blocks(self.path, blocks)]
+
+        sequences = self.sequences
+        for sets in results:
+            for target_set, replayed_set in zip((self.add_set, self.remove_set), sets):
+                for element, timestamp in replayed_set.items():
+                    if self.int_timestamps:
+                        timestamp = int(timestamp)  # of a float64 record
+                    current_timestamp = target_set.get(element)
+                    if current_timestamp is None or current_timestamp < timestamp:
+                        target_set[element] = timestamp
+                        # numbered as a change, see LWW_python.delta_since()
+                        sequences.pop(element, None)
+                        self.last_sequence += 1
+                        sequences[element] = self.last_sequence
+
+        if valid_length < os.path.getsize(self.path):
+            with open(self.path, "r+b") as f:
+                f.truncate(valid_length)
+
+    def add(self, element, timestamp=None):
+        """Add an element to lww_set, and log the operation
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+        timestamp = self.write_timestamp(timestamp)
+        if not LWW_python.add(self, element, timestamp):
+            return False
+        return self.log([(self.ADD, element, timestamp)])
+
+    def remove(self, element, timestamp=None):
+        """Remove an element from lww_set, and log the operation
+
+        See base class LWW_set docstring for detals.
+        """
+        element = self.validate_element(element)
+        timestamp = self.write_timestamp(timestamp)
+        if not LWW_python.remove(self, element, timestamp):
+            return False
+        return self.log([(self.REMOVE, element, timestamp)])
+
+    def apply_ops(self, ops):
+        """Apply a batch of add and remove operations, and log them
+
+        See base class LWW_set docstring for detals.
+        """
+        ops = [self.validate_op(op, element, timestamp)
+               for op, element, timestamp in ops]
+        if not LWW_python.apply_ops(self, ops):
+            return False
+        return self.log(ops)
+
+    def log(self, ops):
+        """Appends validated operations to the log buffer
+
+        Keyword returns:
+        True -- the operations are buffered (or, if durable, committed)
+        False -- the log is closed
+
+        Keyword raise:
+        RuntimeError -- durable only, the group commit failed; the
+        operations stay buffered for the next commit
+        """
+        if not ops:
+            return True
+        payload = encode_ops(ops, self.int_timestamps)
+        with self.buffer_lock:
+            if self.closed:
+                return False
+            self.buffer.append(payload)
+            self.pending += len(ops)
+            self.appended += len(ops)
+            sequence = self.appended
+            if self.pending >= self.commit_size:
+                self.wake.set()
+            if not self.durable:
+                return True
+            self.wake.set()
+            failures = self.failures
+            while self.committed < sequence and not self.closed and self.failures == failures:
+                self.commit_done.wait()
+            if self.committed < sequence and self.failures != failures:
+                raise RuntimeError("The group commit of the log failed: %r. A retry may solve the problem. "
+                                   % (self.error,))
+            return self.committed >= sequence
+
+    def commit(self):
+        """Writes and fsyncs all buffered records as one block
+
+        The records leave the buffer only once the block is fsync'ed.
+        If the write or the fsync fails, a partly written block is cut
+        off, the records stay buffered, the durable writers waiting for
+        them are woken up to raise, and the error is raised.
+        """
+        with self.commit_lock:
+            with self.buffer_lock:
+                n_payloads = len(self.buffer)
+                payload = b"".join(self.buffer)
+                count = self.pending
+                sequence = self.appended
+            if count:
+                start = self.file.tell()
+                try:
+                    self.file.write(BLOCK_HEADER.pack(len(payload), count,
+                                                      zlib.crc32(payload) & 0xffffffff))
+                    self.file.write(payload)
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                except Exception as error:
+                    try:
+                        self.file.truncate(start)
+                    except (IOError, OSError, ValueError):
+                        pass  # replay cuts the torn block off
+                    with self.buffer_lock:
+                        self.failures += 1
+                        self.error = error
+                        self.commit_done.notify_all()
+                    raise
+            with self.buffer_lock:
+                # records appended during the write stay buffered
+                del self.buffer[:n_payloads]
+                self.pending -= count
+                self.committed = sequence
+                self.commit_done.notify_all()
+
+    def __run_committer(self):
+        while not self.closed:
+            self.wake.wait(self.commit_interval)
+            self.wake.clear()
+            try:
+                self.commit()
+            except (IOError, OSError, ValueError):
+                # the log was closed or the disk failed; the records
+                # stay buffered and the next commit retries them
+                pass
+
+    def checkpoint(self):
+        """Writes a snapshot to snapshot_path and truncates the log
+
+        Records buffered while the snapshot is taken stay in the buffer
+        and are written to the truncated log afterwards. Everything
+        already in the log file was applied before it was logged, so it
+        is contained in the snapshot. The log is only truncated once the
+        snapshot and its rename are fsync'ed, see write_snapshot().
+        """
+        if self.snapshot_path is None:
+            raise ValueError("checkpoint() needs a snapshot_path!")
+        if self.int_timestamps:
+            raise ValueError("snapshots store float64 timestamps, not int_timestamps!")
+        with self.commit_lock:
+            self.commit()
+            self.dump(self.snapshot_path)  # durable once it returns
+            self.file.truncate(0)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        """Commits the buffered records and closes the log
+
+        The log is closed even if the last commit fails, which raises
+        its error.
+        """
+        try:
+            with self.commit_lock:
+                if self.closed:
+                    return
+                try:
+                    self.commit()
+                finally:
+                    with self.buffer_lock:
+                        self.closed = True
+                        self.commit_done.notify_all()
+                    self.wake.set()
+                    self.file.close()
+        finally:
+            self.committer.join()
@@ -0,0 +1,159 @@
+"""unit tests for the lww_wal"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from lww_wal import LWW_python_wal, replay_blocks, scan_blocks
+
+class Test_LWW_Wal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "lww.log")
+        self.snapshot_path = os.path.join(self.directory, "lww.snapshot")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def reopen(self, lww, **kwargs):
+        lww.close()
+        return LWW_python_wal(self.path, self.snapshot_path, **kwargs)
+
+    def test_replay(self):
+        lww = LWW_python_wal(self.path, commit_interval=60)
+        lww.add("a", 1)
+        lww.add(u"élément", 1)
+        lww.remove("a", 2)
+        lww.add_many([("b", 1), ("c", 1)])
+        lww.remove("c", 0)
+        lww = self.reopen(lww)
+        self.assertEqual(sorted(lww.get()), ["b", "c", u"élément"])
+        self.assertEqual(lww.remove_set, {"a": 2, "c": 0})
+        # new operations are appended after the replayed ones
+        lww.add("a", 3)
+        lww = self.reopen(lww)
+        self.assertEqual(sorted(lww.get()), ["a", "b", "c", u"élément"])
+        lww.close()
+
+    def test_group_commit(self):
+        lww = LWW_python_wal(self.path, commit_interval=60, commit_size=1000)
+        lww.add_many((i, 1) for i in range(10))
+        self.assertEqual(os.path.getsize(self.path), 0)
+        lww.commit()
+        size = os.path.getsize(self.path)
+        self.assertTrue(size > 0)
+        lww.commit()  # nothing pending, nothing written
+        self.assertEqual(os.path.getsize(self.path), size)
+        lww.close()
+
+    def test_durable(self):
+        lww = LWW_python_wal(self.path, commit_interval=60, durable=True)
+
+        def write(offset):
+            for i in range(offset, 200, 4):
+                self.assertTrue(lww.add(i, 1))
+
+        threads = [threading.Thread(target=write, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(lww.committed, 200)
+        # every acknowledged operation is on disk before close()
+        shutil.copy(self.path, self.path + ".copy")
+        lww.close()
+        copy = LWW_python_wal(self.path + ".copy")
+        self.assertEqual(len(copy.get()), 200)
+        copy.close()
+
+    def test_int_timestamps(self):
+        """int64 records replay exactly beyond the precision of a float"""
+        t = 1700000000000000000  # nanoseconds
+        lww = LWW_python_wal(self.path, int_timestamps=True)
+        lww.add("a", t + 1)
+        lww.remove("a", t + 2)
+        lww.apply_ops([(lww.ADD, "b", t + 3), (lww.REMOVE, "b", t + 2)])
+        self.assertRaises(ValueError, lww.add, "c", 1.5)
+        lww.close()
+        lww = LWW_python_wal(self.path, int_timestamps=True)
+        self.assertEqual(lww.timestamps("a"), (t + 1, t + 2))
+        self.assertEqual(lww.timestamps("b"), (t + 3, t + 2))
+        self.assertEqual(type(lww.timestamps("b")[0]), int)
+        self.assertEqual(lww.get(), ["b"])
+        lww.close()
+        self.assertRaises(ValueError, LWW_python_wal, self.path, self.snapshot_path,
+                          int_timestamps=True)
+
+    def test_failed_commit(self):
+        """A failed write keeps the records and raises to durable writers"""
+        lww = LWW_python_wal(self.path, commit_interval=60, durable=True)
+        log_file = lww.file
+
+        class Full_disk(object):
+            def write(self, data):
+                raise OSError("No space left on device")
+
+            def __getattr__(self, name):
+                return getattr(log_file, name)
+
+        lww.file = Full_disk()
+        self.assertRaises(RuntimeError, lww.add, "a", 1)
+        self.assertRaises(OSError, lww.commit)
+        self.assertEqual(lww.pending, 1)
+        lww.file = log_file
+        self.assertTrue(lww.add("b", 1))
+        self.assertEqual(lww.committed, 2)
+        lww = self.reopen(lww)
+        self.assertEqual(sorted(lww.get()), ["a", "b"])
+        lww.close()
+
+    def test_torn_tail(self):
+        lww = LWW_python_wal(self.path)
+        lww.add("a", 1)
+        lww.commit()
+        lww.add("b", 1)
+        lww.close()
+        size = os.path.getsize(self.path)
+        with open(self.path, "r+b") as f:
+            f.truncate(size - 1)
+        lww = LWW_python_wal(self.path)
+        self.assertEqual(lww.get(), ["a"])
+        lww.add("c", 1)
+        lww = self.reopen(lww)
+        self.assertEqual(sorted(lww.get()), ["a", "c"])
+        lww.close()
+
+    def test_checkpoint(self):
+        lww = LWW_python_wal(self.path, self.snapshot_path)
+        lww.add_many((i, 1) for i in range(100))
+        lww.checkpoint()
+        self.assertEqual(os.path.getsize(self.path), 0)
+        lww.remove(5, 2)
+        lww = self.reopen(lww)
+        self.assertEqual(len(lww.get()), 99)
+        self.assertFalse(lww.exist(5))
+        lww.close()
+
+    def test_parallel_replay(self):
+        lww = LWW_python_wal(self.path, commit_interval=60)
+        for i in range(20):
+            lww.add_many((j, i) for j in range(50))
+            lww.remove_many((j, i) for j in range(i, 50, 7))
+            lww.commit()
+        serial = self.reopen(lww)
+        parallel = self.reopen(serial, replay_workers=3)
+        self.assertEqual(parallel.add_set, serial.add_set)
+        self.assertEqual(parallel.remove_set, serial.remove_set)
+        parallel.close()
+        # a worker reads from the first block of its range
+        with open(self.path, "rb") as f:
+            blocks = scan_blocks(f.read())
+        self.assertEqual(len(blocks), 20)
+        add_set, remove_set = replay_blocks(self.path, blocks[-1:])
+        self.assertEqual(add_set, dict((str(j), 19) for j in range(50)))
+        self.assertEqual(remove_set, dict((str(j), 19) for j in range(19, 50, 7)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,392 @@
+"""Workload generator and benchmark harness for lww-sets
+
+Usage:
+    python lww_workload.py [--backend python] [--size N] [--ops N]
+        [--keys uniform|zipf] [--zipf-s S] [--mix add=0.2,remove=0.1,exist=0.7]
+        [--skew N] [--threads N] [--processes N] [--redis HOST:PORT|fakeredis]
+        [--output FILE] [--baseline FILE] [--tolerance 0.1]
+
+A run preloads a set with --size elements, then --threads threads in
+each of --processes processes run --ops operations in total, drawn from
+the mix. It prints a JSON result with the throughput, the p50/p99/p999
+latency of every operation kind in microseconds and the peak RSS of the
+run. With --baseline, a previous result is compared with this one, and
+the exit status is 1 if the throughput or a p50/p99 latency regressed
+by more than --tolerance.
+
+Processes are forked after the preload. Each process has its own copy
+of an lww_python set, so use them with lww_redis or lww_shared, which
+all processes share. The ring backend spreads the set over the
+comma-separated servers of --redis, e.g., three local redis-server
+processes on ports 6379 to 6381. fakeredis lives in one process and only supports
+--processes 1.
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import random
+import resource
+import sys
+import threading
+import time
+from itertools import islice
+from lww_metrics import Histogram
+
+OPERATIONS = ("add", "remove", "exist", "get")
+PRELOAD_BATCH = 10000
+
+
+class Workload(object):
+    """A reproducible stream of lww-set operations.
+
+    Elements are the strings of 0..n_elements-1, drawn uniformly or
+    from a Zipf distribution in which element k is chosen with a
+    probability proportional to 1 / (k + 1) ** zipf_s, i.e., "0" is the
+    hottest. Write timestamps count up with the operations, each moved
+    back by a random 0..skew, so that up to skew later writes arrive
+    before an earlier one. Every worker draws from its own seeded
+    generator, so a workload is the same on every run.
+
+    Keyword attributes:
+    n_elements -- the number of distinct elements, and of preloaded ones
+    n_ops -- the number of operations of all workers together
+    keys -- "uniform" or "zipf"
+    zipf_s -- the exponent of the Zipf distribution, > 0
+    mix -- operation kind -> its share, e.g., {"add": 0.2, "exist": 0.8}
+    skew -- the maximum number of operations a timestamp is moved back
+    seed -- the seed of the generators
+    """
+    def __init__(self, n_elements=100000, n_ops=100000, keys="uniform", zipf_s=1.1,
+                 mix=None, skew=0, seed=0):
+        if keys not in ("uniform", "zipf"):
+            raise ValueError("keys must be uniform or zipf!")
+        if keys == "zipf" and zipf_s <= 0:
+            raise ValueError("zipf_s must be positive!")
+        mix = dict(mix or {"add": 0.2, "remove": 0.1, "exist": 0.7})
+        if not mix or any(op not in OPERATIONS or share < 0 for op, share in mix.items()) \
+                or sum(mix.values()) <= 0:
+            raise ValueError("mix must map some of %s to non-negative shares!" % (OPERATIONS,))
+        self.n_elements = n_elements
+        self.n_ops = n_ops
+        self.keys = keys
+        self.zipf_s = zipf_s
+        self.mix = mix
+        self.skew = skew
+        self.seed = seed
+
+    def config(self):
+        """Returns the parameters as a dict, for the JSON result"""
+        return {"n_elements": self.n_elements, "n_ops": self.n_ops, "keys": self.keys,
+                "zipf_s": self.zipf_s, "mix": self.mix, "skew": self.skew, "seed": self.seed}
+
+    def preload(self):
+        """Iterates over (element, timestamp) pairs adding every element
+        before the first operation"""
+        return ((str(i), 0) for i in range(self.n_elements))
+
+    def element_sampler(self, rand):
+        """Returns a function drawing one element index
+
+        The Zipf distribution is sampled by inverting the CDF of its
+        continuous approximation, in constant time and memory whatever
+        n_elements is.
+        """
+        n = self.n_elements
+        if self.keys == "uniform":
+            return lambda: rand.randrange(n)
+        s = self.zipf_s
+        if abs(s - 1.0) < 1e-9:
+            log_n = math.log(n + 1)
+            return lambda: min(n - 1, int(math.exp(rand.random() * log_n)) - 1)
+        exponent = 1.0 - s
+        span = (n + 1) ** exponent - 1.0
+        return lambda: min(n - 1, int((rand.random() * span + 1.0) ** (1.0 / exponent)) - 1)
+
+    def ops(self, worker, n_workers):
+        """Returns the (op, element, timestamp) list of one worker
+
+        Operation i of all workers is run by worker i % n_workers, so
+        the workers share the timestamps of one stream. get has no
+        element, its element is None.
+        """
+        rand = random.Random("%s/%d" % (self.seed, worker))
+        sample = self.element_sampler(rand)
+        kinds = sorted(self.mix)
+        cum_weights = []
+        total = 0.0
+        for op in kinds:
+            total += self.mix[op]
+            cum_weights.append(total)
+        skew = self.skew
+        ops = []
+        for i in range(worker, self.n_ops, n_workers):
+            op = rand.choices(kinds, cum_weights=cum_weights)[0]
+            timestamp = 1 + i - (rand.randint(0, skew) if skew else 0)
+            ops.append((op, None if op == "get" else str(sample()), timestamp))
+        return ops
+
+
+def run_ops(lww, ops, histograms):
+    """Runs ops on an lww-set, recording the nanoseconds of each in the
+    histogram of its kind
+
+    Keyword returns:
+    the number of operations that raised or returned False
+    """
+    calls = {"add": lww.add, "remove": lww.remove}
+    exist = lww.exist
+    get = lww.get
+    clock = time.perf_counter_ns
+    errors = 0
+    for op, element, timestamp in ops:
+        record = histograms[op].record
+        start = clock()
+        try:
+            if op == "exist":
+                exist(element)
+            elif op == "get":
+                get()
+            elif calls[op](element, timestamp) is False:
+                errors += 1
+        except Exception:
+            errors += 1
+        record(clock() - start)
+    return errors
+
+
+def run_threads(lww, workload, workers, n_workers):
+    """Runs the ops of some workers, one thread each
+
+    Keyword returns:
+    (start time, end time, histograms, errors) of the threads together
+    """
+    worker_ops = [workload.ops(worker, n_workers) for worker in workers]
+    worker_histograms = [dict((op, Histogram()) for op in OPERATIONS) for _ in workers]
+    errors = [0] * len(workers)
+
+    def run(i):
+        errors[i] = run_ops(lww, worker_ops[i], worker_histograms[i])
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(workers))]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    end = time.time()
+    histograms = dict((op, Histogram()) for op in OPERATIONS)
+    for thread_histograms in worker_histograms:
+        for op, histogram in thread_histograms.items():
+            histograms[op].merge(histogram)
+    return start, end, histograms, sum(errors)
+
+
+def peak_rss():
+    """Returns the peak RSS in bytes of this process and of its
+    terminated children"""
+    scale = 1 if sys.platform == "darwin" else 1024  # bytes on macOS, KiB elsewhere
+    return scale * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def run_workload(lww, workload, threads=1, processes=1):
+    """Preloads an lww-set and runs a workload on it
+
+    Keyword arguments:
+    lww -- an empty lww-set
+    workload -- a Workload
+    threads -- the number of threads per process
+    processes -- the number of forked processes, 1 to run in this one
+
+    Keyword returns:
+    a dict of the "workload", "threads", "processes", "ops", "errors",
+    "seconds", "ops_per_second", "latency_us" (operation kind or "all"
+    -> {"p50", "p99", "p999"}) and "peak_rss_mb"
+    """
+    pairs = workload.preload()
+    while True:
+        batch = list(islice(pairs, PRELOAD_BATCH))
+        if not batch:
+            break
+        lww.add_many(batch)
+
+    n_workers = threads * processes
+    if processes == 1:
+        runs = [run_threads(lww, workload, range(threads), n_workers)]
+    else:
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+
+        def run(process):
+            workers = range(process * threads, (process + 1) * threads)
+            results.put(run_threads(lww, workload, workers, n_workers))
+
+        children = [context.Process(target=run, args=(i,)) for i in range(processes)]
+        for p in children:
+            p.start()
+        runs = [results.get() for _ in children]
+        for p in children:
+            p.join()
+
+    seconds = max(run[1] for run in runs) - min(run[0] for run in runs)
+    histograms = dict((op, Histogram()) for op in OPERATIONS)
+    for run in runs:
+        for op, histogram in run[2].items():
+            histograms[op].merge(histogram)
+    total = Histogram()
+    for histogram in histograms.values():
+        total.merge(histogram)
+    latency = {}
+    for op, histogram in list(histograms.items()) + [("all", total)]:
+        if histogram.total:
+            latency[op] = dict((name, histogram.percentile(p) / 1000.0)
+                               for name, p in (("p50", 50), ("p99", 99), ("p999", 99.9)))
+    n_ops = total.total
+    return {"workload": workload.config(),
+            "threads": threads,
+            "processes": processes,
+            "ops": n_ops,
+            "errors": sum(run[3] for run in runs),
+            "seconds": seconds,
+            "ops_per_second": n_ops / seconds if seconds > 0 else 0.0,
+            "latency_us": latency,
+            "peak_rss_mb": peak_rss() / 1e6}
+
+
+def compare(result, baseline, tolerance=0.1):
+    """Returns the regressions of a result against a baseline result
+
+    The throughput regresses if it is lower than the baseline by more
+    than tolerance (a fraction), and a p50 or p99 latency if it is
+    higher by more than tolerance. p999 latencies are too noisy for a
+    gate and are not compared. Results of different backends or
+    workloads are not comparable, which is reported as a regression.
+
+    Keyword returns:
+    a list of messages, empty if there is no regression
+    """
+    regressions = []
+    for key in ("backend", "workload", "threads", "processes"):
+        if result.get(key) != baseline.get(key):
+            regressions.append("%s %s differs from baseline %s"
+                               % (key, result.get(key), baseline.get(key)))
+    if result["ops_per_second"] < baseline["ops_per_second"] * (1.0 - tolerance):
+        regressions.append("ops_per_second %.0f < baseline %.0f"
+                           % (result["ops_per_second"], baseline["ops_per_second"]))
+    for op, percentiles in sorted(baseline["latency_us"].items()):
+        for name in ("p50", "p99"):
+            value = result["latency_us"].get(op, {}).get(name)
+            if value is not None and value > percentiles[name] * (1.0 + tolerance):
+                regressions.append("%s %s %.1f us > baseline %.1f us"
+                                   % (op, name, value, percentiles[name]))
+    return regressions
+
+
+def redis_client(address):
+    """Returns a client of a HOST:PORT address, or of a fakeredis server"""
+    if address == "fakeredis":
+        import fakeredis
+        return fakeredis.FakeStrictRedis()
+    import redis
+    host, _, port = (address or "localhost").partition(":")
+    return redis.StrictRedis(host=host, port=int(port or 6379), db=0)
+
+
+def make_lww(backend, redis_address=None):
+    """Returns an empty lww-set of a backend name
+
+    Keyword arguments:
+    backend -- python, compact, sharded, shared, redis or ring
+    redis_address -- HOST:PORT of a redis server, or "fakeredis"; for
+    ring, a comma-separated list of them
+    """
+    if backend == "python":
+        from lww_python import LWW_python
+        return LWW_python()
+    if backend == "compact":
+        from lww_python_compact import LWW_python_compact
+        return LWW_python_compact()
+    if backend == "sharded":
+        from lww_python_sharded import LWW_python_sharded
+        return LWW_python_sharded()
+    if backend == "shared":
+        from lww_shared import LWW_shared
+        return LWW_shared()
+    if backend == "redis":
+        from lww_redis import LWW_redis
+        client = redis_client(redis_address)
+        lww = LWW_redis(client, namespace="lww_workload")
+        client.delete(*[key for keys in lww.buckets for key in keys])
+        return lww
+    if backend == "ring":
+        from lww_redis_ring import LWW_redis_ring
+        nodes = dict((address, redis_client(address))
+                     for address in (redis_address or "localhost").split(","))
+        lww = LWW_redis_ring(nodes, namespace="lww_workload")
+        for node in lww.nodes.values():
+            node.redis.delete(*[key for keys in node.buckets for key in keys])
+        return lww
+    raise ValueError("unknown backend %s!" % backend)
+
+
+def parse_mix(text):
+    """Parses "add=0.2,exist=0.8" into {"add": 0.2, "exist": 0.8}"""
+    mix = {}
+    for item in text.split(","):
+        op, _, share = item.partition("=")
+        mix[op.strip()] = float(share)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Workload benchmark for lww_set")
+    parser.add_argument("--backend", default="python",
+                        choices=["python", "compact", "sharded", "shared", "redis", "ring"])
+    parser.add_argument("--redis", metavar="HOST:PORT", default="localhost:6379",
+                        help='the redis server of the redis backend, or "fakeredis"; '
+                             'the comma-separated servers of the ring backend')
+    parser.add_argument("--size", type=int, default=100000,
+                        help="number of distinct and preloaded elements")
+    parser.add_argument("--ops", type=int, default=100000, help="number of operations")
+    parser.add_argument("--keys", default="uniform", choices=["uniform", "zipf"])
+    parser.add_argument("--zipf-s", type=float, default=1.1, help="Zipf exponent")
+    parser.add_argument("--mix", type=parse_mix, default=None,
+                        help="operation shares, e.g., add=0.2,remove=0.1,exist=0.7")
+    parser.add_argument("--skew", type=int, default=0,
+                        help="maximum number of operations a timestamp is moved back")
+    parser.add_argument("--threads", type=int, default=1, help="threads per process")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the JSON result to this file")
+    parser.add_argument("--baseline", help="a JSON result to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="the regression tolerance as a fraction")
+    args = parser.parse_args()
+
+    workload = Workload(args.size, args.ops, args.keys, args.zipf_s, args.mix,
+                        args.skew, args.seed)
+    lww = make_lww(args.backend, args.redis)
+    try:
+        result = run_workload(lww, workload, args.threads, args.processes)
+    finally:
+        if hasattr(lww, "close"):
+            lww.close()
+    result["backend"] = args.backend
+    text = json.dumps(result, indent=2, sort_keys=True)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: %s" % regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""unit tests for the lww_workload"""
+
+import unittest
+from collections import Counter
+from lww_python import LWW_python
+from lww_shared import LWW_shared
+from lww_workload import Workload, run_workload, compare
+
+
+class Test_Workload(unittest.TestCase):
+    def test_ops(self):
+        workload = Workload(n_elements=100, n_ops=10000, seed=1)
+        ops = workload.ops(0, 1)
+        self.assertEqual(ops, Workload(n_elements=100, n_ops=10000, seed=1).ops(0, 1))
+        self.assertNotEqual(ops, Workload(n_elements=100, n_ops=10000, seed=2).ops(0, 1))
+        self.assertEqual([timestamp for _, _, timestamp in ops], list(range(1, 10001)))
+        shares = Counter(op for op, _, _ in ops)
+        self.assertTrue(6500 < shares["exist"] < 7500)
+        self.assertTrue(1500 < shares["add"] < 2500)
+        self.assertTrue(all(0 <= int(element) < 100 for _, element, _ in ops))
+        # the workers split one stream of timestamps
+        timestamps = sorted(timestamp for worker in range(3)
+                            for _, _, timestamp in workload.ops(worker, 3))
+        self.assertEqual(timestamps, list(range(1, 10001)))
+
+    def test_mix(self):
+        ops = Workload(n_elements=10, n_ops=100, mix={"get": 1, "add": 0}).ops(0, 1)
+        self.assertEqual(set((op, element) for op, element, _ in ops), set([("get", None)]))
+        self.assertRaises(ValueError, Workload, mix={"update": 1})
+        self.assertRaises(ValueError, Workload, mix={"add": 0})
+        self.assertRaises(ValueError, Workload, keys="normal")
+
+    def test_zipf(self):
+        for s in (1.0, 1.2):
+            ops = Workload(n_elements=1000, n_ops=20000, keys="zipf", zipf_s=s).ops(0, 1)
+            counts = Counter(int(element) for _, element, _ in ops)
+            self.assertTrue(min(counts) >= 0 and max(counts) < 1000)
+            # the hottest element is drawn about twice as often as the second
+            self.assertTrue(1.5 < counts[0] / float(counts[1]) < 3.0, counts.most_common(3))
+            self.assertTrue(counts[0] > 20 * counts.get(100, 1))
+
+    def test_skew(self):
+        ops = Workload(n_elements=10, n_ops=1000, skew=50).ops(0, 1)
+        moved = [i + 1 - timestamp for i, (_, _, timestamp) in enumerate(ops)]
+        self.assertTrue(min(moved) >= 0 and max(moved) <= 50)
+        self.assertTrue(max(moved) > 40)
+
+
+class Test_Run_Workload(unittest.TestCase):
+    def test_threads(self):
+        workload = Workload(n_elements=1000, n_ops=2000,
+                            mix={"add": 0.3, "remove": 0.2, "exist": 0.49, "get": 0.01})
+        lww = LWW_python()
+        result = run_workload(lww, workload, threads=2)
+        self.assertEqual(result["ops"], 2000)
+        self.assertEqual(result["errors"], 0)
+        self.assertEqual(sorted(result["latency_us"]), ["add", "all", "exist", "get", "remove"])
+        latency = result["latency_us"]["all"]
+        self.assertTrue(0 < latency["p50"] <= latency["p99"] <= latency["p999"])
+        self.assertTrue(result["ops_per_second"] > 0)
+        self.assertTrue(result["peak_rss_mb"] > 0)
+        self.assertEqual(result["workload"], workload.config())
+        self.assertTrue(lww.count() >= 1000 - 400)
+
+    def test_processes(self):
+        workload = Workload(n_elements=100, n_ops=1000, mix={"remove": 1})
+        with LWW_shared(capacity=1024) as lww:
+            result = run_workload(lww, workload, threads=2, processes=2)
+            self.assertEqual(result["ops"], 1000)
+            # the removes of all processes reach the shared set
+            removed = set(element for worker in range(4)
+                          for _, element, _ in workload.ops(worker, 4))
+            self.assertEqual(lww.count(), 100 - len(removed))
+
+    def test_compare(self):
+        baseline = {"backend": "python", "workload": {}, "threads": 1, "processes": 1,
+                    "ops_per_second": 1000.0,
+                    "latency_us": {"exist": {"p50": 1.0, "p99": 10.0, "p999": 100.0}}}
+        result = dict(baseline, ops_per_second=950.0,
+                      latency_us={"exist": {"p50": 1.05, "p99": 10.0, "p999": 500.0}})
+        self.assertEqual(compare(result, baseline), [])
+        result["ops_per_second"] = 800.0
+        result["latency_us"]["exist"]["p99"] = 12.0
+        self.assertEqual(len(compare(result, baseline)), 2)
+        self.assertEqual(compare(result, baseline, tolerance=0.5), [])
+        result["threads"] = 4
+        self.assertEqual(len(compare(result, baseline, tolerance=0.5)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()